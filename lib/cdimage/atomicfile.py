@@ -24,11 +24,17 @@ import sys
 
 
 class AtomicFile:
-    """Facilitate atomic writing of files.  Forces UTF-8 encoding."""
+    """Facilitate atomic writing of files.
 
-    def __init__(self, filename):
+    Forces UTF-8 encoding, unless BINARY is true in which case the file
+    takes bytes.
+    """
+
+    def __init__(self, filename, binary=False):
         self.filename = filename
-        if sys.version_info[0] < 3:
+        if binary:
+            self.fd = open('%s.new' % self.filename, 'wb')
+        elif sys.version_info[0] < 3:
             self.fd = codecs.open(
                 '%s.new' % self.filename, 'w', 'UTF-8', 'replace')
         else:
@@ -45,6 +51,11 @@ class AtomicFile:
         self.fd.close()
         if exc_type is None:
             os.rename('%s.new' % self.filename, self.filename)
+        else:
+            try:
+                os.unlink('%s.new' % self.filename)
+            except OSError:
+                pass
 
     # Not really necessary, but reduces pychecker confusion.
     def write(self, s):
@@ -0,0 +1,222 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for checksum generation.
+
+Each case runs in a fresh child process against a synthetic image tree,
+so that peak RSS and syscall counts are not polluted by earlier cases.
+"""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+from collections import namedtuple
+import multiprocessing
+import os
+import resource
+import time
+
+from cdimage.checksums import (
+    ChecksumFile,
+    ChecksumFileSet,
+    checksum_directory,
+    )
+from cdimage.log import logger
+from cdimage import osextras
+
+
+BenchmarkResult = namedtuple(
+    "BenchmarkResult",
+    ["name", "seconds", "bytes", "syscalls", "peak_rss"])
+
+
+def make_sparse_file(path, size):
+    """Create a sparse file of SIZE bytes without writing its contents."""
+    with open(path, "wb") as sparse:
+        sparse.truncate(size)
+
+
+def make_tree(directory, images=4, image_size=2 * 1024 * 1024 * 1024,
+              small_files=200, small_size=64 * 1024, old_directories=3,
+              old_entries=500):
+    """Populate DIRECTORY with a synthetic image tree.
+
+    The tree holds IMAGES sparse images of IMAGE_SIZE bytes and
+    SMALL_FILES real files of SMALL_SIZE bytes, plus OLD_DIRECTORIES old
+    directories whose checksum files each list OLD_ENTRIES unrelated
+    images, so that merging has to look at them but never finds a match.
+
+    Returns the image directory and the list of old directories.
+    """
+    image_dir = os.path.join(directory, "images")
+    osextras.ensuredir(image_dir)
+    for i in range(images):
+        make_sparse_file(
+            os.path.join(image_dir, "bench-desktop-arch%d.iso" % i),
+            image_size)
+    for i in range(small_files):
+        with open(os.path.join(image_dir, "bench-small%d.img" % i),
+                  "wb") as small:
+            small.write(os.urandom(small_size))
+
+    old_dirs = []
+    for i in range(old_directories):
+        old_dir = os.path.join(directory, "old%d" % i)
+        osextras.ensuredir(old_dir)
+        for name, hash_method in ChecksumFileSet.checksum_file_methods.items():
+            digest = hash_method(name.encode("UTF-8")).hexdigest()
+            with open(os.path.join(old_dir, name), "w") as old_sums:
+                for j in range(old_entries):
+                    print("%s *old%d-arch%d.raw" % (digest, i, j),
+                          file=old_sums)
+        old_dirs.append(old_dir)
+    return image_dir, old_dirs
+
+
+def tree_bytes(image_dir):
+    return sum(
+        os.stat(os.path.join(image_dir, name)).st_size
+        for name in os.listdir(image_dir))
+
+
+def _read_syscalls():
+    """Return the number of read and write syscalls made so far.
+
+    This includes reaped child processes.  Returns None if the kernel
+    does not provide I/O accounting.
+    """
+    try:
+        with open("/proc/self/io") as io:
+            fields = dict(line.split(": ", 1) for line in io)
+    except IOError:
+        return None
+    try:
+        return int(fields["syscr"]) + int(fields["syscw"])
+    except (KeyError, ValueError):
+        return None
+
+
+def _peak_rss():
+    """Return peak RSS in KiB of this process or any reaped child."""
+    return max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def _run_in_child(function, args, conn):
+    syscalls_before = _read_syscalls()
+    start = time.time()
+    function(*args)
+    seconds = time.time() - start
+    syscalls_after = _read_syscalls()
+    if syscalls_before is None or syscalls_after is None:
+        syscalls = None
+    else:
+        syscalls = syscalls_after - syscalls_before
+    conn.send((seconds, syscalls, _peak_rss()))
+    conn.close()
+
+
+def run_case(name, function, args, nbytes):
+    """Run FUNCTION(*ARGS) in a child process and measure it."""
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    child = multiprocessing.Process(
+        target=_run_in_child, args=(function, args, child_conn))
+    child.start()
+    child_conn.close()
+    try:
+        seconds, syscalls, peak_rss = parent_conn.recv()
+    except EOFError:
+        child.join()
+        raise RuntimeError(
+            "Benchmark %s failed (exit status %s)" % (name, child.exitcode))
+    child.join()
+    return BenchmarkResult(name, seconds, nbytes, syscalls, peak_rss)
+
+
+def _per_digest(config, image_dir):
+    """The old code path: one complete read per image per digest."""
+    for name in sorted(os.listdir(image_dir)):
+        for checksum_name, hash_method in sorted(
+                ChecksumFileSet.checksum_file_methods.items()):
+            checksum_file = ChecksumFile(
+                config, image_dir, checksum_name, hash_method, sign=False)
+            checksum_file.checksum(os.path.join(image_dir, name))
+
+
+def _single_pass(config, image_dir):
+    checksum_files = ChecksumFileSet(config, image_dir, sign=False)
+    for name in sorted(os.listdir(image_dir)):
+        checksum_files.checksum(os.path.join(image_dir, name))
+
+
+def _merge_all(config, image_dir, old_dirs, jobs):
+    checksum_files = ChecksumFileSet(config, image_dir, sign=False)
+    checksum_files.merge_all(
+        old_dirs, map_expr=r"s/\.\(img\|iso\)$/.raw/", jobs=jobs)
+
+
+def _checksum_directory(config, image_dir, old_dirs, jobs):
+    # Silence the "No keys found" warning.
+    logger.disabled = True
+    try:
+        checksum_directory(
+            config, image_dir, old_directories=old_dirs,
+            map_expr=r"s/\.\(img\|iso\)$/.raw/", jobs=jobs)
+    finally:
+        logger.disabled = False
+
+
+def run_benchmarks(config, image_dir, old_dirs, jobs=None):
+    """Run all the checksum benchmarks; return a list of results."""
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    nbytes = tree_bytes(image_dir)
+    cases = [
+        ("ChecksumFile.checksum (per digest)", _per_digest,
+         (config, image_dir)),
+        ("ChecksumFileSet.checksum (single pass)", _single_pass,
+         (config, image_dir)),
+        ("merge_all (serial)", _merge_all, (config, image_dir, old_dirs, 1)),
+        ("merge_all (%d jobs)" % jobs, _merge_all,
+         (config, image_dir, old_dirs, jobs)),
+        ("checksum_directory (serial)", _checksum_directory,
+         (config, image_dir, old_dirs, 1)),
+        ("checksum_directory (%d jobs)" % jobs, _checksum_directory,
+         (config, image_dir, old_dirs, jobs)),
+        ]
+    return [
+        run_case(name, function, args, nbytes)
+        for name, function, args in cases]
+
+
+def format_results(results):
+    """Format benchmark results as a table, one line per case."""
+    lines = ["%-40s %10s %9s %10s %12s" % (
+        "case", "MB/s", "seconds", "syscalls", "peak RSS KiB")]
+    for result in results:
+        if result.seconds > 0:
+            rate = "%.1f" % (result.bytes / 1000000.0 / result.seconds)
+        else:
+            rate = "-"
+        if result.syscalls is None:
+            syscalls = "-"
+        else:
+            syscalls = "%d" % result.syscalls
+        lines.append("%-40s %10s %9.2f %10s %12d" % (
+            result.name, rate, result.seconds, syscalls, result.peak_rss))
+    return lines
+
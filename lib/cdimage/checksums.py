@@ -19,21 +19,22 @@ from __future__ import print_function
 
 __metaclass__ = type
 
+import errno
 import hashlib
+import multiprocessing
 import os
 import re
+import shutil
 import subprocess
+import sys
+import tempfile
+import time
 
 from cdimage.atomicfile import AtomicFile
-from cdimage.sign import can_sign, sign_cdimage
+from cdimage.sign import can_sign, sign_cdimage, sign_cdimage_batch
 
 
-def apply_sed(text, expression):
-    """Run TEXT through EXPRESSION using sed.
-
-    A pure Python approach would be better, but this saves on parsing effort
-    for now.
-    """
+def _run_sed(text, expression):
     sed = subprocess.Popen(
         ["sed", expression], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
         universal_newlines=True)
@@ -45,18 +46,421 @@ def apply_sed(text, expression):
         sed.wait()
 
 
+def _split_sed_substitution(expression):
+    """Split a sed s/// command into (pattern, replacement, flags).
+
+    Returns None if EXPRESSION is not a single s command.
+    """
+    if len(expression) < 4 or expression[0] != "s":
+        return None
+    delimiter = expression[1]
+    if delimiter in "\\\n.*[]^$":
+        # An escaped special character used as the delimiter has
+        # implementation-specific meaning.
+        return None
+    parts = []
+    current = []
+    i = 2
+    while i < len(expression):
+        c = expression[i]
+        if c == "\\" and i + 1 < len(expression):
+            if expression[i + 1] == delimiter:
+                current.append(delimiter)
+            else:
+                current.append(expression[i:i + 2])
+            i += 2
+            continue
+        if c == delimiter and len(parts) < 2:
+            parts.append("".join(current))
+            current = []
+        else:
+            current.append(c)
+        i += 1
+    if len(parts) != 2:
+        return None
+    return parts[0], parts[1], "".join(current)
+
+
+def _bre_to_python(pattern):
+    """Translate a GNU sed basic regular expression to Python syntax.
+
+    Returns None for constructs we do not handle.
+    """
+    out = []
+    # True where a following "*" is literal and "^" is an anchor.
+    at_start = True
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if i + 1 >= len(pattern):
+                return None
+            n = pattern[i + 1]
+            i += 2
+            if n in "(|":
+                out.append(n)
+                at_start = True
+                continue
+            elif n in "){}+?":
+                out.append(n)
+            elif n in "123456789":
+                out.append("\\" + n)
+            elif n == "n":
+                out.append("\n")
+            elif n in ".*[]^$\\/":
+                out.append(re.escape(n))
+            else:
+                # \w, \<, \`, and friends differ subtly between GNU sed
+                # and Python; leave them to sed.
+                return None
+        elif c == "[":
+            end = i + 1
+            if end < len(pattern) and pattern[end] == "^":
+                end += 1
+            if end < len(pattern) and pattern[end] == "]":
+                end += 1
+            end = pattern.find("]", end)
+            if end == -1:
+                return None
+            body = pattern[i + 1:end]
+            if "[" in body or "\\" in body:
+                # POSIX classes, or backslashes (literal in POSIX brackets).
+                return None
+            if body.startswith("^]"):
+                body = "^\\]" + body[2:]
+            elif body.startswith("]"):
+                body = "\\]" + body[1:]
+            out.append("[%s]" % body)
+            i = end + 1
+        elif c == "*":
+            out.append("\\*" if at_start else "*")
+            i += 1
+        elif c == "^":
+            out.append("^" if at_start else "\\^")
+            i += 1
+            continue
+        elif c == "$":
+            rest = pattern[i + 1:]
+            if not rest or rest.startswith("\\)") or rest.startswith("\\|"):
+                out.append("$")
+            else:
+                out.append("\\$")
+            i += 1
+        elif c == ".":
+            out.append(".")
+            i += 1
+        else:
+            out.append(re.escape(c))
+            i += 1
+        at_start = False
+    return "".join(out)
+
+
+def _parse_sed_replacement(replacement):
+    """Parse a sed replacement into a list of strings and group numbers."""
+    parts = []
+    literal = []
+    i = 0
+    while i < len(replacement):
+        c = replacement[i]
+        if c == "\\" and i + 1 < len(replacement):
+            n = replacement[i + 1]
+            i += 2
+            if n == "&":
+                literal.append("&")
+            elif n in "0123456789":
+                if literal:
+                    parts.append("".join(literal))
+                    literal = []
+                parts.append(int(n))
+            elif n == "n":
+                literal.append("\n")
+            elif n in "lLuUE":
+                # GNU case conversion.
+                return None
+            else:
+                literal.append(n)
+        elif c == "&":
+            if literal:
+                parts.append("".join(literal))
+                literal = []
+            parts.append(0)
+            i += 1
+        else:
+            literal.append(c)
+            i += 1
+    if literal:
+        parts.append("".join(literal))
+    return parts
+
+
+class SedMapper:
+    """Apply a sed s/// expression to many strings.
+
+    The common subset of sed substitutions is compiled once into a Python
+    regular expression; anything else is run through sed itself, once for
+    each string, since the expression may depend on line numbers or add
+    or delete lines.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self._regex = None
+        self._replacement = None
+        self._count = 1
+        bits = _split_sed_substitution(expression)
+        if bits is None:
+            return
+        pattern, replacement, flags = bits
+        re_flags = 0
+        for flag in flags:
+            if flag == "g":
+                self._count = 0
+            elif flag in "Ii":
+                re_flags |= re.IGNORECASE
+            else:
+                return
+        python_pattern = _bre_to_python(pattern)
+        parsed_replacement = _parse_sed_replacement(replacement)
+        if python_pattern is None or parsed_replacement is None:
+            return
+        try:
+            regex = re.compile(python_pattern, re_flags)
+        except re.error:
+            return
+        if [part for part in parsed_replacement
+            if not isinstance(part, str) and part > regex.groups]:
+            return
+        self._regex = regex
+        self._replacement = parsed_replacement
+
+    @property
+    def compiled(self):
+        """True if this expression can be applied without running sed."""
+        return self._regex is not None
+
+    def _expand(self, match):
+        return "".join(
+            part if isinstance(part, str) else (match.group(part) or "")
+            for part in self._replacement)
+
+    def _substitute_line(self, line):
+        return self._regex.sub(self._expand, line, count=self._count)
+
+    def __call__(self, text):
+        if not self.compiled:
+            return _run_sed(text, self.expression)
+        lines = text.split("\n")
+        return "\n".join(self._substitute_line(line) for line in lines)
+
+    def map(self, texts):
+        """Return a list of TEXTS each passed through this expression."""
+        return [self(text) for text in texts]
+
+
+def apply_sed(text, expression):
+    """Run TEXT through EXPRESSION as sed would."""
+    return SedMapper(expression)(text)
+
+
+def _update_hashes(entry_path, hash_objs):
+    with open(entry_path, "rb") as fh:
+        while True:
+            buf = fh.read(16 * 1024)
+            if not buf:
+                break
+            for hash_obj in hash_objs:
+                hash_obj.update(buf)
+
+
+def _checksum_worker(args):
+    """Compute the named digests of a file; runs in a worker process."""
+    entry_path, hash_names = args
+    hash_objs = [hashlib.new(hash_name) for hash_name in hash_names]
+    _update_hashes(entry_path, hash_objs)
+    return [hash_obj.hexdigest() for hash_obj in hash_objs]
+
+
+def checksum_jobs(config):
+    """Return the number of parallel checksumming processes to use."""
+    try:
+        return max(1, int(config["CDIMAGE_CHECKSUM_JOBS"]))
+    except ValueError:
+        return 1
+
+
+class ChecksumCache:
+    """A persistent cache of file digests.
+
+    Entries are keyed by device, inode, size and modification time, so a
+    file that has been hardlinked or renamed without being changed can be
+    checksummed without reading it again.  Each entry also remembers the
+    paths at which it was seen, which lets prune discard entries for files
+    that no longer exist.
+    """
+
+    def __init__(self, config, path=None):
+        self.config = config
+        if path is None:
+            path = os.path.join(config.root, "etc", ".checksum-cache")
+        self.path = path
+        self.entries = {}
+        self.changed = False
+
+    @staticmethod
+    def key(st):
+        mtime_ns = getattr(st, "st_mtime_ns", None)
+        if mtime_ns is None:
+            mtime_ns = int(st.st_mtime * 1000000000)
+        return st.st_dev, st.st_ino, st.st_size, mtime_ns
+
+    def _stat_key(self, path):
+        try:
+            return self.key(os.stat(path))
+        except OSError:
+            return None
+
+    def read(self):
+        self.entries = {}
+        self.changed = False
+        try:
+            cache = open(self.path)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        with cache:
+            for line in cache:
+                bits = line.rstrip("\n").split("\t")
+                if len(bits) < 3:
+                    continue
+                try:
+                    key = tuple(int(field) for field in bits[0].split())
+                    digests = dict(
+                        digest.split("=", 1) for digest in bits[1].split())
+                except ValueError:
+                    continue
+                if len(key) != 4:
+                    continue
+                self.entries[key] = (set(bits[2:]), digests)
+
+    def lookup(self, entry_path, hash_name):
+        """Return the cached HASH_NAME digest of ENTRY_PATH, or None."""
+        key = self._stat_key(entry_path)
+        if key not in self.entries:
+            return None
+        paths, digests = self.entries[key]
+        if hash_name not in digests:
+            return None
+        if entry_path not in paths:
+            paths.add(entry_path)
+            self.changed = True
+        return digests[hash_name]
+
+    def store(self, entry_path, hash_name, digest):
+        key = self._stat_key(entry_path)
+        if key is None:
+            return
+        paths, digests = self.entries.setdefault(key, (set(), {}))
+        paths.add(entry_path)
+        digests[hash_name] = digest
+        self.changed = True
+
+    def fill(self, checksum_file, entry_name):
+        """Fill in CHECKSUM_FILE's entry for ENTRY_NAME from the cache.
+
+        Returns True if the entry was cached.
+        """
+        digest = self.lookup(
+            os.path.join(checksum_file.directory, entry_name),
+            checksum_file.hash_name)
+        if digest is None:
+            return False
+        checksum_file.entries[entry_name] = digest
+        return True
+
+    def record(self, checksum_file, entry_name):
+        """Remember CHECKSUM_FILE's entry for ENTRY_NAME."""
+        self.store(
+            os.path.join(checksum_file.directory, entry_name),
+            checksum_file.hash_name, checksum_file.entries[entry_name])
+
+    def prune(self):
+        """Forget files that no longer exist or have been changed."""
+        for key, (paths, digests) in list(self.entries.items()):
+            live_paths = set(
+                path for path in paths if self._stat_key(path) == key)
+            if not live_paths:
+                del self.entries[key]
+                self.changed = True
+            elif live_paths != paths:
+                self.entries[key] = (live_paths, digests)
+                self.changed = True
+
+    def write(self):
+        if not self.changed:
+            return
+        # Several publishers may write the cache at once.  Each writes its
+        # own temporary file and renames it into place, so the cache may
+        # lose some recent entries but can never be corrupted.
+        fd, temp_path = tempfile.mkstemp(
+            prefix="%s." % os.path.basename(self.path),
+            dir=os.path.dirname(self.path))
+        try:
+            with os.fdopen(fd, "w") as cache:
+                for key in sorted(self.entries):
+                    paths, digests = self.entries[key]
+                    print("%s\t%s\t%s" % (
+                        " ".join(str(field) for field in key),
+                        " ".join(
+                            "%s=%s" % item
+                            for item in sorted(digests.items())),
+                        "\t".join(sorted(paths))), file=cache)
+            os.rename(temp_path, self.path)
+        except Exception:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+        self.changed = False
+
+    def __enter__(self):
+        self.read()
+        return self
+
+    def __exit__(self, exc_type, unused_exc_value, unused_exc_tb):
+        if exc_type is None:
+            self.write()
+
+
+def checksum_cache(config):
+    """Return the configured ChecksumCache, or None if caching is off."""
+    if config["CDIMAGE_CHECKSUM_CACHE"]:
+        return ChecksumCache(config)
+    else:
+        return None
+
+
 class ChecksumFile:
     """Manipulate a single checksum file."""
 
-    def __init__(self, config, directory, name, hash_method, sign=True):
+    def __init__(self, config, directory, name, hash_method, sign=True,
+                 cache=None):
         self.config = config
         self.directory = directory
         self.name = name
         self.path = os.path.join(directory, name)
         self.hash_method = hash_method
         self.sign = sign
+        self.cache = cache
         self.entries = {}
 
+    @property
+    def hash_name(self):
+        # Some versions of hashlib report upper-case names.
+        return self.hash_method().name.lower()
+
     def read(self):
         self.entries = {}
         if not os.path.exists(self.path):
@@ -78,44 +482,50 @@ class ChecksumFile:
             return hash_obj.hexdigest()
 
     def add(self, entry_name):
-        if entry_name not in self.entries:
-            entry_path = os.path.join(self.directory, entry_name)
-            self.entries[entry_name] = self.checksum(entry_path)
+        if entry_name in self.entries:
+            return
+        if self.cache is not None and self.cache.fill(self, entry_name):
+            return
+        self.entries[entry_name] = self.checksum(
+            os.path.join(self.directory, entry_name))
+        if self.cache is not None:
+            self.cache.record(self, entry_name)
 
     def remove(self, entry_name):
         self.entries.pop(entry_name, None)
 
-    def merge(self, directories, entry_name, possible_entry_names):
+    def merge(self, directories, entry_name, possible_entry_names,
+              index=None):
         if entry_name in self.entries:
             return
+        if index is None:
+            index = ChecksumFileIndex(self.config)
         try:
             entry_time = os.stat(
                 os.path.join(self.directory, entry_name)).st_mtime
         except OSError:
             entry_time = 0
         for directory in directories:
-            try:
-                dir_time = os.stat(os.path.join(directory, self.name)).st_mtime
-            except OSError:
+            old_checksums = index.get(directory, self.name)
+            if old_checksums is None:
                 continue
+            dir_time, old_entries = old_checksums
             if entry_time > dir_time:
                 continue
-            old_checksum_file = ChecksumFile(
-                self.config, directory, self.name, self.hash_method,
-                sign=self.sign)
-            old_checksum_file.read()
             for name in possible_entry_names:
-                if name in old_checksum_file.entries:
-                    self.entries[entry_name] = old_checksum_file.entries[name]
+                if name in old_entries:
+                    self.entries[entry_name] = old_entries[name]
                     return
 
-    def write(self):
+    def write(self, sign=None):
+        if sign is None:
+            sign = self.sign
         if self.entries:
             with AtomicFile(self.path) as checksums:
                 for entry_name in sorted(self.entries):
                     print("%s *%s" % (self.entries[entry_name], entry_name),
                           file=checksums)
-            if self.sign:
+            if sign:
                 sign_cdimage(self.config, self.path)
         else:
             try:
@@ -132,6 +542,29 @@ class ChecksumFile:
             self.write()
 
 
+class ChecksumFileIndex:
+    """Old checksum files, each read and parsed at most once."""
+
+    def __init__(self, config):
+        self.config = config
+        self.checksum_files = {}
+
+    def get(self, directory, name):
+        """Return (mtime, entries) for a checksum file, or None if missing."""
+        key = (directory, name)
+        if key not in self.checksum_files:
+            old_checksum_file = ChecksumFile(
+                self.config, directory, name, None, sign=False)
+            try:
+                mtime = os.stat(old_checksum_file.path).st_mtime
+            except OSError:
+                self.checksum_files[key] = None
+            else:
+                old_checksum_file.read()
+                self.checksum_files[key] = (mtime, old_checksum_file.entries)
+        return self.checksum_files[key]
+
+
 class ChecksumFileSet:
     """Manipulate the standard set of checksums files together."""
 
@@ -141,29 +574,115 @@ class ChecksumFileSet:
         "SHA256SUMS": hashlib.sha256,
         }
 
-    def __init__(self, config, directory, sign=True):
+    def __init__(self, config, directory, sign=True, cache=None):
         self.config = config
         self.directory = directory
         self.sign = sign
+        self.cache = cache
         self.checksum_files = [
-            ChecksumFile(config, directory, filename, hash_method, sign=sign)
+            ChecksumFile(
+                config, directory, filename, hash_method, sign=sign,
+                cache=cache)
             for filename, hash_method in self.checksum_file_methods.items()]
 
     def read(self):
         for checksum_file in self.checksum_files:
             checksum_file.read()
 
-    def add(self, entry_name):
+    def checksum(self, entry_path, checksum_files=None):
+        """Compute several checksums of ENTRY_PATH in a single pass.
+
+        Returns a dictionary mapping checksum file names to digests.
+        """
+        if checksum_files is None:
+            checksum_files = self.checksum_files
+        hash_objs = [
+            checksum_file.hash_method() for checksum_file in checksum_files]
+        _update_hashes(entry_path, hash_objs)
+        return dict(
+            (checksum_file.name, hash_obj.hexdigest())
+            for checksum_file, hash_obj in zip(checksum_files, hash_objs))
+
+    def missing(self, entry_name):
+        """Return the checksum files that need ENTRY_NAME to be read.
+
+        Entries are filled in from the cache where possible.
+        """
+        missing = []
         for checksum_file in self.checksum_files:
-            checksum_file.add(entry_name)
+            if entry_name in checksum_file.entries:
+                continue
+            if self.cache is not None and self.cache.fill(
+                    checksum_file, entry_name):
+                continue
+            missing.append(checksum_file)
+        return missing
+
+    def _store(self, entry_name, checksum_file, digest):
+        checksum_file.entries[entry_name] = digest
+        if self.cache is not None:
+            self.cache.record(checksum_file, entry_name)
+
+    def add(self, entry_name):
+        # Only read the file once, however many checksums are missing.
+        missing = self.missing(entry_name)
+        if not missing:
+            return
+        entry_path = os.path.join(self.directory, entry_name)
+        digests = self.checksum(entry_path, checksum_files=missing)
+        for checksum_file in missing:
+            self._store(entry_name, checksum_file, digests[checksum_file.name])
+
+    def add_parallel(self, entry_names, jobs):
+        """Add several entries, spreading the work over JOBS processes.
+
+        The results are identical to calling add on each entry in turn.
+        """
+        work = []
+        for entry_name in entry_names:
+            missing = self.missing(entry_name)
+            if missing:
+                work.append((entry_name, missing))
+        if len(work) < 2 or jobs < 2:
+            for entry_name, _ in work:
+                self.add(entry_name)
+            return
+        pool = multiprocessing.Pool(min(jobs, len(work)))
+        try:
+            results = pool.map(_checksum_worker, [
+                (os.path.join(self.directory, entry_name),
+                 [checksum_file.hash_name for checksum_file in missing])
+                for entry_name, missing in work], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for (entry_name, missing), digests in zip(work, results):
+            for checksum_file, digest in zip(missing, digests):
+                self._store(entry_name, checksum_file, digest)
 
     def remove(self, entry_name):
         for checksum_file in self.checksum_files:
             checksum_file.remove(entry_name)
 
-    def merge(self, directories, entry_name, possible_entry_names):
+    def merge(self, directories, entry_name, possible_entry_names,
+              index=None):
+        if index is None:
+            index = ChecksumFileIndex(self.config)
+        for checksum_file in self.checksum_files:
+            checksum_file.merge(
+                directories, entry_name, possible_entry_names, index=index)
+
+    def add_precomputed(self, entry_name, digests):
+        """Add checksums of ENTRY_NAME that have already been computed.
+
+        DIGESTS maps checksum file names to digests, as returned by
+        checksum_move.
+        """
         for checksum_file in self.checksum_files:
-            checksum_file.merge(directories, entry_name, possible_entry_names)
+            if (entry_name not in checksum_file.entries and
+                checksum_file.name in digests):
+                self._store(
+                    entry_name, checksum_file, digests[checksum_file.name])
 
     def want_image(self, image):
         """Return true if and only if we want to checksum this image."""
@@ -182,24 +701,41 @@ class ChecksumFileSet:
         else:
             return False
 
-    def merge_all(self, old_directories, map_expr=None):
+    def merge_all(self, old_directories, map_expr=None, jobs=None,
+                  precomputed=None):
+        if jobs is None:
+            jobs = checksum_jobs(self.config)
         images = sorted(
             name for name in os.listdir(self.directory)
             if self.want_image(name))
-        for image in images:
+        if precomputed:
+            for image in images:
+                if image in precomputed:
+                    self.add_precomputed(image, precomputed[image])
+        if map_expr:
+            mapped_images = SedMapper(map_expr).map(images)
+        else:
+            mapped_images = [None] * len(images)
+        index = ChecksumFileIndex(self.config)
+        for image, mapped_image in zip(images, mapped_images):
             image_names = [image]
-            if map_expr:
-                image_names.append(apply_sed(image, map_expr))
-            self.merge(old_directories, image, image_names)
-            self.add(image)
+            if mapped_image is not None:
+                image_names.append(mapped_image)
+            self.merge(old_directories, image, image_names, index=index)
+        self.add_parallel(images, jobs)
 
     def write(self):
         if self.sign and not can_sign(self.config):
             self.sign = False
             for checksum_file in self.checksum_files:
                 checksum_file.sign = False
+        # Sign everything together once it has all been written.
         for checksum_file in self.checksum_files:
-            checksum_file.write()
+            checksum_file.write(sign=False)
+        if self.sign:
+            sign_cdimage_batch(self.config, [
+                checksum_file.path for checksum_file in self.checksum_files
+                if checksum_file.sign and checksum_file.entries])
 
     def __enter__(self):
         self.read()
@@ -222,17 +758,221 @@ class MetalinkChecksumFileSet(ChecksumFileSet):
         return image.endswith(".metalink")
 
 
-def checksum_directory(config, directory, old_directories=None, map_expr=None):
+def _verify_worker(args):
+    """Checksum one file for verification; runs in a worker process.
+
+    Returns (pid, digests, size, elapsed time, error).  If the file cannot
+    be read, digests is None and error is None if it is missing or
+    otherwise describes the problem.
+    """
+    entry_path, hash_names = args
+    start = time.time()
+    try:
+        size = os.stat(entry_path).st_size
+        digests = _checksum_worker((entry_path, hash_names))
+    except (IOError, OSError) as e:
+        if e.errno == errno.ENOENT:
+            error = None
+        else:
+            error = e.strerror or str(e)
+        return os.getpid(), None, 0, time.time() - start, error
+    return os.getpid(), digests, size, time.time() - start, None
+
+
+class ChecksumVerifier:
+    """Check files against the checksum files in some directories.
+
+    Each listed file is read once, however many checksum files mention it.
+    """
+
+    checksum_file_methods = dict(ChecksumFileSet.checksum_file_methods)
+    checksum_file_methods.update(
+        MetalinkChecksumFileSet.checksum_file_methods)
+
+    def __init__(self, config, directories, jobs=None, recursive=False):
+        self.config = config
+        self.directories = directories
+        if jobs is None:
+            jobs = checksum_jobs(config)
+        self.jobs = jobs
+        self.recursive = recursive
+        self.verified = []
+        self.mismatched = []
+        self.missing = []
+        self.unreadable = []
+        self.worker_stats = {}
+
+    def _all_directories(self):
+        for directory in self.directories:
+            if self.recursive:
+                for dirpath, dirnames, _ in os.walk(directory):
+                    dirnames.sort()
+                    yield dirpath
+            else:
+                yield directory
+
+    def expected(self):
+        """Return a sorted list of (path, [(checksum file, digest), ...])."""
+        expected = {}
+        for directory in self._all_directories():
+            for name in sorted(self.checksum_file_methods):
+                checksum_file = ChecksumFile(
+                    self.config, directory, name,
+                    self.checksum_file_methods[name], sign=False)
+                checksum_file.read()
+                for entry_name, digest in checksum_file.entries.items():
+                    entry_path = os.path.join(directory, entry_name)
+                    expected.setdefault(entry_path, []).append(
+                        (checksum_file, digest))
+        return sorted(expected.items())
+
+    def verify(self):
+        """Check every file; return True if and only if all are correct."""
+        expected = self.expected()
+        work = [
+            (entry_path,
+             [checksum_file.hash_name for checksum_file, _ in checks])
+            for entry_path, checks in expected]
+        if self.jobs > 1 and len(work) > 1:
+            pool = multiprocessing.Pool(min(self.jobs, len(work)))
+            try:
+                results = pool.map(_verify_worker, work, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_verify_worker(item) for item in work]
+
+        self.verified = []
+        self.mismatched = []
+        self.missing = []
+        self.unreadable = []
+        self.worker_stats = {}
+        for (entry_path, checks), result in zip(expected, results):
+            pid, digests, size, elapsed, error = result
+            stats = self.worker_stats.setdefault(pid, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += size
+            stats[2] += elapsed
+            if error is not None:
+                self.unreadable.append((entry_path, error))
+                continue
+            elif digests is None:
+                self.missing.append(entry_path)
+                continue
+            for (checksum_file, digest), actual in zip(checks, digests):
+                if digest == actual:
+                    self.verified.append((entry_path, checksum_file.path))
+                else:
+                    self.mismatched.append((entry_path, checksum_file.path))
+        return not self.mismatched and not self.missing and not self.unreadable
+
+    def report(self, out=None, err=None):
+        if out is None:
+            out = sys.stdout
+        if err is None:
+            err = sys.stderr
+        for entry_path, checksum_path in self.mismatched:
+            print("%s: FAILED (%s)" % (entry_path, checksum_path), file=err)
+        for entry_path in self.missing:
+            print("%s: MISSING" % entry_path, file=err)
+        for entry_path, error in self.unreadable:
+            print("%s: UNREADABLE (%s)" % (entry_path, error), file=err)
+        for number, pid in enumerate(sorted(self.worker_stats), 1):
+            files, size, elapsed = self.worker_stats[pid]
+            megabytes = size / 1000000.0
+            if elapsed > 0:
+                rate = "%.1f MB/s" % (megabytes / elapsed)
+            else:
+                rate = "- MB/s"
+            print("Worker %d: %d files, %.1f MB in %.1fs (%s)" % (
+                number, files, megabytes, elapsed, rate), file=out)
+        print(
+            "%d checksums verified, %d mismatched, %d files missing, "
+            "%d unreadable" % (
+                len(self.verified), len(self.mismatched), len(self.missing),
+                len(self.unreadable)),
+            file=out)
+
+
+def verify_directories(config, directories, jobs=None, recursive=False):
+    """Verify and report on the checksum files in DIRECTORIES."""
+    verifier = ChecksumVerifier(
+        config, directories, jobs=jobs, recursive=recursive)
+    ret = verifier.verify()
+    verifier.report()
+    return ret
+
+
+def checksum_move(source, target, checksum_file_methods=None):
+    """Move SOURCE to TARGET, checksumming it if it has to be copied.
+
+    If SOURCE and TARGET are on the same filesystem, this is just a rename
+    and None is returned.  Otherwise, the data is checksummed while it is
+    copied, and a dictionary mapping checksum file names to digests is
+    returned.
+    """
+    try:
+        os.rename(source, target)
+        return None
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    if checksum_file_methods is None:
+        checksum_file_methods = ChecksumFileSet.checksum_file_methods
+    hash_objs = dict(
+        (name, hash_method())
+        for name, hash_method in checksum_file_methods.items())
+    # TARGET may be hardlinked to a previously-published image, so copy to
+    # a new file and rename it into place rather than overwriting it.
+    fd, temp_target = tempfile.mkstemp(
+        prefix=".%s." % os.path.basename(target),
+        dir=os.path.dirname(target))
+    try:
+        with open(source, "rb") as infile:
+            with os.fdopen(fd, "wb") as outfile:
+                while True:
+                    buf = infile.read(1024 * 1024)
+                    if not buf:
+                        break
+                    outfile.write(buf)
+                    for hash_obj in hash_objs.values():
+                        hash_obj.update(buf)
+        shutil.copystat(source, temp_target)
+        os.rename(temp_target, target)
+    except Exception:
+        try:
+            os.unlink(temp_target)
+        except OSError:
+            pass
+        raise
+    os.unlink(source)
+    return dict((name, hash_obj.hexdigest())
+                for name, hash_obj in hash_objs.items())
+
+
+def checksum_directory(config, directory, old_directories=None, map_expr=None,
+                       jobs=None, precomputed=None):
     if old_directories is None:
         old_directories = [directory]
 
+    cache = checksum_cache(config)
+    if cache is not None:
+        cache.read()
+
     # We don't want to read the existing checksum files directly, as they
     # may contain stale checksums; so we don't use the context manager form
     # here.
-    checksum_files = ChecksumFileSet(config, directory)
-    checksum_files.merge_all(old_directories, map_expr=map_expr)
+    checksum_files = ChecksumFileSet(config, directory, cache=cache)
+    checksum_files.merge_all(
+        old_directories, map_expr=map_expr, jobs=jobs,
+        precomputed=precomputed)
     checksum_files.write()
 
+    if cache is not None:
+        cache.write()
+
+
 def metalink_checksum_directory(config, directory, old_directories=None):
     if old_directories is None:
         old_directories = [directory]
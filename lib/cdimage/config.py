@@ -17,15 +17,24 @@
 
 Most of this is a transitional measure to permit shell and Python programs
 to co-exist until such time as the whole of cdimage is rewritten.
+
+Sourcing etc/config means running a shell, so it is only done when a
+value is first needed, and the result is cached in etc/.config-cache keyed
+on the files that etc/config reads and on the environment.
 """
 
 __metaclass__ = type
 
 from collections import defaultdict, namedtuple
+import errno
+import hashlib
 import operator
 import os
 import re
 import subprocess
+import tempfile
+import threading
+import time
 
 
 class UnknownSeries(Exception):
@@ -34,26 +43,58 @@ class UnknownSeries(Exception):
 
 BaseSeries = namedtuple("BaseSeries", ["name", "version", "displayname"])
 all_series = []
+_series_by_name = {}
+_series_by_version = {}
+
+# The list of series shipped with cdimage.
+_series_path = os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, "etc", "series")
 
 
 class Series(BaseSeries):
     def __init__(self, *args, **kwargs):
         self._index = None
 
+    @classmethod
+    def register(self, series_list):
+        """Replace the known series with SERIES_LIST, oldest first."""
+        all_series[:] = series_list
+        _series_by_name.clear()
+        _series_by_version.clear()
+        for index, series in enumerate(all_series):
+            series._index = index
+            _series_by_name[series.name] = series
+            _series_by_version[series.version] = series
+
+    @classmethod
+    def read(self, path):
+        """Read a list of series from a data file.
+
+        Each non-comment line has a name, a version, and a display name,
+        separated by whitespace; series are listed oldest first.
+        """
+        series_list = []
+        with open(path) as series_file:
+            for line in series_file:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                name, version, displayname = line.split(None, 2)
+                series_list.append(Series(name, version, displayname))
+        return series_list
+
     @classmethod
     def find_by_name(self, name):
-        for series in all_series:
-            if series.name == name:
-                return series
-        else:
+        try:
+            return _series_by_name[name]
+        except KeyError:
             raise ValueError("No series named %s" % name)
 
     @classmethod
     def find_by_version(self, version):
-        for series in all_series:
-            if series.version == version:
-                return series
-        else:
+        try:
+            return _series_by_version[version]
+        except KeyError:
             raise ValueError("No series with version %s" % version)
 
     @classmethod
@@ -66,17 +107,21 @@ class Series(BaseSeries):
     @property
     def index(self):
         if self._index is None:
-            self._index = [
-                series.name for series in all_series].index(self.name)
+            # Not registered; use the ordering of the registered series of
+            # the same name.
+            self._index = self.find_by_name(self.name).index
         return self._index
 
     @property
     def is_latest(self):
-        return self == all_series[-1]
+        return self.index == len(all_series) - 1
 
     def _compare(self, other, method):
         if not isinstance(other, Series):
-            other = self.find_by_name(other)
+            try:
+                other = _series_by_name[other]
+            except KeyError:
+                raise ValueError("No series named %s" % other)
         return method(self.index, other.index)
 
     def __lt__(self, other):
@@ -97,28 +142,11 @@ class Series(BaseSeries):
     def __gt__(self, other):
         return self._compare(other, operator.gt)
 
+    def __hash__(self):
+        return hash(self.name)
+
 
-# TODO: This should probably come from a configuration file.
-all_series.extend([
-    Series("warty", "4.10", "Warty Warthog"),
-    Series("hoary", "5.04", "Hoary Hedgehog"),
-    Series("breezy", "5.10", "Breezy Badger"),
-    Series("dapper", "6.06", "Dapper Drake"),
-    Series("edgy", "6.10", "Edgy Eft"),
-    Series("feisty", "7.04", "Feisty Fawn"),
-    Series("gutsy", "7.10", "Gutsy Gibbon"),
-    Series("hardy", "8.04", "Hardy Heron"),
-    Series("intrepid", "8.10", "Intrepid Ibex"),
-    Series("jaunty", "9.04", "Jaunty Jackalope"),
-    Series("karmic", "9.10", "Karmic Koala"),
-    Series("lucid", "10.04", "Lucid Lynx"),
-    Series("maverick", "10.10", "Maverick Meerkat"),
-    Series("natty", "11.04", "Natty Narwhal"),
-    Series("oneiric", "11.10", "Oneiric Ocelot"),
-    Series("precise", "12.04", "Precise Pangolin"),
-    Series("quantal", "12.10", "Quantal Quetzal"),
-    Series("raring", "13.04", "Raring Ringtail"),
-    ])
+Series.register(Series.read(_series_path))
 
 
 _whitelisted_keys = (
@@ -147,23 +175,57 @@ _whitelisted_keys = (
     )
 
 
+# Files (relative to CDIMAGE_ROOT) whose contents may affect the result of
+# sourcing etc/config.
+_snapshot_inputs = (
+    ("etc", "config"),
+    ("etc", "default-arches"),
+    ("bin", "default-arches"),
+    ("bin", "functions.sh"),
+    )
+
+# Environment variables other than those kept by Config that etc/config
+# reads; it derives GNUPG_DIR from HOME.
+_snapshot_environment = ("HOME",)
+
+# Snapshots not written for this many seconds are removed.
+_snapshot_max_age = 24 * 60 * 60
+
+
+def _to_bytes(text):
+    if isinstance(text, bytes):
+        return text
+    else:
+        return text.encode("UTF-8", "surrogateescape")
+
+
 class Config(defaultdict):
     def __init__(self, read=True):
         super(Config, self).__init__(str)
         if "CDIMAGE_ROOT" not in os.environ:
             os.environ["CDIMAGE_ROOT"] = "/srv/cdimage.ubuntu.com"
         self.root = os.environ["CDIMAGE_ROOT"]
-        config_path = os.path.join(self.root, "etc", "config")
-        if read:
+        self._load_lock = threading.Lock()
+        # Reading is deferred until a value is first needed.
+        self._pending_read = read
+
+    def _load(self):
+        with self._load_lock:
+            if not self._pending_read:
+                return
+            config_path = os.path.join(self.root, "etc", "config")
             if os.path.exists(config_path):
-                self.read(config_path)
+                self._read_snapshot(config_path)
             else:
                 self.read()
+            self._pending_read = False
 
-    def _read_nullsep_output(self, command):
-        raw = subprocess.Popen(
+    def _run_nullsep(self, command):
+        return subprocess.Popen(
             command, stdout=subprocess.PIPE,
             universal_newlines=True).communicate()[0]
+
+    def _parse_nullsep(self, raw):
         out = {}
         for line in raw.split("\0"):
             try:
@@ -173,27 +235,120 @@ class Config(defaultdict):
                 continue
         return out
 
+    def _read_nullsep_output(self, command):
+        return self._parse_nullsep(self._run_nullsep(command))
+
     def _shell_escape(self, arg):
         if re.match(r"^[a-zA-Z0-9+,./:=@_-]+$", arg):
             return arg
         else:
             return "'%s'" % arg.replace("'", "'\\''")
 
-    def read(self, config_path=None):
+    def _read_command(self, config_path=None):
         commands = []
         if config_path is not None:
             commands.append(". %s" % self._shell_escape(config_path))
         commands.append("cat /proc/self/environ")
         for key in _whitelisted_keys:
             commands.append("printf '%%s\\0' \"%s=$%s\"" % (key, key))
-        env = self._read_nullsep_output(["sh", "-c", "; ".join(commands)])
-        for key, value in env.items():
-            if key.startswith("CDIMAGE_") or key in _whitelisted_keys:
-                self[key] = value
+        return ["sh", "-c", "; ".join(commands)]
+
+    def _wanted(self, key):
+        return key.startswith("CDIMAGE_") or key in _whitelisted_keys
+
+    def _update_from_raw(self, raw):
+        # This runs while loading, so it must not use the lazy methods.
+        for key, value in self._parse_nullsep(raw).items():
+            if self._wanted(key):
+                defaultdict.__setitem__(self, key, value)
 
         # Special entries.
-        if self["DIST"]:
-            self["DIST"] = Series.find_by_name(self["DIST"])
+        dist = defaultdict.__getitem__(self, "DIST")
+        if dist and not isinstance(dist, Series):
+            defaultdict.__setitem__(self, "DIST", Series.find_by_name(dist))
+
+    def read(self, config_path=None):
+        self._update_from_raw(
+            self._run_nullsep(self._read_command(config_path)))
+
+    @property
+    def snapshot_dir(self):
+        return os.path.join(self.root, "etc", ".config-cache")
+
+    def _snapshot_key(self, config_path):
+        key = hashlib.sha256()
+        paths = [config_path] + [
+            os.path.join(self.root, *names) for names in _snapshot_inputs[1:]]
+        for path in paths:
+            try:
+                st = os.stat(path)
+                with open(path, "rb") as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+            except (IOError, OSError):
+                key.update(_to_bytes("%s\0-\0" % path))
+                continue
+            key.update(_to_bytes("%s\0%r\0%s\0" % (
+                path, st.st_mtime, digest)))
+        for name, value in sorted(os.environ.items()):
+            if self._wanted(name) or name in _snapshot_environment:
+                key.update(_to_bytes(name) + b"=" + _to_bytes(value) + b"\0")
+        return key.hexdigest()
+
+    def _write_snapshot(self, path, raw):
+        # Caching is only an optimisation, so give up quietly if the
+        # snapshot cannot be written.  Each writer renames its own
+        # temporary file into place, so concurrent writers are safe.
+        try:
+            try:
+                os.makedirs(self.snapshot_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            now = time.time()
+            for name in os.listdir(self.snapshot_dir):
+                old_path = os.path.join(self.snapshot_dir, name)
+                try:
+                    if os.stat(old_path).st_mtime < now - _snapshot_max_age:
+                        os.unlink(old_path)
+                except OSError:
+                    pass
+            fd, temp_path = tempfile.mkstemp(
+                prefix=".%s." % os.path.basename(path),
+                dir=self.snapshot_dir)
+            try:
+                with os.fdopen(fd, "w") as snapshot:
+                    snapshot.write(raw)
+                os.rename(temp_path, path)
+            except Exception:
+                os.unlink(temp_path)
+                raise
+        except (IOError, OSError):
+            pass
+
+    def _read_snapshot(self, config_path):
+        """Read CONFIG_PATH, using a cached snapshot of the result if any."""
+        path = os.path.join(
+            self.snapshot_dir, self._snapshot_key(config_path))
+        try:
+            with open(path) as snapshot:
+                raw = snapshot.read()
+        except IOError:
+            # Only keep what _update_from_raw uses; the rest of the
+            # environment may hold credentials.
+            values = self._read_nullsep_output(
+                self._read_command(config_path))
+            raw = "".join(
+                "%s=%s\0" % (key, value)
+                for key, value in sorted(values.items())
+                if self._wanted(key))
+            self._write_snapshot(path, raw)
+        else:
+            # Keep snapshots in use from expiring.
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        self._update_from_raw(raw)
 
     @property
     def series(self):
@@ -204,4 +359,28 @@ class Config(defaultdict):
         return self["ARCHES"].split()
 
 
+def _loads_first(name):
+    method = getattr(defaultdict, name)
+
+    def wrapper(self, *args, **kwargs):
+        if self._pending_read:
+            self._load()
+        return method(self, *args, **kwargs)
+
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+for _name in (
+    "__contains__", "__delitem__", "__getitem__", "__iter__", "__len__",
+    "__repr__", "__setitem__", "clear", "get", "has_key", "items",
+    "iteritems", "iterkeys", "itervalues", "keys", "pop", "popitem",
+    "setdefault", "update", "values",
+    ):
+    if hasattr(defaultdict, _name):
+        setattr(Config, _name, _loads_first(_name))
+del _name
+
+
 config = Config()
@@ -0,0 +1,693 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Download live filesystems.
+
+Items are fetched concurrently, but each host only gets a limited number
+of connections, which are kept alive between requests.  Interrupted
+transfers are resumed using Range requests rather than started again.
+"""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+from multiprocessing.pool import ThreadPool
+import os
+import socket
+import tempfile
+import threading
+import time
+
+try:
+    from http import client as httplib
+    from urllib.parse import urljoin, urlsplit
+    from urllib.request import getproxies, proxy_bypass
+except ImportError:
+    import httplib
+    from urllib import getproxies, proxy_bypass
+    from urlparse import urljoin, urlsplit
+
+from cdimage.checksums import ChecksumCache
+from cdimage.livefs import live_fetch_plan
+from cdimage.log import logger
+from cdimage import osextras
+from cdimage.osextras import format_size
+
+
+# Read this much of a response at a time.
+_CHUNK_SIZE = 1024 * 1024
+
+_redirect_statuses = (301, 302, 303, 307)
+
+# Response headers that callers care about.
+_response_headers = ("Location", "ETag", "Last-Modified")
+
+# Request headers used to revalidate cached items with each validator.
+_conditional_headers = (
+    ("ETag", "If-None-Match"),
+    ("Last-Modified", "If-Modified-Since"),
+    )
+
+
+class DownloadError(Exception):
+    pass
+
+
+class _Interrupted(Exception):
+    """A transfer stopped before the whole response had been received."""
+
+    def __init__(self, message, headers):
+        super(_Interrupted, self).__init__(message)
+        self.headers = headers
+
+
+def download_jobs(config):
+    """Return the number of live filesystem items to download at once."""
+    try:
+        return max(1, int(config["CDIMAGE_DOWNLOAD_JOBS"]))
+    except ValueError:
+        return 1
+
+
+def download_connections(config):
+    """Return the number of connections to make to each host at once."""
+    try:
+        return max(1, int(config["CDIMAGE_DOWNLOAD_CONNECTIONS"]))
+    except ValueError:
+        return 2
+
+
+def parse_size(size):
+    """Parse a number of bytes, optionally with a K, M, G, or T suffix."""
+    size = size.strip()
+    multiplier = 1
+    for suffix in "KMGT":
+        multiplier *= 1024
+        if size.upper().endswith(suffix):
+            return int(size[:-1]) * multiplier
+    return int(size)
+
+
+class LiveCache:
+    """A cache of downloaded live filesystem items, keyed by URL.
+
+    Each item is stored in DIRECTORY as a file named after a hash of its
+    URL, alongside a ".meta" file recording the URL, the ETag and
+    Last-Modified validators sent by the server, and the stat key of the
+    cached file (so that a cached file that has been changed in place
+    through one of its hardlinks is not used again).  The modification
+    time of the ".meta" file records when the item was last used, and the
+    least recently used items are evicted to keep the cache within BUDGET
+    bytes.
+
+    Temporary files and cached files without metadata, left behind by
+    stores that were interrupted, are removed once they are STALE_AGE
+    seconds old; until then they count against the budget.
+    """
+
+    def __init__(self, directory, budget, stale_age=60 * 60):
+        self.directory = directory
+        self.budget = budget
+        self.stale_age = stale_age
+        self._lock = threading.Lock()
+
+    def _path(self, url):
+        return os.path.join(
+            self.directory, hashlib.sha256(url.encode("UTF-8")).hexdigest())
+
+    @contextmanager
+    def lock(self, url):
+        """Hold a lock on URL's entry, shared with other processes.
+
+        Builds of several image types for the same series usually want
+        the same items at about the same time; whichever gets there first
+        downloads each item and the rest then find it in the cache.
+        """
+        osextras.ensuredir(self.directory)
+        lock_path = "%s.lock" % self._path(url)
+        while True:
+            lock_file = open(lock_path, "a")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # evict may have removed the lock file while we were
+                # waiting for it, in which case lock the new one instead.
+                held = os.fstat(lock_file.fileno())
+                try:
+                    current = os.stat(lock_path)
+                except OSError:
+                    current = None
+            except Exception:
+                lock_file.close()
+                raise
+            if (current is not None and
+                (held.st_dev, held.st_ino) ==
+                    (current.st_dev, current.st_ino)):
+                break
+            lock_file.close()
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _read_meta(self, url):
+        meta = {}
+        try:
+            with open("%s.meta" % self._path(url)) as meta_file:
+                for line in meta_file:
+                    bits = line.rstrip("\n").split(" ", 1)
+                    if len(bits) == 2:
+                        meta[bits[0]] = bits[1]
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            st = os.stat(self._path(url))
+        except OSError:
+            return None
+        key = " ".join(str(field) for field in ChecksumCache.key(st))
+        if meta.get("url") != url or meta.get("key") != key:
+            return None
+        return meta
+
+    def lookup(self, url):
+        """Return the validators for the cached copy of URL, or None."""
+        meta = self._read_meta(url)
+        if meta is None:
+            return None
+        validators = dict(
+            (name, meta[name]) for name, _ in _conditional_headers
+            if name in meta)
+        return validators or None
+
+    def link(self, url, path):
+        """Hardlink the cached copy of URL to PATH, if it is still there."""
+        if self._read_meta(url) is None:
+            return False
+        try:
+            os.link(self._path(url), path)
+        except OSError:
+            return False
+        try:
+            os.utime("%s.meta" % self._path(url), None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, url, path, validators):
+        """Remember that PATH is the current contents of URL."""
+        if not validators:
+            # Without validators we could never use it again.
+            return
+        osextras.ensuredir(self.directory)
+        cache_path = self._path(url)
+        try:
+            temp_path = "%s.new.%d" % (cache_path, os.getpid())
+            osextras.unlink_force(temp_path)
+            os.link(path, temp_path)
+            os.rename(temp_path, cache_path)
+        except OSError as e:
+            logger.warning("Cannot cache %s: %s" % (url, e))
+            return
+        lines = [
+            "url %s" % url,
+            "key %s" % " ".join(
+                str(field) for field in ChecksumCache.key(os.stat(path))),
+            ]
+        for name, _ in _conditional_headers:
+            if name in validators:
+                lines.append("%s %s" % (name, validators[name]))
+        fd, temp_path = tempfile.mkstemp(
+            prefix="%s.meta." % os.path.basename(cache_path),
+            dir=self.directory)
+        try:
+            with os.fdopen(fd, "w") as meta_file:
+                for line in lines:
+                    print(line, file=meta_file)
+            os.rename(temp_path, "%s.meta" % cache_path)
+        except Exception:
+            osextras.unlink_force(temp_path)
+            raise
+        self.evict()
+
+    def _leftover_size(self, path, now):
+        """Remove PATH if it is stale; otherwise return its size."""
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return 0
+        if now - st.st_ctime >= self.stale_age:
+            osextras.unlink_force(path)
+            return 0
+        return st.st_size
+
+    def _remove_lock(self, cache_path):
+        """Remove an unused lock file for an entry that has gone."""
+        lock_path = "%s.lock" % cache_path
+        try:
+            lock_file = open(lock_path, "a")
+        except IOError:
+            return
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                # Someone is using it.
+                return
+            if (not os.path.exists(cache_path) and
+                not os.path.exists("%s.meta" % cache_path)):
+                osextras.unlink_force(lock_path)
+
+    def evict(self):
+        """Remove the least recently used items until within budget.
+
+        This also cleans up leftovers from interrupted stores, and lock
+        files for items that are no longer cached.
+        """
+        with self._lock:
+            now = time.time()
+            groups = {}
+            for name in osextras.listdir_force(self.directory):
+                base, _, suffix = name.partition(".")
+                groups.setdefault(base, set()).add(suffix)
+            entries = []
+            total = 0
+            for base, suffixes in groups.items():
+                cache_path = os.path.join(self.directory, base)
+                for suffix in suffixes:
+                    if suffix.startswith("new.") or suffix.startswith("meta."):
+                        total += self._leftover_size(
+                            "%s.%s" % (cache_path, suffix), now)
+                if "meta" in suffixes:
+                    try:
+                        used = os.stat("%s.meta" % cache_path).st_mtime
+                    except OSError:
+                        # Another process evicted it.
+                        continue
+                    try:
+                        size = os.stat(cache_path).st_size
+                    except OSError:
+                        size = None
+                    entries.append((used, size, cache_path))
+                elif "" in suffixes:
+                    total += self._leftover_size(cache_path, now)
+            for used, size, cache_path in sorted(entries, reverse=True):
+                if size is not None:
+                    total += size
+                    if total <= self.budget:
+                        continue
+                osextras.unlink_force(cache_path)
+                osextras.unlink_force("%s.meta" % cache_path)
+            for base, suffixes in groups.items():
+                cache_path = os.path.join(self.directory, base)
+                if ("lock" in suffixes and
+                    not os.path.exists(cache_path) and
+                    not os.path.exists("%s.meta" % cache_path)):
+                    self._remove_lock(cache_path)
+
+
+def live_cache(config):
+    """Return the configured LiveCache, or None if caching is off."""
+    try:
+        budget = parse_size(config["CDIMAGE_LIVE_CACHE"])
+    except ValueError:
+        return None
+    if budget <= 0:
+        return None
+    return LiveCache(
+        os.path.join(config.root, "scratch", ".live-cache"), budget)
+
+
+def find_proxy(scheme, netloc):
+    """Return the proxy to use for SCHEME://NETLOC, or None.
+
+    This honours $http_proxy, $https_proxy, and $no_proxy, as wget does.
+    """
+    proxy = getproxies().get(scheme)
+    if not proxy or proxy_bypass(netloc):
+        return None
+    if "://" not in proxy:
+        proxy = "http://%s" % proxy
+    return urlsplit(proxy).netloc
+
+
+class HostConnections:
+    """A limited pool of persistent connections to a single host.
+
+    If PROXY is given, connections go through it: plain HTTP requests are
+    sent to it with absolute URLs, and HTTPS is tunnelled with CONNECT.
+    """
+
+    def __init__(self, scheme, netloc, limit, timeout=None, proxy=None):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.timeout = timeout
+        self.proxy = proxy
+        self._slots = threading.Semaphore(limit)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.connections = 0
+        self.bytes = 0
+        self._active = 0
+        self._busy_since = None
+        self.busy_time = 0.0
+
+    def _connect(self):
+        if self.scheme == "https":
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        address = self.netloc if self.proxy is None else self.proxy
+        if self.timeout is None:
+            connection = connection_class(address)
+        else:
+            connection = connection_class(address, timeout=self.timeout)
+        if self.proxy is not None and self.scheme == "https":
+            connection.set_tunnel(self.netloc)
+        with self._lock:
+            self.connections += 1
+        return connection
+
+    def acquire(self):
+        self._slots.acquire()
+        with self._lock:
+            self._active += 1
+            if self._active == 1:
+                self._busy_since = time.time()
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def release(self, connection, reusable):
+        with self._lock:
+            if reusable:
+                self._idle.append(connection)
+            self._active -= 1
+            if self._active == 0:
+                self.busy_time += time.time() - self._busy_since
+        if not reusable:
+            connection.close()
+        self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def _record(self, nbytes):
+        with self._lock:
+            self.bytes += nbytes
+
+    def get(self, request_path, partial, offset, headers=None):
+        """Request REQUEST_PATH, writing the body to PARTIAL.
+
+        If OFFSET is non-zero, ask for the rest of the file from there
+        onwards and append it to PARTIAL.  HEADERS are extra request
+        headers.  Returns the HTTP status and a dictionary of the response
+        headers named in _response_headers.
+        """
+        connection = self.acquire()
+        reusable = False
+        try:
+            headers = dict(headers or {})
+            if offset:
+                headers["Range"] = "bytes=%d-" % offset
+            if self.proxy is not None and self.scheme == "http":
+                request_path = "http://%s%s" % (self.netloc, request_path)
+            connection.request("GET", request_path, headers=headers)
+            response = connection.getresponse()
+            response_headers = {}
+            for name in _response_headers:
+                value = response.getheader(name)
+                if value is not None:
+                    response_headers[name] = value
+            if response.status in _redirect_statuses or response.status == 304:
+                response.read()
+                reusable = not response.will_close
+                return response.status, response_headers
+            if response.status == 206 and offset:
+                content_range = response.getheader("Content-Range", "")
+                if not content_range.startswith("bytes %d-" % offset):
+                    response.read()
+                    raise DownloadError(
+                        "%s: unexpected Content-Range %r" %
+                        (request_path, content_range))
+                mode = "ab"
+            elif response.status == 200:
+                mode = "wb"
+            else:
+                response.read()
+                reusable = not response.will_close
+                raise DownloadError(
+                    "%s: HTTP %d %s" %
+                    (request_path, response.status, response.reason))
+            expected = response.getheader("Content-Length")
+            received = 0
+            with open(partial, mode) as out:
+                while True:
+                    try:
+                        buf = response.read(_CHUNK_SIZE)
+                    except (socket.error, httplib.HTTPException) as e:
+                        raise _Interrupted(str(e), response_headers)
+                    if not buf:
+                        break
+                    out.write(buf)
+                    received += len(buf)
+                    self._record(len(buf))
+            if expected is not None and received < int(expected):
+                raise _Interrupted(
+                    "%s: got %d of %s bytes" %
+                    (request_path, received, expected), response_headers)
+            reusable = not response.will_close
+            return response.status, response_headers
+        finally:
+            self.release(connection, reusable)
+
+
+class Downloader:
+    """Fetch URLs, sharing connections to each host between threads.
+
+    After an error, wait RETRY_DELAY seconds before trying again, doubling
+    the wait each time up to MAX_RETRY_DELAY.
+    """
+
+    def __init__(self, connections_per_host=2, retries=5, timeout=300,
+                 max_redirects=5, cache=None, retry_delay=1,
+                 max_retry_delay=30):
+        self.connections_per_host = connections_per_host
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.cache = cache
+        self._lock = threading.Lock()
+        self.hosts = {}
+
+    def _host(self, scheme, netloc):
+        with self._lock:
+            if (scheme, netloc) not in self.hosts:
+                self.hosts[(scheme, netloc)] = HostConnections(
+                    scheme, netloc, self.connections_per_host,
+                    timeout=self.timeout, proxy=find_proxy(scheme, netloc))
+            return self.hosts[(scheme, netloc)]
+
+    def fetch(self, url, path):
+        """Fetch URL to PATH, raising DownloadError on failure.
+
+        As with the fetch shell function, local paths are hardlinked.  If
+        there is a cache and it has a copy of URL that the server says is
+        still current, that is hardlinked instead.
+        """
+        if url.startswith("/"):
+            try:
+                os.link(url, path)
+            except OSError as e:
+                raise DownloadError("%s: %s" % (url, e))
+            return
+
+        if self.cache is None:
+            self._fetch(url, path)
+            return
+
+        with self.cache.lock(url):
+            validators = self._fetch(
+                url, path, validators=self.cache.lookup(url))
+            if validators is None:
+                if self.cache.link(url, path):
+                    logger.info("Using cached copy of %s" % url)
+                    return
+                # It went away in the meantime.
+                validators = self._fetch(url, path)
+            self.cache.store(url, path, validators)
+
+    def _fetch(self, url, path, validators=None):
+        """Fetch URL to PATH.
+
+        If VALIDATORS (a dictionary of ETag and Last-Modified values) is
+        given, make the request conditional, and return None without
+        creating PATH if the server says that URL has not been modified.
+        Otherwise, return the validators that the server sent.
+        """
+        partial = "%s.part" % path
+        osextras.unlink_force(partial)
+        headers = {}
+        if validators:
+            for name, header in _conditional_headers:
+                if name in validators:
+                    headers[header] = validators[name]
+        interruptions = 0
+        redirects = 0
+        try:
+            while True:
+                scheme, netloc, urlpath, query, _ = urlsplit(url)
+                if scheme not in ("http", "https"):
+                    raise DownloadError("%s: unsupported URL" % url)
+                request_path = urlpath or "/"
+                if query:
+                    request_path += "?%s" % query
+                host = self._host(scheme, netloc)
+                if os.path.exists(partial):
+                    offset = os.stat(partial).st_size
+                else:
+                    offset = 0
+                try:
+                    status, response_headers = host.get(
+                        request_path, partial, offset, headers=headers)
+                except (_Interrupted, socket.error,
+                        httplib.HTTPException) as e:
+                    interruptions += 1
+                    if interruptions > self.retries:
+                        raise DownloadError("%s: %s" % (url, e))
+                    logger.info("Resuming %s after error: %s" % (url, e))
+                    time.sleep(min(
+                        self.retry_delay * 2 ** (interruptions - 1),
+                        self.max_retry_delay))
+                    if isinstance(e, _Interrupted):
+                        # We have part of the body now, so only ask for
+                        # the rest if it is still the same file.
+                        validator = e.headers.get(
+                            "ETag", e.headers.get("Last-Modified"))
+                        if validator is not None:
+                            headers = {"If-Range": validator}
+                        else:
+                            headers = {}
+                    continue
+                if status in _redirect_statuses:
+                    redirects += 1
+                    location = response_headers.get("Location")
+                    if location is None or redirects > self.max_redirects:
+                        raise DownloadError("%s: bad redirect" % url)
+                    url = urljoin(url, location)
+                    osextras.unlink_force(partial)
+                    continue
+                if status == 304:
+                    if not validators:
+                        raise DownloadError(
+                            "%s: unexpected HTTP 304" % url)
+                    osextras.unlink_force(partial)
+                    return None
+                break
+            os.rename(partial, path)
+            return dict(
+                (name, response_headers[name])
+                for name, _ in _conditional_headers
+                if name in response_headers)
+        except Exception:
+            osextras.unlink_force(partial)
+            raise
+
+    def fetch_alternatives(self, alternatives, directory):
+        """Fetch the first available of several (URL, name) pairs.
+
+        Returns the name that was fetched into DIRECTORY, or None.
+        """
+        for url, name in alternatives:
+            try:
+                self.fetch(url, os.path.join(directory, name))
+                return name
+            except DownloadError as e:
+                logger.info("Failed to fetch %s" % e)
+        return None
+
+    def close(self):
+        for host in self.hosts.values():
+            host.close()
+
+    def log_throughput(self):
+        for (scheme, netloc), host in sorted(self.hosts.items()):
+            if host.busy_time > 0:
+                rate = "%s/s" % format_size(host.bytes / host.busy_time)
+            else:
+                rate = "-"
+            logger.info(
+                "%s: %s in %.1f seconds (%s) over %d connection%s" % (
+                    netloc, format_size(host.bytes), host.busy_time, rate,
+                    host.connections,
+                    "" if host.connections == 1 else "s"))
+
+
+def download_live_filesystems(config, live_out, jobs=None, downloader=None):
+    """Fetch the live filesystem items for this build into LIVE_OUT.
+
+    Filesystem images and other required items for all architectures are
+    fetched first; the optional extras for each architecture are only
+    fetched if an image for it was found.
+    """
+    plan = live_fetch_plan(config)
+    if jobs is None:
+        jobs = download_jobs(config)
+    jobs = max(1, jobs)
+    if downloader is None:
+        downloader = Downloader(
+            connections_per_host=download_connections(config),
+            cache=live_cache(config))
+
+    def fetch(live_fetch):
+        return downloader.fetch_alternatives(
+            live_fetch.alternatives, live_out)
+
+    first = [item for item in plan if item.policy != "optional"]
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(fetch, first, chunksize=1)
+        got_image = set()
+        for live_fetch, result in zip(first, results):
+            if result is not None:
+                if live_fetch.policy == "primary":
+                    got_image.add(live_fetch.arch)
+            elif live_fetch.policy == "required":
+                raise DownloadError(
+                    "Failed to fetch required live filesystem item for %s." %
+                    live_fetch.arch)
+        if config["CDIMAGE_LIVE"] and not got_image:
+            raise DownloadError("No filesystem images found.")
+        rest = [
+            item for item in plan
+            if item.policy == "optional" and item.arch in got_image]
+        if rest:
+            pool.map(fetch, rest, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        downloader.close()
+        downloader.log_throughput()
@@ -17,7 +17,9 @@
 
 __metaclass__ = type
 
-from cdimage.config import Series
+from collections import namedtuple
+
+from cdimage.config import Config, Series
 
 
 class UnknownArchitecture(Exception):
@@ -327,3 +329,146 @@ def live_item_paths(config, arch, item):
             raise NoLiveItem
     else:
         raise UnknownLiveItem("Unknown live filesystem item '%s'" % item)
+
+
+# A file to fetch for the live filesystem.  ALTERNATIVES is a list of (url,
+# destination) pairs, tried in order until one succeeds; destinations are
+# relative to the live output directory.  POLICY says what happens if none
+# of them succeed: for "primary", skip the remaining "optional" fetches
+# for ARCH; for "optional", nothing; for "required", give up.
+LiveFetch = namedtuple("LiveFetch", ["arch", "policy", "alternatives"])
+
+
+def _live_item_paths_or_none(config, arch, item):
+    try:
+        return list(live_item_paths(config, arch, item))
+    except (NoLiveItem, UnknownArchitecture):
+        return []
+
+
+def _live_fetch_plan_arch(config, arch):
+    project = config["PROJECT"]
+    series = config["DIST"]
+
+    def fetch(policy, items):
+        alternatives = []
+        for item, destination in items:
+            for path in _live_item_paths_or_none(config, arch, item):
+                alternatives.append((path, "%s.%s" % (arch, destination)))
+        if alternatives:
+            yield LiveFetch(arch, policy, alternatives)
+
+    if config["UBUNTU_DEFAULTS_LOCALE"]:
+        image_items = ["iso"]
+    else:
+        image_items = ["cloop", "squashfs", "rootfs.tar.gz", "tar.xz"]
+    primary = list(fetch("primary", [(item, item) for item in image_items]))
+    if not primary:
+        # Nothing else is useful without a filesystem image.
+        return
+    for live_fetch in primary:
+        yield live_fetch
+
+    if series >= "dapper" and project != "ubuntu-core":
+        for item in ("kernel", "initrd"):
+            paths = _live_item_paths_or_none(config, arch, item)
+            for flavour, path in zip(flavours(config, arch), paths):
+                yield LiveFetch(arch, "optional", [
+                    (path, "%s.%s-%s" % (arch, item, flavour))])
+        paths = _live_item_paths_or_none(config, arch, "kernel-efi-signed")
+        for flavour, path in zip(flavours(config, arch), paths):
+            yield LiveFetch(arch, "optional", [
+                (path, "%s.kernel-%s.efi.signed" % (arch, flavour))])
+    for items in (
+        [("manifest", "manifest")],
+        [("manifest-remove", "manifest-remove"),
+         ("manifest-desktop", "manifest-desktop")],
+        [("size", "size")],
+        ):
+        for live_fetch in fetch("optional", items):
+            yield live_fetch
+
+    if config["UBUNTU_DEFAULTS_LOCALE"]:
+        return
+
+    if (project not in ("livecd-base", "ubuntu-core", "kubuntu-active") and
+        (project != "edubuntu" or series >= "precise")):
+        if series <= "feisty":
+            pass
+        elif series <= "intrepid":
+            if config["CDIMAGE_DVD"] != "1":
+                for live_fetch in fetch("optional", [("wubi", "wubi.exe")]):
+                    yield live_fetch
+            for live_fetch in fetch("optional", [("umenu", "umenu.exe")]):
+                yield live_fetch
+        else:
+            for live_fetch in fetch("optional", [("wubi", "wubi.exe")]):
+                yield live_fetch
+    if project in ("kubuntu-active", "ubuntu-netbook", "ubuntu-moblin-remix"):
+        want_usb_creator = True
+    elif project in ("livecd-base", "ubuntu-core", "edubuntu"):
+        want_usb_creator = False
+    else:
+        want_usb_creator = bool(config["CDIMAGE_DVD"]) or series >= "maverick"
+    if want_usb_creator:
+        for live_fetch in fetch(
+            "optional", [("usb-creator", "usb-creator.exe")]):
+            yield live_fetch
+
+
+def live_fetch_plan(config):
+    """Resolve all the live filesystem items needed for this build.
+
+    This makes the same decisions as download-live-filesystems used to
+    make with one find-live-filesystem call per item, and returns a list
+    of LiveFetch objects.
+    """
+    project = config["PROJECT"]
+    series = config["DIST"]
+    plan = []
+
+    if config["CDIMAGE_LIVE"]:
+        for arch in config.arches:
+            plan.extend(_live_fetch_plan_arch(config, arch))
+
+    if (project == "edubuntu" and config["CDIMAGE_INSTALL"] and
+        series <= "hardy"):
+        for cpuarch in config["CPUARCHES"].split():
+            for path in _live_item_paths_or_none(config, cpuarch, "winfoss"):
+                plan.append(LiveFetch(
+                    cpuarch, "required",
+                    [(path, "%s.winfoss.tgz" % cpuarch)]))
+
+    if project == "edubuntu" and config["CDIMAGE_DVD"] and series >= "lucid":
+        server_config = Config(read=False)
+        server_config.update(config)
+        server_config["PROJECT"] = "ubuntu-server"
+        for arch in config.arches:
+            if arch not in ("amd64", "i386"):
+                continue
+            if series >= "raring":
+                # Fetch the Ubuntu Server squashfs for Edubuntu Server.
+                plan.append(LiveFetch(arch, "required", [
+                    (path, "%s.server-squashfs" % arch)
+                    for path in _live_item_paths_or_none(
+                        server_config, arch, "squashfs")]))
+            # Fetch the i386 LTSP chroot for Edubuntu Terminal Server.
+            plan.append(LiveFetch(arch, "required", [
+                (path, "%s.ltsp-squashfs" % arch)
+                for path in _live_item_paths_or_none(
+                    config, arch, "ltsp-squashfs")]))
+
+    return plan
+
+
+def format_live_fetch_plan(plan):
+    """Format a plan as lines of tab-separated fields.
+
+    Each line has an architecture, a policy, and then one or more pairs of
+    URL and destination.
+    """
+    for live_fetch in plan:
+        fields = [live_fetch.arch, live_fetch.policy]
+        for url, destination in live_fetch.alternatives:
+            fields.extend([url, destination])
+        yield "\t".join(fields)
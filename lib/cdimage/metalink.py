@@ -0,0 +1,177 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate metalink files for published images."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+import errno
+import hashlib
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+from cdimage.atomicfile import AtomicFile
+from cdimage.checksums import ChecksumFileSet, MetalinkChecksumFileSet
+from cdimage import osextras
+
+
+# Checksum file names, and the corresponding metalink hash types.
+_metalink_hash_types = (
+    ("MD5SUMS", "md5"),
+    ("SHA1SUMS", "sha1"),
+    ("SHA256SUMS", "sha256"),
+    )
+
+
+def want_metalink(name):
+    """Return true if and only if we want a metalink file for this image."""
+    return name.endswith(".iso")
+
+
+def metalink_name(name):
+    return "%s.metalink" % name.rsplit(".", 1)[0]
+
+
+def read_mirrors(config, hostname):
+    """Return the mirrors of HOSTNAME listed in etc/metalink-mirrors.
+
+    Each line of that file holds a hostname, a location (an ISO 3166
+    country code), and the base URL of a mirror of that host.  Returns a
+    list of (location, base URL) pairs.
+    """
+    path = os.path.join(config.root, "etc", "metalink-mirrors")
+    mirrors = []
+    try:
+        with open(path) as mirrors_file:
+            for line in mirrors_file:
+                words = line.split("#", 1)[0].split()
+                if len(words) >= 3 and words[0] == hostname:
+                    mirrors.append((words[1], words[2].rstrip("/")))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return mirrors
+
+
+def metalink_xml(name, size, digests, urls, version=None):
+    """Return a Metalink 3.0 document for a single file.
+
+    DIGESTS maps checksum file names to digests, as returned by
+    ChecksumFileSet.checksum.  URLS is a list of (type, location, url)
+    tuples; LOCATION may be None.
+    """
+    lines = [
+        '<?xml version="1.0" encoding="utf-8"?>',
+        '<metalink version="3.0" xmlns="http://www.metalinker.org/" '
+        'generator="cdimage">',
+        '  <files>',
+        '    <file name=%s>' % quoteattr(name),
+        ]
+    if version is not None:
+        lines.append('      <version>%s</version>' % escape(version))
+    lines.append('      <size>%d</size>' % size)
+    lines.append('      <verification>')
+    for checksum_name, hash_type in _metalink_hash_types:
+        if checksum_name in digests:
+            lines.append('        <hash type="%s">%s</hash>' % (
+                hash_type, digests[checksum_name]))
+    lines.append('      </verification>')
+    lines.append('      <resources>')
+    for url_type, location, url in urls:
+        if location is None:
+            location_attr = ""
+        else:
+            location_attr = " location=%s" % quoteattr(location)
+        lines.append(
+            '        <url type=%s%s preference="100">%s</url>' % (
+                quoteattr(url_type), location_attr, escape(url)))
+    lines.extend([
+        '      </resources>',
+        '    </file>',
+        '  </files>',
+        '</metalink>',
+        ])
+    return "\n".join(lines) + "\n"
+
+
+def make_metalinks(config, basedir, version, reldir, hostname,
+                   precomputed=None, sign=True):
+    """Make metalink files for the images in BASEDIR/RELDIR.
+
+    Image sizes and hashes are taken from PRECOMPUTED (a dictionary
+    mapping image names to digests, as used by ChecksumFileSet.merge_all)
+    or from the directory's existing checksum files where possible, so
+    images are only read if they have not been checksummed yet.
+    MD5SUMS-metalink is written from the generated data in the same pass.
+
+    Each metalink lists HOSTNAME, any mirrors of HOSTNAME from
+    etc/metalink-mirrors, and the torrent if there is one.
+
+    Returns the list of metalink files created.
+    """
+    if precomputed is None:
+        precomputed = {}
+    reldir = reldir.strip("/")
+    directory = os.path.join(basedir, reldir)
+    images = sorted(
+        name for name in osextras.listdir_force(directory)
+        if want_metalink(name))
+    if not images:
+        return []
+
+    image_checksums = ChecksumFileSet(config, directory, sign=False)
+    image_checksums.read()
+    metalink_checksums = MetalinkChecksumFileSet(config, directory, sign=sign)
+    base_urls = [("http", None, "http://%s/%s" % (hostname, reldir))]
+    for location, mirror in read_mirrors(config, hostname):
+        base_urls.append(
+            (mirror.split(":", 1)[0], location, "%s/%s" % (mirror, reldir)))
+    created = []
+    for name in images:
+        path = os.path.join(directory, name)
+        digests = dict(precomputed.get(name, {}))
+        for checksum_file in image_checksums.checksum_files:
+            if (checksum_file.name not in digests and
+                name in checksum_file.entries):
+                digests[checksum_file.name] = checksum_file.entries[name]
+        missing = [
+            checksum_file for checksum_file in image_checksums.checksum_files
+            if checksum_file.name not in digests]
+        if missing:
+            digests.update(image_checksums.checksum(path, missing))
+
+        urls = [
+            (url_type, location, "%s/%s" % (base_url, name))
+            for url_type, location, base_url in base_urls]
+        if os.path.exists("%s.torrent" % path):
+            urls.append(
+                ("bittorrent", None,
+                 "%s/%s.torrent" % (base_urls[0][2], name)))
+        text = metalink_xml(
+            name, os.stat(path).st_size, digests, urls, version=version)
+
+        metalink = metalink_name(name)
+        with AtomicFile(os.path.join(directory, metalink)) as metalink_file:
+            metalink_file.write(text)
+        metalink_checksums.add_precomputed(
+            metalink,
+            {"MD5SUMS-metalink": hashlib.md5(
+                text.encode("UTF-8")).hexdigest()})
+        created.append(metalink)
+
+    metalink_checksums.write()
+    return created
@@ -19,7 +19,9 @@ import errno
 import os
 import shutil
 import signal
+import stat
 import subprocess
+import sys
 
 from cdimage.log import logger
 
@@ -46,6 +48,83 @@ def listdir_force(directory):
         raise
 
 
+class _DirEntry:
+    """A minimal os.DirEntry for Pythons without os.scandir."""
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        self._stat = None
+        self._lstat = None
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks:
+            if self._stat is None:
+                self._stat = os.stat(self.path)
+            return self._stat
+        else:
+            if self._lstat is None:
+                self._lstat = os.lstat(self.path)
+            return self._lstat
+
+    def is_dir(self, follow_symlinks=True):
+        try:
+            return stat.S_ISDIR(
+                self.stat(follow_symlinks=follow_symlinks).st_mode)
+        except OSError:
+            return False
+
+    def is_file(self):
+        try:
+            return stat.S_ISREG(self.stat().st_mode)
+        except OSError:
+            return False
+
+    def is_symlink(self):
+        try:
+            return stat.S_ISLNK(self.stat(follow_symlinks=False).st_mode)
+        except OSError:
+            return False
+
+
+class _ScandirIterator:
+    """A minimal os.scandir iterator for Pythons without os.scandir."""
+
+    def __init__(self, directory):
+        self._entries = iter(
+            [_DirEntry(directory, name) for name in os.listdir(directory)])
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._entries)
+
+    next = __next__
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, unused_exc_type, unused_exc_value, unused_exc_tb):
+        self.close()
+
+
+def scandir(directory):
+    """Return an iterator of directory entries, like os.scandir.
+
+    Entries cache their stat results, so callers can avoid stating the same
+    path more than once.  The iterator can be used as a context manager to
+    close the directory.
+    """
+    # os.scandir iterators can only be closed from Python 3.6.
+    if sys.version_info >= (3, 6):
+        return os.scandir(directory)
+    return _ScandirIterator(directory)
+
+
 def unlink_force(path):
     """Unlink path, without worrying about whether it exists."""
     try:
@@ -69,6 +148,20 @@ def find_on_path(command):
     return False
 
 
+def format_size(nbytes):
+    """Format a number of bytes for humans."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if nbytes < 1024:
+            break
+        nbytes /= 1024.0
+    else:
+        unit = "TiB"
+    if unit == "B":
+        return "%d B" % nbytes
+    else:
+        return "%.1f %s" % (nbytes, unit)
+
+
 def waitpid_retry(*args):
     """Run waitpid, retrying on EINTR."""
     while True:
@@ -15,8 +15,10 @@
 
 """Sign a file with the cdimage key."""
 
+from multiprocessing.pool import ThreadPool
 import os
 import subprocess
+import time
 
 from cdimage.log import logger
 
@@ -52,10 +54,7 @@ def _signing_command(config):
         ]
 
 
-def sign_cdimage(config, path):
-    if not can_sign(config):
-        return False
-
+def _gpg_sign(config, path):
     with open(path, "rb") as infile:
         with open("%s.gpg" % path, "wb") as outfile:
             try:
@@ -67,4 +66,53 @@ def sign_cdimage(config, path):
                 except OSError:
                     pass
                 raise
+
+
+def sign_cdimage(config, path):
+    if not can_sign(config):
+        return False
+
+    _gpg_sign(config, path)
     return True
+
+
+def signing_jobs(config):
+    """Return the number of signing processes to run at once."""
+    try:
+        return max(1, int(config["CDIMAGE_SIGNING_JOBS"]))
+    except ValueError:
+        return 1
+
+
+def sign_cdimage_batch(config, paths, jobs=None, signer=None):
+    """Sign several files, running up to JOBS signers at once.
+
+    SIGNER is called as signer(config, path) to create "path.gpg"; it
+    defaults to running gpg.  Returns a list of (path, seconds) pairs in
+    the same order as PATHS, or None if no keys are available.
+    """
+    if not can_sign(config):
+        return None
+    if signer is None:
+        signer = _gpg_sign
+    if jobs is None:
+        jobs = signing_jobs(config)
+
+    def timed_sign(path):
+        start = time.time()
+        signer(config, path)
+        return path, time.time() - start
+
+    paths = list(paths)
+    if jobs < 2 or len(paths) < 2:
+        timings = [timed_sign(path) for path in paths]
+    else:
+        pool = ThreadPool(min(jobs, len(paths)))
+        try:
+            timings = pool.map(timed_sign, paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    for path, seconds in timings:
+        logger.debug("Signed %s in %.2fs" % (path, seconds))
+    return timings
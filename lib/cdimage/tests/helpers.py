@@ -18,6 +18,7 @@
 __metaclass__ = type
 
 from logging.handlers import BufferingHandler
+import os
 import shutil
 import tempfile
 try:
@@ -63,3 +64,23 @@ class TestCase(unittest.TestCase):
 def touch(path):
     with open(path, "a"):
         pass
+
+
+class FakeSigner:
+    """A stand-in for gpg that records which files it was asked to sign."""
+
+    def __init__(self):
+        self.signed = []
+
+    def __call__(self, config, path):
+        self.signed.append(path)
+        with open("%s.gpg" % path, "w") as signature:
+            signature.write("signature of %s\n" % path)
+
+
+def use_fake_keys(config, directory):
+    """Set up CONFIG so that can_sign will succeed."""
+    for tail in "secring.gpg", "pubring.gpg", "trustdb.gpg":
+        touch(os.path.join(directory, tail))
+    config["GNUPG_DIR"] = directory
+    config["SIGNING_KEYID"] = "01234567"
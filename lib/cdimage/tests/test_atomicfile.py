@@ -35,6 +35,15 @@ class TestAtomicFile(TestCase):
         with open(foo) as handle:
             self.assertEqual("string", handle.read())
 
+    def test_binary(self):
+        """AtomicFile writes bytes unchanged if asked to."""
+        self.use_temp_dir()
+        foo = os.path.join(self.temp_dir, "foo")
+        with AtomicFile(foo, binary=True) as test:
+            test.write(b"\xff\x00\n")
+        with open(foo, "rb") as handle:
+            self.assertEqual(b"\xff\x00\n", handle.read())
+
     def test_removes_dot_new(self):
         """AtomicFile does not leave .new files lying around."""
         self.use_temp_dir()
@@ -42,3 +51,16 @@ class TestAtomicFile(TestCase):
         with AtomicFile(foo):
             pass
         self.assertFalse(os.path.exists("%s.new" % foo))
+
+    def test_removes_dot_new_on_error(self):
+        """AtomicFile removes the .new file if writing fails."""
+        self.use_temp_dir()
+        foo = os.path.join(self.temp_dir, "foo")
+        try:
+            with AtomicFile(foo) as test:
+                test.write("string")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(os.path.exists(foo))
+        self.assertFalse(os.path.exists("%s.new" % foo))
@@ -0,0 +1,76 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.benchmark."""
+
+__metaclass__ = type
+
+import os
+
+from cdimage.benchmark import (
+    BenchmarkResult,
+    format_results,
+    make_tree,
+    run_benchmarks,
+    tree_bytes,
+    )
+from cdimage.config import Config
+from cdimage.tests.helpers import TestCase
+
+
+class TestBenchmark(TestCase):
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config.root = self.temp_dir
+
+    def test_make_tree(self):
+        image_dir, old_dirs = make_tree(
+            self.temp_dir, images=2, image_size=1024 * 1024, small_files=3,
+            small_size=10, old_directories=2, old_entries=5)
+        self.assertEqual(
+            ["bench-desktop-arch0.iso", "bench-desktop-arch1.iso",
+             "bench-small0.img", "bench-small1.img", "bench-small2.img"],
+            sorted(os.listdir(image_dir)))
+        self.assertEqual(2 * 1024 * 1024 + 30, tree_bytes(image_dir))
+        self.assertEqual(2, len(old_dirs))
+        with open(os.path.join(old_dirs[0], "MD5SUMS")) as md5sums:
+            self.assertEqual(5, len(md5sums.readlines()))
+
+    def test_run_benchmarks(self):
+        image_dir, old_dirs = make_tree(
+            self.temp_dir, images=1, image_size=64 * 1024, small_files=2,
+            small_size=10, old_directories=1, old_entries=2)
+        results = run_benchmarks(self.config, image_dir, old_dirs, jobs=2)
+        self.assertEqual(6, len(results))
+        for result in results:
+            self.assertEqual(64 * 1024 + 20, result.bytes)
+            self.assertGreater(result.peak_rss, 0)
+
+    def test_format_results(self):
+        lines = format_results([
+            BenchmarkResult("case", 2.0, 4000000, 10, 1024),
+            BenchmarkResult("other", 0.0, 0, None, 2048),
+            ])
+        self.assertEqual(3, len(lines))
+        self.assertEqual(
+            "%-40s %10s %9.2f %10s %12d" % ("case", "2.0", 2.0, "10", 1024),
+            lines[1])
+        self.assertEqual(
+            "%-40s %10s %9.2f %10s %12d" % ("other", "-", 0.0, "-", 2048),
+            lines[2])
@@ -21,23 +21,35 @@ from __future__ import print_function
 
 __metaclass__ = type
 
+import errno
 import hashlib
 import os
 import shutil
 import subprocess
 import time
 from textwrap import dedent
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 from cdimage.checksums import (
     apply_sed,
+    ChecksumCache,
     ChecksumFile,
+    ChecksumFileIndex,
     ChecksumFileSet,
+    ChecksumVerifier,
     checksum_directory,
+    checksum_jobs,
+    checksum_move,
     MetalinkChecksumFileSet,
     metalink_checksum_directory,
+    SedMapper,
     )
 from cdimage.config import Config
-from cdimage.tests.helpers import TestCase, touch
+from cdimage import sign
+from cdimage.tests.helpers import FakeSigner, TestCase, touch, use_fake_keys
 
 
 class TestApplySed(TestCase):
@@ -45,6 +57,246 @@ class TestApplySed(TestCase):
         self.assertEqual("aabce", apply_sed("abcde", "s/bcd/abc/"))
 
 
+class TestSedMapper(TestCase):
+    def test_publish_expression(self):
+        mapper = SedMapper(
+            r"s/\.\(img\|img\.gz\|iso\|iso\.gz\|tar\.gz\)$/.raw/")
+        self.assertTrue(mapper.compiled)
+        self.assertEqual(
+            ["foo-i386.raw", "foo-armhf.raw", "foo.list", "foo.iso.raw"],
+            mapper.map([
+                "foo-i386.iso", "foo-armhf.img.gz", "foo.list",
+                "foo.iso.tar.gz"]))
+
+    def test_groups_and_flags(self):
+        mapper = SedMapper(r"s/\(a\)\(b*\)/[\2\1&]/g")
+        self.assertTrue(mapper.compiled)
+        self.assertEqual("[bbaabb][aa]", mapper("abba"))
+        self.assertEqual("fOO", SedMapper("s/o/O/gI")("fOo"))
+
+    def test_bre_literals(self):
+        self.assertEqual("Qbc", SedMapper("s/^*a/Q/")("*abc"))
+        self.assertEqual("Zc", SedMapper("s/a$b/Z/")("a$bc"))
+        self.assertEqual("x-y", SedMapper(r"s,a\,b,-,")("xa,by"))
+        self.assertEqual("-y", SedMapper("s/[]x]/-/")("xy"))
+        self.assertEqual("&y", SedMapper("s/x/\\&/")("xy"))
+
+    def test_falls_back_to_sed(self):
+        mapper = SedMapper(r"s/\w/X/")
+        self.assertFalse(mapper.compiled)
+        self.assertEqual("Xb", mapper("ab"))
+        self.assertEqual(["Xb", "X", ""], mapper.map(["ab", "c", ""]))
+
+    def test_falls_back_to_sed_per_text(self):
+        # Addresses apply to each text separately, as they would if sed
+        # were run once for each.
+        mapper = SedMapper("1s/a/X/")
+        self.assertFalse(mapper.compiled)
+        self.assertEqual(["X1", "X2", "X3"], mapper.map(["a1", "a2", "a3"]))
+        self.assertEqual(["a\na", "b\nb"], SedMapper("p").map(["a", "b"]))
+
+    def test_unsupported_flags(self):
+        self.assertFalse(SedMapper("s/a/b/2").compiled)
+        self.assertFalse(SedMapper("y/a/b/").compiled)
+
+
+class TestChecksumJobs(TestCase):
+    def test_checksum_jobs(self):
+        config = Config(read=False)
+        self.assertEqual(1, checksum_jobs(config))
+        config["CDIMAGE_CHECKSUM_JOBS"] = "4"
+        self.assertEqual(4, checksum_jobs(config))
+        config["CDIMAGE_CHECKSUM_JOBS"] = "0"
+        self.assertEqual(1, checksum_jobs(config))
+        config["CDIMAGE_CHECKSUM_JOBS"] = "lots"
+        self.assertEqual(1, checksum_jobs(config))
+
+
+class TestChecksumCache(TestCase):
+    def setUp(self):
+        super(TestChecksumCache, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config.root = self.temp_dir
+        os.mkdir(os.path.join(self.temp_dir, "etc"))
+        self.entry_path = os.path.join(self.temp_dir, "entry")
+        with open(self.entry_path, "w") as entry:
+            print("data", end="", file=entry)
+
+    def test_default_path(self):
+        cache = ChecksumCache(self.config)
+        self.assertEqual(
+            os.path.join(self.temp_dir, "etc", ".checksum-cache"), cache.path)
+
+    def test_lookup_missing(self):
+        cache = ChecksumCache(self.config)
+        self.assertIsNone(cache.lookup(self.entry_path, "md5"))
+
+    def test_store_and_lookup_hardlink(self):
+        cache = ChecksumCache(self.config)
+        cache.store(self.entry_path, "md5", "checksum")
+        link_path = os.path.join(self.temp_dir, "link")
+        os.link(self.entry_path, link_path)
+        self.assertEqual("checksum", cache.lookup(link_path, "md5"))
+        self.assertIsNone(cache.lookup(link_path, "sha1"))
+
+    def test_lookup_ignores_modified_file(self):
+        cache = ChecksumCache(self.config)
+        cache.store(self.entry_path, "md5", "checksum")
+        next_minute = time.time() + 60
+        os.utime(self.entry_path, (next_minute, next_minute))
+        self.assertIsNone(cache.lookup(self.entry_path, "md5"))
+
+    def test_write_and_read(self):
+        with ChecksumCache(self.config) as cache:
+            cache.store(self.entry_path, "md5", "md5sum")
+            cache.store(self.entry_path, "sha1", "sha1sum")
+        cache = ChecksumCache(self.config)
+        cache.read()
+        self.assertEqual("md5sum", cache.lookup(self.entry_path, "md5"))
+        self.assertEqual("sha1sum", cache.lookup(self.entry_path, "sha1"))
+        self.assertEqual([".checksum-cache"], os.listdir(
+            os.path.join(self.temp_dir, "etc")))
+
+    def test_prune(self):
+        cache = ChecksumCache(self.config)
+        link_path = os.path.join(self.temp_dir, "link")
+        os.link(self.entry_path, link_path)
+        cache.store(self.entry_path, "md5", "checksum")
+        cache.store(link_path, "md5", "checksum")
+        os.unlink(self.entry_path)
+        cache.prune()
+        self.assertEqual(1, len(cache.entries))
+        self.assertEqual(
+            set([link_path]), list(cache.entries.values())[0][0])
+        os.unlink(link_path)
+        cache.prune()
+        self.assertEqual({}, cache.entries)
+
+    def test_fill_and_record(self):
+        cache = ChecksumCache(self.config)
+        checksum_file = ChecksumFile(
+            self.config, self.temp_dir, "MD5SUMS", hashlib.md5, sign=False)
+        self.assertFalse(cache.fill(checksum_file, "entry"))
+        self.assertEqual({}, checksum_file.entries)
+        checksum_file.entries["entry"] = "checksum"
+        cache.record(checksum_file, "entry")
+        self.assertEqual("checksum", cache.lookup(self.entry_path, "md5"))
+        other = ChecksumFile(
+            self.config, self.temp_dir, "MD5SUMS", hashlib.md5, sign=False)
+        self.assertTrue(cache.fill(other, "entry"))
+        self.assertEqual({"entry": "checksum"}, other.entries)
+
+    def test_checksum_file_add_uses_cache(self):
+        cache = ChecksumCache(self.config)
+        checksum_file = ChecksumFile(
+            self.config, self.temp_dir, "MD5SUMS", hashlib.md5, sign=False,
+            cache=cache)
+        checksum_file.add("entry")
+        self.assertEqual(
+            hashlib.md5(b"data").hexdigest(),
+            cache.lookup(self.entry_path, "md5"))
+        cache.store(self.entry_path, "md5", "cached")
+        checksum_file.entries = {}
+        checksum_file.add("entry")
+        self.assertEqual({"entry": "cached"}, checksum_file.entries)
+
+    def test_checksum_directory_uses_cache(self):
+        self.config["CDIMAGE_CHECKSUM_CACHE"] = "1"
+        old_dir = os.path.join(self.temp_dir, "old")
+        new_dir = os.path.join(self.temp_dir, "new")
+        os.mkdir(old_dir)
+        os.mkdir(new_dir)
+        old_iso = os.path.join(old_dir, "foo-i386.iso")
+        with open(old_iso, "w") as iso:
+            print("foo-i386.iso", end="", file=iso)
+        checksum_directory(self.config, old_dir)
+        os.link(old_iso, os.path.join(new_dir, "foo-i386.iso"))
+        # Mark the cached digests so that we can tell they were used.
+        with ChecksumCache(self.config) as cache:
+            self.assertEqual(1, len(cache.entries))
+            for _, digests in cache.entries.values():
+                for hash_name in digests:
+                    digests[hash_name] = "cached-%s" % hash_name
+            cache.changed = True
+        checksum_directory(self.config, new_dir, old_directories=[])
+        with open(os.path.join(new_dir, "MD5SUMS")) as md5sums:
+            self.assertEqual("cached-md5 *foo-i386.iso\n", md5sums.read())
+
+
+class TestChecksumFileIndex(TestCase):
+    def setUp(self):
+        super(TestChecksumFileIndex, self).setUp()
+        self.config = Config(read=False)
+        self.use_temp_dir()
+
+    def test_get_missing(self):
+        index = ChecksumFileIndex(self.config)
+        self.assertIsNone(index.get(self.temp_dir, "MD5SUMS"))
+
+    def test_get(self):
+        md5sums_path = os.path.join(self.temp_dir, "MD5SUMS")
+        with open(md5sums_path, "w") as md5sums:
+            print("checksum *entry", file=md5sums)
+        index = ChecksumFileIndex(self.config)
+        self.assertEqual(
+            (os.stat(md5sums_path).st_mtime, {"entry": "checksum"}),
+            index.get(self.temp_dir, "MD5SUMS"))
+
+
+class TestChecksumMove(TestCase):
+    def setUp(self):
+        super(TestChecksumMove, self).setUp()
+        self.use_temp_dir()
+        self.source = os.path.join(self.temp_dir, "source")
+        self.target = os.path.join(self.temp_dir, "target")
+        with open(self.source, "w") as source:
+            print("data", end="", file=source)
+
+    def force_copy(self):
+        real_rename = os.rename
+        renames = []
+
+        def rename(src, dst):
+            if src == self.source and not renames:
+                renames.append(src)
+                raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+            return real_rename(src, dst)
+
+        os.rename = rename
+        self.addCleanup(setattr, os, "rename", real_rename)
+
+    def test_same_filesystem(self):
+        self.assertIsNone(checksum_move(self.source, self.target))
+        self.assertFalse(os.path.exists(self.source))
+        with open(self.target) as target:
+            self.assertEqual("data", target.read())
+
+    def test_copy(self):
+        self.force_copy()
+        self.assertEqual({
+            "MD5SUMS": hashlib.md5("data").hexdigest(),
+            "SHA1SUMS": hashlib.sha1("data").hexdigest(),
+            "SHA256SUMS": hashlib.sha256("data").hexdigest(),
+            }, checksum_move(self.source, self.target))
+        self.assertFalse(os.path.exists(self.source))
+        with open(self.target) as target:
+            self.assertEqual("data", target.read())
+        self.assertEqual(["target"], os.listdir(self.temp_dir))
+
+    def test_copy_preserves_hardlinked_target(self):
+        old = os.path.join(self.temp_dir, "old")
+        with open(old, "w") as old_file:
+            print("old", end="", file=old_file)
+        os.link(old, self.target)
+        self.force_copy()
+        checksum_move(self.source, self.target)
+        with open(old) as old_file:
+            self.assertEqual("old", old_file.read())
+        with open(self.target) as target:
+            self.assertEqual("data", target.read())
+
+
 class TestChecksumFile(TestCase):
     def setUp(self):
         super(TestChecksumFile, self).setUp()
@@ -157,6 +409,22 @@ class TestChecksumFile(TestCase):
         checksum_file.merge([old_dir], "entry", ["other-entry"])
         self.assertEqual({"entry": "checksum"}, checksum_file.entries)
 
+    def test_merge_uses_index(self):
+        old_dir = os.path.join(self.temp_dir, "old")
+        os.mkdir(old_dir)
+        touch(os.path.join(self.temp_dir, "entry"))
+        with open(os.path.join(old_dir, "MD5SUMS"), "w") as old_md5sums:
+            print("checksum *entry", file=old_md5sums)
+        index = ChecksumFileIndex(self.config)
+        self.assertEqual(
+            {"entry": "checksum"}, index.get(old_dir, "MD5SUMS")[1])
+        # Later changes to the old checksum file are not seen.
+        os.unlink(os.path.join(old_dir, "MD5SUMS"))
+        checksum_file = ChecksumFile(
+            self.config, self.temp_dir, "MD5SUMS", hashlib.md5)
+        checksum_file.merge([old_dir], "entry", ["entry"], index=index)
+        self.assertEqual({"entry": "checksum"}, checksum_file.entries)
+
     def test_write(self):
         checksum_file = ChecksumFile(
             self.config, self.temp_dir, "MD5SUMS", hashlib.md5, sign=False)
@@ -255,6 +523,47 @@ class TestChecksumFileSet(TestCase):
         checksum_files.add("entry")
         self.assertChecksumsEqual({"entry": "test\n"}, checksum_files)
 
+    def test_checksum(self):
+        entry_path = os.path.join(self.temp_dir, "entry")
+        data = "a" * 1048576
+        with open(entry_path, "w") as entry:
+            print(data, end="", file=entry)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        self.assertEqual(
+            dict((cf.name, cf.hash_method(data).hexdigest())
+                 for cf in checksum_files.checksum_files),
+            checksum_files.checksum(entry_path))
+
+    def test_add_reads_once(self):
+        entry_path = os.path.join(self.temp_dir, "entry")
+        with open(entry_path, "w") as entry:
+            print("test\n", end="", file=entry)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        calls = []
+        real_checksum = checksum_files.checksum
+
+        def checksum(entry_path, checksum_files=None):
+            calls.append(entry_path)
+            return real_checksum(entry_path, checksum_files=checksum_files)
+
+        checksum_files.checksum = checksum
+        checksum_files.add("entry")
+        checksum_files.add("entry")
+        self.assertEqual([entry_path], calls)
+        self.assertChecksumsEqual({"entry": "test\n"}, checksum_files)
+
+    def test_add_only_missing(self):
+        entry_path = os.path.join(self.temp_dir, "entry")
+        with open(entry_path, "w") as entry:
+            print("test\n", end="", file=entry)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        checksum_files.checksum_files[0].entries["entry"] = ""
+        checksum_files.add("entry")
+        self.assertEqual("", checksum_files.checksum_files[0].entries["entry"])
+        for cf in checksum_files.checksum_files[1:]:
+            self.assertEqual(
+                cf.hash_method(b"test\n").hexdigest(), cf.entries["entry"])
+
     def test_remove(self):
         entry_path = os.path.join(self.temp_dir, "entry")
         data = "test\n"
@@ -311,6 +620,48 @@ class TestChecksumFileSet(TestCase):
             "foo-i386.iso": "foo-i386.raw",
             }, checksum_files)
 
+    def test_add_parallel(self):
+        entry_data = {}
+        for i in range(5):
+            name = "entry%d" % i
+            entry_data[name] = name * 1000
+            with open(os.path.join(self.temp_dir, name), "w") as entry:
+                print(entry_data[name], end="", file=entry)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        checksum_files.checksum_files[0].entries["entry0"] = (
+            checksum_files.checksum_files[0].hash_method(
+                entry_data["entry0"]).hexdigest())
+        checksum_files.add_parallel(sorted(entry_data), 3)
+        self.assertChecksumsEqual(entry_data, checksum_files)
+
+    def test_merge_all_parallel_matches_serial(self):
+        for name in "foo-amd64.iso", "foo-armhf.img.gz", "foo-i386.iso":
+            with open(os.path.join(self.temp_dir, name), "w") as image:
+                print(name * 100, end="", file=image)
+        self.config["CDIMAGE_CHECKSUM_JOBS"] = "3"
+        parallel = self.cls(self.config, self.temp_dir)
+        parallel.merge_all([])
+        serial = self.cls(self.config, self.temp_dir)
+        serial.merge_all([], jobs=1)
+        self.assertEqual(
+            [cf.entries for cf in serial.checksum_files],
+            [cf.entries for cf in parallel.checksum_files])
+
+    def test_merge_all_precomputed(self):
+        for name in "foo-amd64.iso", "foo-i386.iso":
+            with open(os.path.join(self.temp_dir, name), "w") as image:
+                print(name, end="", file=image)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        precomputed = {
+            "foo-i386.iso": dict(
+                (cf.name, "precomputed")
+                for cf in checksum_files.checksum_files),
+            }
+        checksum_files.merge_all([], precomputed=precomputed)
+        for cf in checksum_files.checksum_files:
+            if "foo-i386.iso" in cf.entries:
+                self.assertEqual("precomputed", cf.entries["foo-i386.iso"])
+
     def test_write(self):
         checksum_files = self.cls(
             self.config, self.temp_dir, sign=False)
@@ -327,6 +678,22 @@ class TestChecksumFileSet(TestCase):
                     [self.files_and_commands[cf.name], "-c", "--status",
                      cf.name], cwd=self.temp_dir))
 
+    def test_write_signs_in_batch(self):
+        use_fake_keys(self.config, self.temp_dir)
+        signer = FakeSigner()
+        real_gpg_sign = sign._gpg_sign
+        sign._gpg_sign = signer
+        self.addCleanup(setattr, sign, "_gpg_sign", real_gpg_sign)
+        checksum_files = self.cls(self.config, self.temp_dir)
+        entry_path = os.path.join(self.temp_dir, "1")
+        with open(entry_path, "w") as entry:
+            print("1", end="", file=entry)
+        checksum_files.add("1")
+        checksum_files.write()
+        self.assertEqual(
+            sorted(cf.path for cf in checksum_files.checksum_files),
+            sorted(signer.signed))
+
     def test_context_manager(self):
         for name in "1", "2":
             entry_path = os.path.join(self.temp_dir, name)
@@ -474,3 +841,99 @@ class TestMetalinkChecksumFileSet(TestChecksumFileSet):
                 %s *foo-amd64.metalink
                 %s *foo-i386.metalink
                 """) % digests, md5sums.read())
+
+
+class TestChecksumVerifier(TestCase):
+    def setUp(self):
+        super(TestChecksumVerifier, self).setUp()
+        self.config = Config(read=False)
+        self.use_temp_dir()
+        for name in "foo-amd64.iso", "foo-i386.iso":
+            with open(os.path.join(self.temp_dir, name), "w") as image:
+                print(name, end="", file=image)
+        checksum_files = ChecksumFileSet(
+            self.config, self.temp_dir, sign=False)
+        checksum_files.merge_all([])
+        checksum_files.write()
+
+    def test_expected(self):
+        verifier = ChecksumVerifier(self.config, [self.temp_dir])
+        expected = verifier.expected()
+        self.assertEqual(
+            [os.path.join(self.temp_dir, name)
+             for name in ("foo-amd64.iso", "foo-i386.iso")],
+            [entry_path for entry_path, _ in expected])
+        self.assertEqual(
+            ["MD5SUMS", "SHA1SUMS", "SHA256SUMS"],
+            sorted(cf.name for cf, _ in expected[0][1]))
+
+    def test_verify_good(self):
+        for jobs in 1, 2:
+            verifier = ChecksumVerifier(
+                self.config, [self.temp_dir], jobs=jobs)
+            self.assertTrue(verifier.verify())
+            self.assertEqual(6, len(verifier.verified))
+            self.assertEqual(
+                2, sum(stats[0] for stats in verifier.worker_stats.values()))
+
+    def test_verify_bad(self):
+        with open(os.path.join(self.temp_dir, "foo-i386.iso"), "w") as image:
+            print("corrupt", end="", file=image)
+        os.unlink(os.path.join(self.temp_dir, "foo-amd64.iso"))
+        verifier = ChecksumVerifier(self.config, [self.temp_dir], jobs=2)
+        self.assertFalse(verifier.verify())
+        self.assertEqual(
+            [os.path.join(self.temp_dir, "foo-amd64.iso")], verifier.missing)
+        self.assertEqual(
+            sorted((os.path.join(self.temp_dir, "foo-i386.iso"),
+                    os.path.join(self.temp_dir, name))
+                   for name in ("MD5SUMS", "SHA1SUMS", "SHA256SUMS")),
+            sorted(verifier.mismatched))
+        out = StringIO()
+        err = StringIO()
+        verifier.report(out=out, err=err)
+        self.assertIn(
+            "%s: MISSING" % os.path.join(self.temp_dir, "foo-amd64.iso"),
+            err.getvalue())
+        self.assertIn(
+            "0 checksums verified, 3 mismatched, 1 files missing",
+            out.getvalue())
+
+    def test_verify_unreadable(self):
+        # Opening a directory fails with something other than ENOENT.
+        os.unlink(os.path.join(self.temp_dir, "foo-i386.iso"))
+        os.mkdir(os.path.join(self.temp_dir, "foo-i386.iso"))
+        for jobs in 1, 2:
+            verifier = ChecksumVerifier(
+                self.config, [self.temp_dir], jobs=jobs)
+            self.assertFalse(verifier.verify())
+            self.assertEqual(
+                [os.path.join(self.temp_dir, "foo-i386.iso")],
+                [entry_path for entry_path, _ in verifier.unreadable])
+            self.assertEqual([], verifier.missing)
+            # Other files are still checked.
+            self.assertEqual(3, len(verifier.verified))
+        out = StringIO()
+        err = StringIO()
+        verifier.report(out=out, err=err)
+        self.assertIn(
+            "%s: UNREADABLE (" % os.path.join(self.temp_dir, "foo-i386.iso"),
+            err.getvalue())
+        self.assertIn(
+            "3 checksums verified, 0 mismatched, 0 files missing, "
+            "1 unreadable", out.getvalue())
+
+    def test_verify_recursive(self):
+        subdir = os.path.join(self.temp_dir, "sub")
+        os.mkdir(subdir)
+        for name in os.listdir(self.temp_dir):
+            if name != "sub":
+                os.rename(
+                    os.path.join(self.temp_dir, name),
+                    os.path.join(subdir, name))
+        verifier = ChecksumVerifier(self.config, [self.temp_dir])
+        self.assertEqual([], verifier.expected())
+        verifier = ChecksumVerifier(
+            self.config, [self.temp_dir], recursive=True)
+        self.assertTrue(verifier.verify())
+        self.assertEqual(6, len(verifier.verified))
@@ -22,6 +22,7 @@ from __future__ import print_function
 __metaclass__ = type
 
 import os
+import time
 from textwrap import dedent
 try:
     from test.support import EnvironmentVarGuard
@@ -29,6 +30,7 @@ except ImportError:
     from test.test_support import EnvironmentVarGuard
 
 from cdimage.config import all_series, Config, Series
+from cdimage import osextras
 from cdimage.tests.helpers import TestCase
 
 
@@ -41,6 +43,49 @@ class TestSeries(TestCase):
         series = Series.find_by_version("5.04")
         self.assertEqual(("hoary", "5.04", "Hoary Hedgehog"), tuple(series))
 
+    def test_find_unknown(self):
+        self.assertRaises(ValueError, Series.find_by_name, "nonexistent")
+        self.assertRaises(ValueError, Series.find_by_version, "1.0")
+
+    def test_read(self):
+        self.use_temp_dir()
+        path = os.path.join(self.temp_dir, "series")
+        with open(path, "w") as series_file:
+            print(dedent("""\
+                # name  version display name
+                warty   4.10    Warty Warthog
+
+                hoary   5.04    Hoary Hedgehog
+                """), file=series_file)
+        self.assertEqual([
+            ("warty", "4.10", "Warty Warthog"),
+            ("hoary", "5.04", "Hoary Hedgehog"),
+            ], [tuple(series) for series in Series.read(path)])
+
+    def test_register(self):
+        self.addCleanup(Series.register, list(all_series))
+        Series.register([
+            Series("foo", "1.0", "Foo"),
+            Series("bar", "0.9", "Bar"),
+            ])
+        self.assertEqual(["foo", "bar"], [str(s) for s in all_series])
+        self.assertEqual("bar", Series.find_by_version("0.9").name)
+        self.assertLess(Series.find_by_name("foo"), "bar")
+        self.assertTrue(Series.find_by_name("bar").is_latest)
+        self.assertRaises(ValueError, Series.find_by_name, "warty")
+
+    def test_index(self):
+        for index, series in enumerate(all_series):
+            self.assertEqual(index, series.index)
+        # A series that was not registered takes its ordering from the
+        # registered series with the same name.
+        self.assertEqual(
+            1, Series("hoary", "5.04", "Hoary Hedgehog").index)
+
+    def test_hash(self):
+        series = {Series.find_by_name("warty"): 1}
+        self.assertEqual(1, series[Series("warty", "4.10", "Warty Warthog")])
+
     def test_latest(self):
         self.assertTrue(Series.latest().is_latest)
 
@@ -108,6 +153,150 @@ class TestConfig(TestCase):
             self.assertEqual("ubuntu", config["PROJECT"])
             self.assertEqual("Ubuntu", config["CAPPROJECT"])
 
+    def write_config(self, text):
+        osextras.ensuredir(os.path.join(self.temp_dir, "etc"))
+        with open(os.path.join(self.temp_dir, "etc", "config"), "w") as f:
+            print(dedent(text), file=f)
+
+    def count_shell_runs(self):
+        runs = []
+        real_run_nullsep = Config._run_nullsep
+
+        def run_nullsep(config, command):
+            runs.append(command)
+            return real_run_nullsep(config, command)
+
+        self.addCleanup(setattr, Config, "_run_nullsep", real_run_nullsep)
+        Config._run_nullsep = run_nullsep
+        return runs
+
+    def test_read_is_lazy(self):
+        self.use_temp_dir()
+        runs = self.count_shell_runs()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT=ubuntu
+                """)
+            config = Config()
+            self.assertEqual(0, len(runs))
+            self.assertEqual("ubuntu", config["PROJECT"])
+            self.assertEqual("", config["DIST"])
+            self.assertEqual(1, len(runs))
+
+    def test_set_before_read(self):
+        self.use_temp_dir()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT=ubuntu
+                DIST=quantal
+                """)
+            config = Config()
+            config["PROJECT"] = "kubuntu"
+            self.assertEqual("kubuntu", config["PROJECT"])
+            self.assertEqual(Series.find_by_name("quantal"), config["DIST"])
+
+    def test_snapshot_reused(self):
+        self.use_temp_dir()
+        runs = self.count_shell_runs()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT=ubuntu
+                DIST=quantal
+                """)
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+            config = Config()
+            self.assertEqual("ubuntu", config["PROJECT"])
+            self.assertEqual(Series.find_by_name("quantal"), config["DIST"])
+            self.assertEqual(1, len(runs))
+            self.assertEqual(1, len(os.listdir(config.snapshot_dir)))
+
+    def test_snapshot_invalidated_by_config(self):
+        self.use_temp_dir()
+        runs = self.count_shell_runs()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT=ubuntu
+                """)
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+            self.write_config("""\
+                PROJECT=kubuntu
+                """)
+            self.assertEqual("kubuntu", Config()["PROJECT"])
+            self.assertEqual(2, len(runs))
+
+    def test_snapshot_invalidated_by_default_arches(self):
+        self.use_temp_dir()
+        runs = self.count_shell_runs()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT=ubuntu
+                """)
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+            osextras.ensuredir(os.path.join(self.temp_dir, "bin"))
+            with open(
+                os.path.join(self.temp_dir, "bin", "default-arches"),
+                "w") as f:
+                print("print('amd64 i386')", file=f)
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+            self.assertEqual(2, len(runs))
+
+    def test_snapshot_invalidated_by_environment(self):
+        self.use_temp_dir()
+        runs = self.count_shell_runs()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT="${PROJECT:-ubuntu}"
+                """)
+            env.unset("PROJECT")
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+            env["PROJECT"] = "xubuntu"
+            self.assertEqual("xubuntu", Config()["PROJECT"])
+            env["PWD"] = "/"
+            env["SSH_AUTH_SOCK"] = "/tmp/ssh-agent"
+            self.assertEqual("xubuntu", Config()["PROJECT"])
+            self.assertEqual(2, len(runs))
+
+    def test_snapshot_only_stores_config_keys(self):
+        self.use_temp_dir()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            env["SECRET_PASSWORD"] = "hunter2"
+            self.write_config("""\
+                PROJECT=ubuntu
+                export CDIMAGE_DEBUG=1
+                """)
+            config = Config()
+            self.assertEqual("ubuntu", config["PROJECT"])
+            [name] = os.listdir(config.snapshot_dir)
+            with open(os.path.join(config.snapshot_dir, name)) as snapshot:
+                raw = snapshot.read()
+            self.assertIn("PROJECT=ubuntu\0", raw)
+            self.assertIn("CDIMAGE_DEBUG=1\0", raw)
+            self.assertNotIn("SECRET_PASSWORD", raw)
+            self.assertNotIn("hunter2", raw)
+
+    def test_snapshot_refreshed_when_used(self):
+        self.use_temp_dir()
+        with EnvironmentVarGuard() as env:
+            env["CDIMAGE_ROOT"] = self.temp_dir
+            self.write_config("""\
+                PROJECT=ubuntu
+                """)
+            config = Config()
+            self.assertEqual("ubuntu", config["PROJECT"])
+            [name] = os.listdir(config.snapshot_dir)
+            path = os.path.join(config.snapshot_dir, name)
+            old = time.time() - 2 * 24 * 60 * 60
+            os.utime(path, (old, old))
+            self.assertEqual("ubuntu", Config()["PROJECT"])
+            self.assertGreater(os.stat(path).st_mtime, old + 60)
+
     def test_missing_config(self):
         # Even if etc/config is missing, Config still reads values from the
         # environment.  This makes it easier to experiment locally.
@@ -0,0 +1,587 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.download."""
+
+__metaclass__ = type
+
+from multiprocessing.pool import ThreadPool
+import os
+import re
+import socket
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+from cdimage.config import Config
+from cdimage import download
+from cdimage.download import (
+    DownloadError,
+    Downloader,
+    download_connections,
+    download_jobs,
+    download_live_filesystems,
+    find_proxy,
+    live_cache,
+    LiveCache,
+    parse_size,
+    )
+from cdimage.livefs import LiveFetch
+from cdimage.tests.helpers import TestCase, touch
+
+
+class FakeHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, headers=()):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        range_header = self.headers.get("Range")
+        with server.lock:
+            server.requests.append((self.path, range_header))
+            server.request_headers.append(dict(
+                (name.lower(), value) for name, value in self.headers.items()))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        try:
+            time.sleep(server.delay)
+            if self.path in server.redirects:
+                self.send_body(
+                    302, b"", [("Location", server.redirects[self.path])])
+                return
+            if self.path not in server.files:
+                self.send_body(404, b"not found")
+                return
+            data = server.files[self.path]
+            validators = []
+            etag = server.etags.get(self.path)
+            if etag is not None:
+                validators.append(("ETag", etag))
+            last_modified = server.last_modified.get(self.path)
+            if last_modified is not None:
+                validators.append(("Last-Modified", last_modified))
+            if ((etag is not None and
+                 self.headers.get("If-None-Match") == etag) or
+                (last_modified is not None and
+                 self.headers.get("If-Modified-Since") == last_modified)):
+                self.send_body(304, b"", validators)
+                return
+            offset = 0
+            if_range = self.headers.get("If-Range")
+            if (range_header and not server.ignore_range and
+                if_range in (None, etag, last_modified)):
+                offset = int(re.match(r"bytes=(\d+)-", range_header).group(1))
+            with server.lock:
+                truncate = self.path in server.truncate
+                server.truncate.discard(self.path)
+            if offset:
+                self.send_response(206)
+                self.send_header(
+                    "Content-Range",
+                    "bytes %d-%d/%d" % (offset, len(data) - 1, len(data)))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(data) - offset))
+            for header in validators:
+                self.send_header(*header)
+            self.end_headers()
+            if truncate:
+                # Send part of the body and then drop the connection.
+                self.wfile.write(data[offset:offset + len(data) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(data[offset:])
+        finally:
+            with server.lock:
+                server.active -= 1
+
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), FakeHTTPRequestHandler)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.redirects = {}
+        self.etags = {}
+        self.last_modified = {}
+        self.truncate = set()
+        self.ignore_range = False
+        self.delay = 0
+        self.requests = []
+        self.request_headers = []
+        self.connections = 0
+        self.active = 0
+        self.max_active = 0
+
+
+class HTTPTestCase(TestCase):
+    """Run a FakeHTTPServer for the duration of each test."""
+
+    def setUp(self):
+        super(HTTPTestCase, self).setUp()
+        self.use_temp_dir()
+        for name in (
+            "http_proxy", "https_proxy", "no_proxy",
+            "HTTP_PROXY", "HTTPS_PROXY", "NO_PROXY"):
+            self.setenv(name, None)
+        self.server = FakeHTTPServer()
+        thread = threading.Thread(
+            target=self.server.serve_forever, kwargs={"poll_interval": 0.01})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.netloc = "127.0.0.1:%d" % self.server.server_address[1]
+        self.downloader = Downloader(timeout=10, retry_delay=0)
+        self.addCleanup(self.downloader.close)
+
+    def setenv(self, name, value):
+        self.addCleanup(self._restore_env, name, os.environ.get(name))
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    def _restore_env(self, name, value):
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+    def url(self, path):
+        return "http://%s%s" % (self.netloc, path)
+
+    def assertFileContents(self, expected, path):
+        with open(path, "rb") as f:
+            self.assertEqual(expected, f.read())
+
+
+class TestDownloader(HTTPTestCase):
+    def test_fetch(self):
+        self.server.files["/a"] = b"contents of a"
+        path = os.path.join(self.temp_dir, "a")
+        self.downloader.fetch(self.url("/a"), path)
+        self.assertFileContents(b"contents of a", path)
+        self.assertEqual(["a"], os.listdir(self.temp_dir))
+
+    def test_fetch_local(self):
+        source = os.path.join(self.temp_dir, "source")
+        touch(source)
+        path = os.path.join(self.temp_dir, "target")
+        self.downloader.fetch(source, path)
+        self.assertEqual(os.stat(source).st_ino, os.stat(path).st_ino)
+
+    def test_not_found(self):
+        path = os.path.join(self.temp_dir, "missing")
+        self.assertRaises(
+            DownloadError, self.downloader.fetch, self.url("/missing"), path)
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_find_proxy(self):
+        self.assertIsNone(find_proxy("http", "cardamom.buildd"))
+        self.setenv("http_proxy", "http://proxy.example:3128/")
+        self.setenv("no_proxy", "localhost,.internal")
+        self.assertEqual(
+            "proxy.example:3128", find_proxy("http", "cardamom.buildd"))
+        self.assertIsNone(find_proxy("https", "cardamom.buildd"))
+        self.assertIsNone(find_proxy("http", "builder.internal"))
+        self.setenv("http_proxy", "proxy.example:8080")
+        self.assertEqual(
+            "proxy.example:8080", find_proxy("http", "cardamom.buildd"))
+
+    def test_proxy(self):
+        self.setenv("http_proxy", "http://%s/" % self.netloc)
+        self.server.files["http://cardamom.buildd/a"] = b"proxied"
+        path = os.path.join(self.temp_dir, "a")
+        self.downloader.fetch("http://cardamom.buildd/a", path)
+        self.assertFileContents(b"proxied", path)
+
+    def test_no_proxy(self):
+        self.setenv("http_proxy", "http://proxy.invalid:3128/")
+        self.setenv("no_proxy", "127.0.0.1")
+        self.server.files["/a"] = b"direct"
+        path = os.path.join(self.temp_dir, "a")
+        self.downloader.fetch(self.url("/a"), path)
+        self.assertFileContents(b"direct", path)
+
+    def test_redirect(self):
+        self.server.files["/stable/file"] = b"redirected"
+        self.server.redirects["/stable"] = "/stable/file"
+        path = os.path.join(self.temp_dir, "file")
+        self.downloader.fetch(self.url("/stable"), path)
+        self.assertFileContents(b"redirected", path)
+
+    def test_keep_alive(self):
+        for name in "abc":
+            self.server.files["/%s" % name] = name.encode("ASCII") * 100
+        for name in "abc":
+            self.downloader.fetch(
+                self.url("/%s" % name), os.path.join(self.temp_dir, name))
+        self.assertEqual(1, self.server.connections)
+        self.assertEqual(
+            1, self.downloader.hosts[("http", self.netloc)].connections)
+
+    def test_resume(self):
+        data = b"".join(b"%d\n" % i for i in range(1000))
+        self.server.files["/big"] = data
+        self.server.truncate.add("/big")
+        path = os.path.join(self.temp_dir, "big")
+        self.downloader.fetch(self.url("/big"), path)
+        self.assertFileContents(data, path)
+        self.assertEqual(
+            [("/big", None), ("/big", "bytes=%d-" % (len(data) // 2))],
+            self.server.requests)
+
+    def test_resume_if_range(self):
+        data = b"x" * 1000
+        self.server.files["/big"] = data
+        self.server.etags["/big"] = '"v1"'
+        self.server.truncate.add("/big")
+        path = os.path.join(self.temp_dir, "big")
+        self.downloader.fetch(self.url("/big"), path)
+        self.assertFileContents(data, path)
+        self.assertEqual('"v1"', self.server.request_headers[1]["if-range"])
+
+    def test_resume_range_ignored(self):
+        data = b"x" * 1000
+        self.server.files["/big"] = data
+        self.server.truncate.add("/big")
+        self.server.ignore_range = True
+        path = os.path.join(self.temp_dir, "big")
+        self.downloader.fetch(self.url("/big"), path)
+        self.assertFileContents(data, path)
+
+    def test_resume_gives_up(self):
+        self.server.files["/big"] = b"x" * 1000
+        self.downloader.retries = 0
+        self.server.truncate.add("/big")
+        path = os.path.join(self.temp_dir, "big")
+        self.assertRaises(
+            DownloadError, self.downloader.fetch, self.url("/big"), path)
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_retry_backoff(self):
+        # Find a port with nothing listening on it.
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.downloader.retries = 2
+        self.downloader.retry_delay = 0.1
+        path = os.path.join(self.temp_dir, "a")
+        start = time.time()
+        self.assertRaises(
+            DownloadError, self.downloader.fetch,
+            "http://127.0.0.1:%d/a" % port, path)
+        # 0.1 seconds, then 0.2 seconds.
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+    def test_connection_limit(self):
+        names = [str(i) for i in range(6)]
+        for name in names:
+            self.server.files["/%s" % name] = b"data"
+        self.server.delay = 0.05
+        self.downloader.connections_per_host = 2
+        pool = ThreadPool(len(names))
+        try:
+            pool.map(
+                lambda name: self.downloader.fetch(
+                    self.url("/%s" % name),
+                    os.path.join(self.temp_dir, name)),
+                names, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(sorted(names), sorted(os.listdir(self.temp_dir)))
+        self.assertEqual(2, self.server.max_active)
+        self.assertEqual(2, self.server.connections)
+
+    def test_log_throughput(self):
+        self.server.files["/a"] = b"a" * 2048
+        self.downloader.fetch(
+            self.url("/a"), os.path.join(self.temp_dir, "a"))
+        self.capture_logging()
+        self.downloader.log_throughput()
+        self.assertEqual(1, len(self.handler.buffer))
+        self.assertRegexpMatches(
+            self.handler.buffer[0].getMessage(),
+            r"^%s: 2\.0 KiB in [0-9.]+ seconds \(.*/s\) over 1 connection$" %
+            re.escape(self.netloc))
+
+    def test_download_jobs(self):
+        config = Config(read=False)
+        self.assertEqual(1, download_jobs(config))
+        self.assertEqual(2, download_connections(config))
+        config["CDIMAGE_DOWNLOAD_JOBS"] = "4"
+        config["CDIMAGE_DOWNLOAD_CONNECTIONS"] = "3"
+        self.assertEqual(4, download_jobs(config))
+        self.assertEqual(3, download_connections(config))
+
+    def test_download_live_filesystems_zero_jobs(self):
+        config = Config(read=False)
+        real_live_fetch_plan = download.live_fetch_plan
+        download.live_fetch_plan = lambda config: []
+        self.addCleanup(
+            setattr, download, "live_fetch_plan", real_live_fetch_plan)
+        self.capture_logging()
+        download_live_filesystems(
+            config, self.temp_dir, jobs=0, downloader=self.downloader)
+
+    def download_plan(self, plan, live=True):
+        config = Config(read=False)
+        if live:
+            config["CDIMAGE_LIVE"] = "1"
+        real_live_fetch_plan = download.live_fetch_plan
+        download.live_fetch_plan = lambda config: plan
+        self.addCleanup(
+            setattr, download, "live_fetch_plan", real_live_fetch_plan)
+        self.capture_logging()
+        download_live_filesystems(
+            config, self.temp_dir, jobs=4, downloader=self.downloader)
+
+    def test_download_live_filesystems(self):
+        for name in ("i386.squashfs", "i386.manifest", "amd64.manifest"):
+            self.server.files["/%s" % name] = name.encode("ASCII")
+        self.download_plan([
+            LiveFetch("i386", "primary", [
+                (self.url("/i386.cloop"), "i386.cloop"),
+                (self.url("/i386.squashfs"), "i386.squashfs")]),
+            LiveFetch("i386", "optional", [
+                (self.url("/i386.manifest"), "i386.manifest")]),
+            LiveFetch("i386", "optional", [
+                (self.url("/i386.size"), "i386.size")]),
+            LiveFetch("amd64", "primary", [
+                (self.url("/amd64.cloop"), "amd64.cloop")]),
+            LiveFetch("amd64", "optional", [
+                (self.url("/amd64.manifest"), "amd64.manifest")]),
+            ])
+        self.assertEqual(
+            ["i386.manifest", "i386.squashfs"],
+            sorted(os.listdir(self.temp_dir)))
+        self.assertNotIn(
+            ("/amd64.manifest", None), self.server.requests)
+
+    def test_download_live_filesystems_no_images(self):
+        self.assertRaisesRegexp(
+            DownloadError, "No filesystem images found",
+            self.download_plan, [
+                LiveFetch("i386", "primary", [
+                    (self.url("/i386.squashfs"), "i386.squashfs")])])
+
+    def test_download_live_filesystems_required(self):
+        self.server.files["/i386.squashfs"] = b"squashfs"
+        self.assertRaisesRegexp(
+            DownloadError, "required live filesystem item for i386",
+            self.download_plan, [
+                LiveFetch("i386", "primary", [
+                    (self.url("/i386.squashfs"), "i386.squashfs")]),
+                LiveFetch("i386", "required", [
+                    (self.url("/i386.ltsp-squashfs"),
+                     "i386.ltsp-squashfs")])])
+
+
+class TestLiveCache(HTTPTestCase):
+    def setUp(self):
+        super(TestLiveCache, self).setUp()
+        self.cache_dir = os.path.join(self.temp_dir, ".live-cache")
+        self.out_dir = os.path.join(self.temp_dir, "live")
+        os.mkdir(self.out_dir)
+        self.cache = LiveCache(self.cache_dir, 1024 * 1024)
+        self.downloader.cache = self.cache
+        self.capture_logging()
+
+    def fetch(self, name, url_path):
+        path = os.path.join(self.out_dir, name)
+        self.downloader.fetch(self.url(url_path), path)
+        return path
+
+    def test_parse_size(self):
+        self.assertEqual(100, parse_size("100"))
+        self.assertEqual(2048, parse_size("2K"))
+        self.assertEqual(3 * 1024 * 1024, parse_size("3m"))
+        self.assertEqual(20 * 1024 ** 3, parse_size("20G"))
+        self.assertRaises(ValueError, parse_size, "")
+
+    def test_live_cache(self):
+        config = Config(read=False)
+        config.root = self.temp_dir
+        self.assertIsNone(live_cache(config))
+        config["CDIMAGE_LIVE_CACHE"] = "0"
+        self.assertIsNone(live_cache(config))
+        config["CDIMAGE_LIVE_CACHE"] = "1G"
+        cache = live_cache(config)
+        self.assertEqual(
+            os.path.join(self.temp_dir, "scratch", ".live-cache"),
+            cache.directory)
+        self.assertEqual(1024 ** 3, cache.budget)
+
+    def test_etag(self):
+        self.server.files["/squashfs"] = b"squashfs"
+        self.server.etags["/squashfs"] = '"v1"'
+        first = self.fetch("daily.squashfs", "/squashfs")
+        second = self.fetch("daily-live.squashfs", "/squashfs")
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertFileContents(b"squashfs", second)
+        self.assertNotIn("if-none-match", self.server.request_headers[0])
+        self.assertEqual(
+            '"v1"', self.server.request_headers[1]["if-none-match"])
+        self.assertLogEqual(
+            ["Using cached copy of %s" % self.url("/squashfs")])
+
+    def test_last_modified(self):
+        self.server.files["/manifest"] = b"manifest"
+        modified = "Mon, 01 Oct 2012 00:00:00 GMT"
+        self.server.last_modified["/manifest"] = modified
+        first = self.fetch("a.manifest", "/manifest")
+        second = self.fetch("b.manifest", "/manifest")
+        self.assertEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertEqual(
+            modified, self.server.request_headers[1]["if-modified-since"])
+
+    def test_changed(self):
+        self.server.files["/squashfs"] = b"old"
+        self.server.etags["/squashfs"] = '"v1"'
+        first = self.fetch("a.squashfs", "/squashfs")
+        self.server.files["/squashfs"] = b"new"
+        self.server.etags["/squashfs"] = '"v2"'
+        second = self.fetch("b.squashfs", "/squashfs")
+        self.assertNotEqual(os.stat(first).st_ino, os.stat(second).st_ino)
+        self.assertFileContents(b"new", second)
+        self.assertEqual(
+            {"ETag": '"v2"'}, self.cache.lookup(self.url("/squashfs")))
+
+    def test_no_validators(self):
+        self.server.files["/size"] = b"1234"
+        self.fetch("a.size", "/size")
+        self.assertIsNone(self.cache.lookup(self.url("/size")))
+        self.fetch("b.size", "/size")
+        self.assertNotIn("if-none-match", self.server.request_headers[1])
+
+    def test_modified_in_place(self):
+        self.server.files["/manifest"] = b"manifest"
+        self.server.etags["/manifest"] = '"v1"'
+        path = self.fetch("a.manifest", "/manifest")
+        with open(path, "ab") as f:
+            f.write(b"local change")
+        self.assertIsNone(self.cache.lookup(self.url("/manifest")))
+        self.assertFileContents(
+            b"manifest", self.fetch("b.manifest", "/manifest"))
+
+    def test_evict(self):
+        self.cache.budget = 250
+        now = time.time()
+        for i, name in enumerate(("old", "middle", "new")):
+            self.server.files["/%s" % name] = b"x" * 100
+            self.server.etags["/%s" % name] = '"%s"' % name
+            self.fetch(name, "/%s" % name)
+            meta = "%s.meta" % self.cache._path(self.url("/%s" % name))
+            os.utime(meta, (now - 100 + i, now - 100 + i))
+        # Using "old" again makes it the most recently used.
+        self.fetch("old-again", "/old")
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.lookup(self.url("/old")))
+        self.assertIsNone(self.cache.lookup(self.url("/middle")))
+        self.assertIsNotNone(self.cache.lookup(self.url("/new")))
+
+    def test_evict_stale_leftovers(self):
+        self.cache.stale_age = 0
+        self.server.files["/squashfs"] = b"squashfs"
+        self.server.etags["/squashfs"] = '"v1"'
+        self.fetch("a.squashfs", "/squashfs")
+        cached = self.cache._path(self.url("/squashfs"))
+        orphan = self.cache._path(self.url("/orphan"))
+        leftovers = [
+            "%s.new.1234" % cached, "%s.meta.abcdef" % cached, orphan]
+        for path in leftovers:
+            touch(path)
+        self.cache.evict()
+        for path in leftovers:
+            self.assertFalse(os.path.exists(path))
+        self.assertIsNotNone(self.cache.lookup(self.url("/squashfs")))
+
+    def test_evict_counts_fresh_leftovers(self):
+        self.cache.budget = 150
+        self.server.files["/squashfs"] = b"x" * 100
+        self.server.etags["/squashfs"] = '"v1"'
+        self.fetch("a.squashfs", "/squashfs")
+        leftover = "%s.new.1234" % self.cache._path(self.url("/other"))
+        with open(leftover, "wb") as f:
+            f.write(b"x" * 100)
+        self.cache.evict()
+        self.assertTrue(os.path.exists(leftover))
+        self.assertIsNone(self.cache.lookup(self.url("/squashfs")))
+
+    def test_evict_removes_lock_files(self):
+        self.cache.budget = 150
+        now = time.time()
+        for i, name in enumerate(("old", "new")):
+            self.server.files["/%s" % name] = b"x" * 100
+            self.server.etags["/%s" % name] = '"%s"' % name
+            self.fetch(name, "/%s" % name)
+            meta = "%s.meta" % self.cache._path(self.url("/%s" % name))
+            os.utime(meta, (now - 100 + i, now - 100 + i))
+        self.assertIsNone(self.cache.lookup(self.url("/old")))
+        self.assertFalse(os.path.exists(
+            "%s.lock" % self.cache._path(self.url("/old"))))
+        self.assertTrue(os.path.exists(
+            "%s.lock" % self.cache._path(self.url("/new"))))
+        self.assertEqual(
+            ["%s%s" % (os.path.basename(self.cache._path(self.url("/new"))),
+                       suffix)
+             for suffix in ("", ".lock", ".meta")],
+            sorted(os.listdir(self.cache_dir)))
+
+    def test_evict_keeps_held_lock_files(self):
+        url = self.url("/squashfs")
+        with self.cache.lock(url):
+            self.cache.evict()
+            self.assertTrue(
+                os.path.exists("%s.lock" % self.cache._path(url)))
+        self.cache.evict()
+        self.assertFalse(os.path.exists("%s.lock" % self.cache._path(url)))
+
+    def test_lock_after_lock_file_removed(self):
+        url = self.url("/squashfs")
+        lock_path = "%s.lock" % self.cache._path(url)
+        with self.cache.lock(url):
+            pass
+        os.unlink(lock_path)
+        with self.cache.lock(url):
+            self.assertTrue(os.path.exists(lock_path))
@@ -22,7 +22,9 @@ __metaclass__ = type
 from cdimage.config import Config, Series
 from cdimage.livefs import (
     flavours,
+    format_live_fetch_plan,
     live_builder,
+    live_fetch_plan,
     live_item_paths,
     live_project,
     livecd_base,
@@ -430,3 +432,95 @@ class TestLiveItemPaths(TestCase):
             self.assertPathsEqual(
                 [path], "i386", "ltsp-squashfs", "edubuntu", series)
         self.assertNoPaths("powerpc", "ltsp-squashfs", "edubuntu", "precise")
+
+
+class TestLiveFetchPlan(TestCase):
+    def setUp(self):
+        super(TestLiveFetchPlan, self).setUp()
+        self.config = Config(read=False)
+
+    def test_no_live(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = Series.find_by_name("quantal")
+        self.config["ARCHES"] = "i386"
+        self.assertEqual([], live_fetch_plan(self.config))
+
+    def test_ubuntu(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = Series.find_by_name("quantal")
+        self.config["ARCHES"] = "i386"
+        self.config["CDIMAGE_LIVE"] = "1"
+        root = "http://cardamom.buildd/~buildd/LiveCD/quantal/ubuntu/current"
+        plan = live_fetch_plan(self.config)
+        self.assertEqual(["i386"], sorted(set(item.arch for item in plan)))
+        self.assertEqual(
+            ("primary", [
+                ("%s/livecd.ubuntu.cloop" % root, "i386.cloop"),
+                ("%s/livecd.ubuntu.squashfs" % root, "i386.squashfs"),
+                ("%s/livecd.ubuntu.rootfs.tar.gz" % root,
+                 "i386.rootfs.tar.gz"),
+                ("%s/livecd.ubuntu.tar.xz" % root, "i386.tar.xz"),
+                ]),
+            (plan[0].policy, plan[0].alternatives))
+        self.assertEqual(
+            ["primary"] + ["optional"] * (len(plan) - 1),
+            [item.policy for item in plan])
+        destinations = [item.alternatives[0][1] for item in plan[1:]]
+        self.assertEqual([
+            "i386.kernel-generic",
+            "i386.initrd-generic",
+            "i386.manifest",
+            "i386.manifest-remove",
+            "i386.size",
+            "i386.wubi.exe",
+            "i386.usb-creator.exe",
+            ], destinations)
+        self.assertEqual(
+            [("%s/livecd.ubuntu.manifest-remove" % root,
+              "i386.manifest-remove"),
+             ("%s/livecd.ubuntu.manifest-desktop" % root,
+              "i386.manifest-desktop")],
+            plan[4].alternatives)
+
+    def test_defaults_locale(self):
+        self.config["PROJECT"] = "ubuntu"
+        self.config["DIST"] = Series.find_by_name("quantal")
+        self.config["ARCHES"] = "i386"
+        self.config["CDIMAGE_LIVE"] = "1"
+        self.config["UBUNTU_DEFAULTS_LOCALE"] = "zh_CN"
+        plan = live_fetch_plan(self.config)
+        self.assertEqual(
+            [("primary", "i386.iso"),
+             ("optional", "i386.kernel-generic"),
+             ("optional", "i386.initrd-generic"),
+             ("optional", "i386.manifest"),
+             ("optional", "i386.manifest-remove"),
+             ("optional", "i386.size")],
+            [(item.policy, item.alternatives[0][1]) for item in plan])
+
+    def test_edubuntu_dvd(self):
+        self.config["PROJECT"] = "edubuntu"
+        self.config["DIST"] = Series.find_by_name("raring")
+        self.config["ARCHES"] = "i386"
+        self.config["CDIMAGE_DVD"] = "1"
+        root = "http://cardamom.buildd/~buildd/LiveCD/raring"
+        self.assertEqual([
+            ("i386", "required", [
+                ("%s/ubuntu-server/current/livecd.ubuntu-server.squashfs" %
+                 root, "i386.server-squashfs")]),
+            ("i386", "required", [
+                ("%s/edubuntu-dvd/current/livecd.edubuntu-dvd-ltsp.squashfs" %
+                 root, "i386.ltsp-squashfs")]),
+            ], live_fetch_plan(self.config))
+
+    def test_format(self):
+        self.config["PROJECT"] = "edubuntu"
+        self.config["DIST"] = Series.find_by_name("hardy")
+        self.config["ARCHES"] = "i386"
+        self.config["CPUARCHES"] = "i386"
+        self.config["CDIMAGE_INSTALL"] = "1"
+        self.assertEqual(
+            ["i386\trequired\t"
+             "http://people.canonical.com/~henrik/winfoss/gutsy/edubuntu/"
+             "current/edubuntu-winfoss-7.10.tar.gz\ti386.winfoss.tgz"],
+            list(format_live_fetch_plan(live_fetch_plan(self.config))))
@@ -0,0 +1,187 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.metalink."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+import hashlib
+import os
+from textwrap import dedent
+
+from cdimage.config import Config
+from cdimage.metalink import (
+    make_metalinks,
+    metalink_name,
+    metalink_xml,
+    read_mirrors,
+    )
+from cdimage.tests.helpers import TestCase
+
+
+class TestMetalink(TestCase):
+    def setUp(self):
+        super(TestMetalink, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config.root = self.temp_dir
+        self.directory = os.path.join(self.temp_dir, "daily-live", "20120807")
+        os.makedirs(self.directory)
+
+    def write_image(self, name, data):
+        with open(os.path.join(self.directory, name), "wb") as image:
+            image.write(data)
+
+    def read_file(self, name):
+        with open(os.path.join(self.directory, name), "rb") as f:
+            return f.read()
+
+    def test_metalink_name(self):
+        self.assertEqual(
+            "quantal-desktop-i386.metalink",
+            metalink_name("quantal-desktop-i386.iso"))
+
+    def test_metalink_xml(self):
+        self.assertEqual(dedent("""\
+            <?xml version="1.0" encoding="utf-8"?>
+            <metalink version="3.0" xmlns="http://www.metalinker.org/" \
+generator="cdimage">
+              <files>
+                <file name="a&amp;b.iso">
+                  <version>12.10</version>
+                  <size>4</size>
+                  <verification>
+                    <hash type="md5">aaaa</hash>
+                    <hash type="sha256">cccc</hash>
+                  </verification>
+                  <resources>
+                    <url type="http" preference="100">http://x/a&amp;b</url>
+                    <url type="ftp" location="gb" preference="100">\
+ftp://y/a&amp;b</url>
+                  </resources>
+                </file>
+              </files>
+            </metalink>
+            """), metalink_xml(
+                "a&b.iso", 4, {"MD5SUMS": "aaaa", "SHA256SUMS": "cccc"},
+                [("http", None, "http://x/a&b"), ("ftp", "gb", "ftp://y/a&b")],
+                version="12.10"))
+
+    def test_make_metalinks(self):
+        self.write_image("quantal-desktop-i386.iso", b"i386")
+        self.write_image("quantal-desktop-i386.iso.torrent", b"torrent")
+        self.write_image("quantal-desktop-amd64.iso", b"amd64")
+        self.write_image("quantal-desktop-amd64.list", b"list")
+        # Digests are taken from existing checksum files where possible.
+        with open(os.path.join(self.directory, "MD5SUMS"), "w") as md5sums:
+            print("%s *quantal-desktop-amd64.iso" % ("0" * 32), file=md5sums)
+        precomputed = {
+            "quantal-desktop-i386.iso": {"SHA1SUMS": "1" * 40},
+            }
+        self.capture_logging()
+        self.assertEqual(
+            ["quantal-desktop-amd64.metalink",
+             "quantal-desktop-i386.metalink"],
+            make_metalinks(
+                self.config, os.path.join(self.temp_dir, "daily-live"),
+                "quantal", "20120807", "cdimage.ubuntu.com",
+                precomputed=precomputed))
+
+        amd64 = self.read_file("quantal-desktop-amd64.metalink")
+        self.assertIn(b'<hash type="md5">%s</hash>' % (b"0" * 32), amd64)
+        self.assertIn(
+            ('<hash type="sha256">%s</hash>' %
+             hashlib.sha256(b"amd64").hexdigest()).encode("UTF-8"),
+            amd64)
+        self.assertIn(
+            b'<url type="http" preference="100">http://cdimage.ubuntu.com/'
+            b'20120807/quantal-desktop-amd64.iso</url>', amd64)
+        self.assertNotIn(b"bittorrent", amd64)
+
+        i386 = self.read_file("quantal-desktop-i386.metalink")
+        self.assertIn(b'<hash type="sha1">%s</hash>' % (b"1" * 40), i386)
+        self.assertIn(
+            b'<url type="bittorrent" preference="100">http://'
+            b'cdimage.ubuntu.com/20120807/quantal-desktop-i386.iso.torrent'
+            b'</url>', i386)
+
+        self.assertEqual(
+            "%s *quantal-desktop-amd64.metalink\n"
+            "%s *quantal-desktop-i386.metalink\n" % (
+                hashlib.md5(amd64).hexdigest(), hashlib.md5(i386).hexdigest()),
+            self.read_file("MD5SUMS-metalink").decode("UTF-8"))
+        self.assertLogEqual(["No keys found; not signing images."])
+
+    def write_mirrors(self):
+        os.mkdir(os.path.join(self.temp_dir, "etc"))
+        with open(
+            os.path.join(self.temp_dir, "etc", "metalink-mirrors"),
+            "w") as mirrors:
+            print(dedent("""\
+                # HOSTNAME LOCATION BASE-URL
+                releases.ubuntu.com us http://us.example.org/releases/
+                releases.ubuntu.com gb ftp://gb.example.org/releases
+                cdimage.ubuntu.com de http://de.example.org/cdimage
+                """), file=mirrors)
+
+    def test_read_mirrors(self):
+        self.assertEqual([], read_mirrors(self.config, "releases.ubuntu.com"))
+        self.write_mirrors()
+        self.assertEqual([
+            ("us", "http://us.example.org/releases"),
+            ("gb", "ftp://gb.example.org/releases"),
+            ], read_mirrors(self.config, "releases.ubuntu.com"))
+
+    def test_make_metalinks_mirrors(self):
+        self.write_mirrors()
+        self.write_image("ubuntu-12.04-desktop-i386.iso", b"i386")
+        self.write_image("ubuntu-12.04-desktop-i386.iso.torrent", b"torrent")
+        self.capture_logging()
+        make_metalinks(
+            self.config, os.path.join(self.temp_dir, "daily-live"),
+            "12.04", "/20120807/", "releases.ubuntu.com", sign=False)
+        metalink = self.read_file("ubuntu-12.04-desktop-i386.metalink")
+        self.assertIn(dedent("""\
+            <resources>
+                    <url type="http" preference="100">\
+http://releases.ubuntu.com/20120807/ubuntu-12.04-desktop-i386.iso</url>
+                    <url type="http" location="us" preference="100">\
+http://us.example.org/releases/20120807/ubuntu-12.04-desktop-i386.iso</url>
+                    <url type="ftp" location="gb" preference="100">\
+ftp://gb.example.org/releases/20120807/ubuntu-12.04-desktop-i386.iso</url>
+                    <url type="bittorrent" preference="100">\
+http://releases.ubuntu.com/20120807/ubuntu-12.04-desktop-i386.iso.torrent\
+</url>
+                  </resources>
+            """).encode("UTF-8"), metalink)
+        self.assertNotIn(b"de.example.org", metalink)
+        self.assertEqual(
+            ["MD5SUMS-metalink", "ubuntu-12.04-desktop-i386.iso",
+             "ubuntu-12.04-desktop-i386.iso.torrent",
+             "ubuntu-12.04-desktop-i386.metalink"],
+            sorted(os.listdir(self.directory)))
+
+    def test_make_metalinks_no_images(self):
+        self.write_image("quantal-desktop-i386.list", b"list")
+        self.assertEqual(
+            [], make_metalinks(
+                self.config, self.temp_dir, "quantal",
+                os.path.join("daily-live", "20120807"), "cdimage.ubuntu.com"))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, "MD5SUMS-metalink")))
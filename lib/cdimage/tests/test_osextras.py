@@ -68,6 +68,31 @@ class TestOSExtras(TestCase):
         new_dir = os.path.join(self.temp_dir, "dir")
         self.assertEqual([], osextras.listdir_force(new_dir))
 
+    def test_scandir(self):
+        touch(os.path.join(self.temp_dir, "file"))
+        os.mkdir(os.path.join(self.temp_dir, "dir"))
+        os.symlink("dir", os.path.join(self.temp_dir, "link"))
+        entries = dict(
+            (entry.name, entry)
+            for entry in osextras.scandir(self.temp_dir))
+        self.assertEqual(["dir", "file", "link"], sorted(entries))
+        self.assertEqual(
+            os.path.join(self.temp_dir, "file"), entries["file"].path)
+        self.assertTrue(entries["file"].is_file())
+        self.assertFalse(entries["file"].is_dir())
+        self.assertTrue(entries["link"].is_dir())
+        self.assertTrue(entries["link"].is_symlink())
+        self.assertEqual(
+            os.stat(os.path.join(self.temp_dir, "dir")).st_ino,
+            entries["link"].stat().st_ino)
+
+    def test_scandir_fallback(self):
+        touch(os.path.join(self.temp_dir, "file"))
+        entry = osextras._DirEntry(self.temp_dir, "file")
+        self.assertIs(entry.stat(), entry.stat())
+        self.assertTrue(entry.is_file())
+        self.assertFalse(entry.is_symlink())
+
     def test_unlink_file_present(self):
         path = os.path.join(self.temp_dir, "file")
         touch(path)
@@ -103,6 +128,13 @@ class TestOSExtras(TestCase):
             env["PATH"] = bin_dir
             self.assertFalse(osextras.find_on_path("program"))
 
+    def test_format_size(self):
+        self.assertEqual("10 B", osextras.format_size(10))
+        self.assertEqual("1.5 KiB", osextras.format_size(1536))
+        self.assertEqual(
+            "700.0 MiB", osextras.format_size(700 * 1024 * 1024))
+        self.assertEqual("2.0 TiB", osextras.format_size(2 * 1024 ** 4))
+
     def test_waitpid_retry(self):
         class Completed(Exception):
             pass
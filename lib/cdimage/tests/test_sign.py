@@ -20,8 +20,14 @@
 import os
 
 from cdimage.config import Config
-from cdimage.sign import _gnupg_files, _signing_command, sign_cdimage
-from cdimage.tests.helpers import TestCase, touch
+from cdimage.sign import (
+    _gnupg_files,
+    _signing_command,
+    sign_cdimage,
+    sign_cdimage_batch,
+    signing_jobs,
+    )
+from cdimage.tests.helpers import FakeSigner, TestCase, touch, use_fake_keys
 
 
 class TestSign(TestCase):
@@ -68,3 +74,39 @@ class TestSign(TestCase):
         self.capture_logging()
         self.assertFalse(sign_cdimage(config, "dummy"))
         self.assertLogEqual(["No keys found; not signing images."])
+
+    def test_signing_jobs(self):
+        config = Config(read=False)
+        self.assertEqual(1, signing_jobs(config))
+        config["CDIMAGE_SIGNING_JOBS"] = "4"
+        self.assertEqual(4, signing_jobs(config))
+        config["CDIMAGE_SIGNING_JOBS"] = "many"
+        self.assertEqual(1, signing_jobs(config))
+
+    def test_sign_cdimage_batch_missing_gnupg_files(self):
+        config = Config(read=False)
+        self.use_temp_dir()
+        config["GNUPG_DIR"] = self.temp_dir
+        config["SIGNING_KEYID"] = "01234567"
+        self.capture_logging()
+        signer = FakeSigner()
+        self.assertIsNone(
+            sign_cdimage_batch(config, ["1", "2"], signer=signer))
+        self.assertEqual([], signer.signed)
+        self.assertLogEqual(["No keys found; not signing images."])
+
+    def test_sign_cdimage_batch(self):
+        config = Config(read=False)
+        self.use_temp_dir()
+        use_fake_keys(config, self.temp_dir)
+        paths = [os.path.join(self.temp_dir, str(i)) for i in range(5)]
+        for path in paths:
+            touch(path)
+        for jobs in 1, 3:
+            signer = FakeSigner()
+            timings = sign_cdimage_batch(
+                config, paths, jobs=jobs, signer=signer)
+            self.assertEqual(paths, [path for path, _ in timings])
+            self.assertEqual(paths, sorted(signer.signed))
+            for path in paths:
+                self.assertTrue(os.path.exists("%s.gpg" % path))
@@ -0,0 +1,80 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.timing."""
+
+__metaclass__ = type
+
+import json
+import os
+
+from cdimage.tests.helpers import TestCase
+from cdimage.timing import StageTimer
+
+
+class TestStageTimer(TestCase):
+    def test_stage(self):
+        timer = StageTimer()
+        with timer.stage("move", arch="i386", nbytes=10):
+            pass
+        with timer.stage("zsync", arch="i386") as record:
+            record["bytes"] = 20
+        self.assertEqual(
+            [("move", "i386", 10), ("zsync", "i386", 20)],
+            [(record["stage"], record["arch"], record["bytes"])
+             for record in timer.records])
+        for record in timer.records:
+            self.assertGreaterEqual(record["wall"], 0)
+            self.assertGreaterEqual(record["cpu"], 0)
+
+    def test_stage_records_failure(self):
+        timer = StageTimer()
+        try:
+            with timer.stage("post-qa"):
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(["post-qa"], [r["stage"] for r in timer.records])
+
+    def test_summary(self):
+        timer = StageTimer()
+        for arch, nbytes in (("amd64", 1), ("i386", 2)):
+            with timer.stage("move", arch=arch, nbytes=nbytes):
+                pass
+        with timer.stage("checksums", nbytes=3):
+            pass
+        summary = timer.summary()
+        self.assertEqual(
+            [("move", 2, 3), ("checksums", 1, 3)],
+            [(total["stage"], total["count"], total["bytes"])
+             for total in summary])
+
+    def test_write(self):
+        self.use_temp_dir()
+        timer = StageTimer()
+        with timer.stage("new_publish_dir"):
+            pass
+        path = os.path.join(self.temp_dir, "log", "daily-live.timings.json")
+        timer.write(path, date="20120807")
+        with open(path) as timings:
+            data = json.load(timings)
+        self.assertEqual("20120807", data["date"])
+        self.assertEqual(
+            ["new_publish_dir"], [r["stage"] for r in data["records"]])
+        self.assertEqual(
+            ["new_publish_dir"], [t["stage"] for t in data["stages"]])
+        self.assertFalse(os.path.exists("%s.new" % path))
@@ -0,0 +1,218 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.torrent."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+import hashlib
+import os
+
+from cdimage import checksums
+from cdimage.checksums import ChecksumCache, checksum_directory
+from cdimage.config import Config
+from cdimage.tests.helpers import TestCase
+from cdimage.torrent import (
+    bencode,
+    make_torrents,
+    TorrentGenerator,
+    torrent_file,
+    torrent_piece_length,
+    )
+
+
+class TestHelpers(TestCase):
+    def test_bencode(self):
+        self.assertEqual(b"i42e", bencode(42))
+        self.assertEqual(b"i-3e", bencode(-3))
+        self.assertEqual(b"4:spam", bencode(b"spam"))
+        self.assertEqual(b"4:spam", bencode(u"spam"))
+        self.assertEqual(b"l4:spami42ee", bencode([b"spam", 42]))
+        self.assertEqual(
+            b"d3:bar4:spam3:fooi42ee", bencode({"foo": 42, "bar": b"spam"}))
+        self.assertRaises(TypeError, bencode, 1.5)
+
+    def test_piece_length(self):
+        self.assertEqual(2 ** 15, torrent_piece_length(1024 * 1024))
+        self.assertEqual(2 ** 19, torrent_piece_length(700 * 1024 * 1024))
+        self.assertEqual(
+            2 ** 20, torrent_piece_length(4 * 1024 * 1024 * 1024))
+
+
+class TestTorrentGenerator(TestCase):
+    def setUp(self):
+        super(TestTorrentGenerator, self).setUp()
+        self.use_temp_dir()
+
+    def test_pieces(self):
+        data = os.urandom(10000)
+        generator = TorrentGenerator(len(data), piece_length=4096)
+        for offset in range(0, len(data), 3001):
+            generator.update(data[offset:offset + 3001])
+        generator.finish()
+        self.assertEqual([
+            hashlib.sha1(data[:4096]).digest(),
+            hashlib.sha1(data[4096:8192]).digest(),
+            hashlib.sha1(data[8192:]).digest(),
+            ], generator.pieces)
+
+    def test_short_read(self):
+        generator = TorrentGenerator(10)
+        generator.update(b"x" * 5)
+        self.assertRaises(ValueError, generator.finish)
+
+    def test_metainfo(self):
+        data = b"x" * 100
+        generator = TorrentGenerator(len(data))
+        generator.update(data)
+        self.assertEqual({
+            "announce": "http://tracker/announce",
+            "announce-list": [["http://tracker/announce"], ["http://t6/"]],
+            "comment": "Ubuntu CD releases.ubuntu.com",
+            "creation date": 1347969600,
+            "info": {
+                "length": 100,
+                "name": "test.iso",
+                "piece length": 2 ** 15,
+                "pieces": hashlib.sha1(data).digest(),
+                },
+            }, generator.metainfo(
+                "test.iso", "http://tracker/announce",
+                announce_list=[["http://tracker/announce"], ["http://t6/"]],
+                comment="Ubuntu CD releases.ubuntu.com",
+                creation_date=1347969600))
+
+    def test_torrent_file_shares_read(self):
+        path = os.path.join(self.temp_dir, "test.iso")
+        data = os.urandom(10000)
+        with open(path, "wb") as image:
+            image.write(data)
+        md5 = hashlib.md5()
+        torrent_file(
+            path, "%s.torrent" % path, "http://tracker/announce",
+            comment="Ubuntu CD cdimage.ubuntu.com", hash_objs=[md5])
+        self.assertEqual(hashlib.md5(data).hexdigest(), md5.hexdigest())
+        with open("%s.torrent" % path, "rb") as torrent:
+            metafile = torrent.read()
+        self.assertTrue(metafile.startswith(
+            b"d8:announce23:http://tracker/announce"
+            b"7:comment28:Ubuntu CD cdimage.ubuntu.com13:creation datei"))
+        self.assertTrue(metafile.endswith(
+            b"4:infod6:lengthi10000e4:name8:test.iso"
+            b"12:piece lengthi32768e6:pieces20:" +
+            hashlib.sha1(data).digest() + b"ee"))
+
+
+class TestMakeTorrents(TestCase):
+    def setUp(self):
+        super(TestMakeTorrents, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config.root = self.temp_dir
+        self.config["CAPPROJECT"] = "Ubuntu"
+        self.directory = os.path.join(self.temp_dir, "release")
+        os.mkdir(self.directory)
+        for name in (
+            "ubuntu-12.04-desktop-i386.iso",
+            "ubuntu-12.04-desktop-amd64.iso",
+            "ubuntu-12.04-desktop-i386.list",
+            "ubuntu-12.04-server-i386.iso",
+            ):
+            with open(os.path.join(self.directory, name), "wb") as image:
+                image.write(name.encode("UTF-8"))
+
+    def read_torrent(self, name):
+        with open(os.path.join(self.directory, name), "rb") as torrent:
+            return torrent.read()
+
+    def test_make_torrents(self):
+        self.capture_logging()
+        make_torrents(self.config, self.directory, "ubuntu-12.04-desktop")
+        self.assertEqual([
+            "MD5SUMS",
+            "SHA1SUMS",
+            "SHA256SUMS",
+            "ubuntu-12.04-desktop-amd64.iso",
+            "ubuntu-12.04-desktop-amd64.iso.torrent",
+            "ubuntu-12.04-desktop-i386.iso",
+            "ubuntu-12.04-desktop-i386.iso.torrent",
+            "ubuntu-12.04-desktop-i386.list",
+            "ubuntu-12.04-server-i386.iso",
+            ], sorted(os.listdir(self.directory)))
+        self.assertLogEqual([
+            "Creating torrent for %s/ubuntu-12.04-desktop-%s.iso ..." % (
+                self.directory, arch)
+            for arch in ("amd64", "i386")] +
+            ["No keys found; not signing images."])
+        metafile = self.read_torrent("ubuntu-12.04-desktop-i386.iso.torrent")
+        self.assertIn(b"7:comment28:Ubuntu CD cdimage.ubuntu.com", metafile)
+        self.assertNotIn(b"announce-list", metafile)
+
+    def test_make_torrents_releases(self):
+        self.capture_logging()
+        make_torrents(
+            self.config, self.directory, "ubuntu-12.04-server",
+            "releases.ubuntu.com")
+        metafile = self.read_torrent("ubuntu-12.04-server-i386.iso.torrent")
+        self.assertIn(b"7:comment29:Ubuntu CD releases.ubuntu.com", metafile)
+        self.assertIn(
+            b"13:announce-listll39:http://torrent.ubuntu.com:6969/announce"
+            b"el44:http://ipv6.torrent.ubuntu.com:6969/announceee",
+            metafile)
+
+    def test_make_torrents_fills_checksum_cache(self):
+        self.config["CDIMAGE_CHECKSUM_CACHE"] = "1"
+        os.mkdir(os.path.join(self.temp_dir, "etc"))
+        self.capture_logging()
+        make_torrents(self.config, self.directory, "ubuntu-12.04-server")
+        cache = ChecksumCache(self.config)
+        cache.read()
+        path = os.path.join(self.directory, "ubuntu-12.04-server-i386.iso")
+        data = b"ubuntu-12.04-server-i386.iso"
+        self.assertEqual(
+            hashlib.sha256(data).hexdigest(), cache.lookup(path, "sha256"))
+        self.assertEqual(
+            hashlib.md5(data).hexdigest(), cache.lookup(path, "md5"))
+
+    def test_make_torrents_shares_read_with_checksums(self):
+        self.capture_logging()
+        with open(os.path.join(self.directory, "SHA256SUMS"), "w") as sums:
+            print("%s *ubuntu-12.04-server-i386.iso" % ("0" * 64), file=sums)
+            print("%s *other.iso" % ("1" * 64), file=sums)
+        make_torrents(self.config, self.directory, "ubuntu-12.04-server")
+
+        # checksum-directory now merges the digests rather than reading
+        # the image again.
+        def update_hashes(path, hash_objs):
+            self.assertNotIn("ubuntu-12.04-server-i386.iso", path)
+            return real_update_hashes(path, hash_objs)
+
+        real_update_hashes = checksums._update_hashes
+        self.addCleanup(
+            setattr, checksums, "_update_hashes", real_update_hashes)
+        checksums._update_hashes = update_hashes
+        checksum_directory(self.config, self.directory, jobs=1)
+        data = b"ubuntu-12.04-server-i386.iso"
+        for name, hash_method in (
+            ("MD5SUMS", hashlib.md5), ("SHA256SUMS", hashlib.sha256),
+            ):
+            with open(os.path.join(self.directory, name)) as sums:
+                self.assertIn(
+                    "%s *ubuntu-12.04-server-i386.iso\n" %
+                    hash_method(data).hexdigest(), sums.read())
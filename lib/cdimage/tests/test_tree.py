@@ -21,13 +21,112 @@ from __future__ import print_function
 
 __metaclass__ = type
 
+import gzip
+import hashlib
+import io
+import datetime
+import errno
 import os
+import tarfile
 from textwrap import dedent
 
 from cdimage.config import all_series, Config, Series
 from cdimage import osextras
+from cdimage.osextras import format_size
 from cdimage.tests.helpers import TestCase, touch
-from cdimage.tree import DailyTree, DailyTreePublisher, SimpleTree, Tree
+from cdimage import tree
+from cdimage.tree import (
+    DailyManifestIndex,
+    DailyTree,
+    DailyTreePublisher,
+    publish_jobs,
+    purge_jobs,
+    purge_usage,
+    SimpleTree,
+    sniff_image,
+    Tree,
+    )
+
+
+def make_iso(path, size=65536):
+    with open(path, "wb") as iso:
+        iso.write(b"\0" * 32768 + b"\x01CD001\x01")
+        iso.truncate(size)
+
+
+def make_boot_sector(path):
+    with open(path, "wb") as img:
+        img.write(b"\0" * 510 + b"\x55\xaa")
+
+
+def make_tar(path):
+    with tarfile.open(path, "w") as tar:
+        info = tarfile.TarInfo("hello")
+        data = b"hello\n"
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def gzip_file(path, target):
+    with open(path, "rb") as uncompressed:
+        with gzip.GzipFile(target, "wb") as compressed:
+            compressed.write(uncompressed.read())
+
+
+class TestSniffImage(TestCase):
+    def setUp(self):
+        super(TestSniffImage, self).setUp()
+        self.use_temp_dir()
+        self.path = os.path.join(self.temp_dir, "image")
+
+    def test_empty(self):
+        touch(self.path)
+        self.assertEqual(("empty", None), sniff_image(self.path))
+
+    def test_data(self):
+        with open(self.path, "wb") as image:
+            image.write(b"\1" * 1024)
+        self.assertEqual(("data", None), sniff_image(self.path))
+
+    def test_iso(self):
+        make_iso(self.path)
+        self.assertEqual(("iso", None), sniff_image(self.path))
+
+    def test_hybrid_iso(self):
+        make_iso(self.path)
+        with open(self.path, "r+b") as image:
+            image.seek(510)
+            image.write(b"\x55\xaa")
+        self.assertEqual(("iso", None), sniff_image(self.path))
+
+    def test_boot_sector(self):
+        make_boot_sector(self.path)
+        self.assertEqual(("boot", None), sniff_image(self.path))
+
+    def test_tar(self):
+        make_tar(self.path)
+        self.assertEqual(("tar", None), sniff_image(self.path))
+
+    def test_gzip(self):
+        for make, expected in (
+            (make_iso, "iso"), (make_boot_sector, "boot"),
+            (make_tar, "tar")):
+            make(self.path)
+            gzip_file(self.path, "%s.gz" % self.path)
+            self.assertEqual(
+                ("gzip", expected), sniff_image("%s.gz" % self.path))
+
+    def test_gzip_large(self):
+        # Only the start of the stream is decompressed.
+        with open(self.path, "wb") as image:
+            image.write(os.urandom(1024 * 1024))
+        gzip_file(self.path, "%s.gz" % self.path)
+        self.assertEqual(("gzip", "data"), sniff_image("%s.gz" % self.path))
+
+    def test_gzip_corrupt(self):
+        with open(self.path, "wb") as image:
+            image.write(b"\x1f\x8b\x08\0\0\0\0\0\0\x03" + b"\xff" * 64)
+        self.assertEqual(("gzip", "data"), sniff_image(self.path))
 
 
 class TestTree(TestCase):
@@ -102,6 +201,103 @@ class TestDailyTree(TestCase):
             ["daily/current/warty-install-i386.iso"],
             list(self.tree.manifest_files()))
 
+    def test_manifest_files_nested_current(self):
+        daily = os.path.join(self.temp_dir, "kubuntu", "hoary", "daily")
+        os.makedirs(os.path.join(daily, "20120806", "source"))
+        os.symlink("20120806", os.path.join(daily, "current"))
+        touch(os.path.join(
+            daily, "20120806", "source", "hoary-src-1.iso"))
+        self.assertEqual(
+            ["kubuntu/hoary/daily/current/source/hoary-src-1.iso"],
+            list(self.tree.manifest_files()))
+
+    def test_manifest_files_prunes_siblings_of_current(self):
+        daily = os.path.join(self.temp_dir, "daily")
+        os.makedirs(os.path.join(daily, "20120806", "current"))
+        os.makedirs(os.path.join(daily, "20120807"))
+        os.symlink("20120807", os.path.join(daily, "current"))
+        touch(os.path.join(daily, "20120806", "current", "warty-old.iso"))
+        touch(os.path.join(daily, "20120807", "warty-install-i386.iso"))
+        self.assertEqual(
+            ["daily/current/warty-install-i386.iso"],
+            list(self.tree.manifest_files()))
+
+    def test_manifest_files_walks_other_siblings_of_current(self):
+        daily = os.path.join(self.temp_dir, "daily")
+        os.makedirs(os.path.join(daily, "20120806"))
+        os.symlink("20120806", os.path.join(daily, "current"))
+        os.makedirs(os.path.join(daily, "wubi", "20120806"))
+        os.symlink("20120806", os.path.join(daily, "wubi", "current"))
+        touch(os.path.join(daily, "20120806", "warty-install-i386.iso"))
+        touch(os.path.join(daily, "wubi", "20120806", "warty-wubi.tar.xz"))
+        self.assertEqual([
+            "daily/current/warty-install-i386.iso",
+            "daily/wubi/current/warty-wubi.tar.xz",
+            ], list(self.tree.manifest_files()))
+
+    def baseline_manifest_files(self):
+        # The os.walk implementation that _walk_manifest replaced.
+        seen_inodes = []
+        for dirpath, dirnames, filenames in os.walk(
+            self.tree.directory, followlinks=True):
+            st = os.stat(dirpath)
+            seen_inodes.append((st.st_dev, st.st_ino))
+            for i in range(len(dirnames) - 1, -1, -1):
+                st = os.stat(os.path.join(dirpath, dirnames[i]))
+                if (st.st_dev, st.st_ino) in seen_inodes:
+                    del dirnames[i]
+            if "current" in dirpath.split(os.sep):
+                relative_dirpath = dirpath[len(self.tree.directory) + 1:]
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    if self.tree.manifest_file_allowed(path):
+                        yield os.path.join(relative_dirpath, filename)
+
+    def test_manifest_files_matches_baseline(self):
+        # The baseline's loop detection remembered every directory it had
+        # walked, so it dropped subdirectories of a dated build reached
+        # through "current" whenever it happened to list the dated build
+        # first.  Only real "current" directories have subdirectories here
+        # to keep clear of that.
+        layout = {
+            "daily": ["20120805", "20120806"],
+            "daily-live": ["20120806"],
+            "kubuntu/hoary/daily": ["20120806"],
+            "kubuntu/hoary/daily/wubi": ["20120806"],
+            "ubuntu-server/daily": ["20120806.1"],
+            }
+        for publish_base, dates in layout.items():
+            for date in dates:
+                date_dir = os.path.join(self.temp_dir, publish_base, date)
+                os.makedirs(date_dir)
+                touch(os.path.join(date_dir, "hoary-%s.iso" % date))
+                touch(os.path.join(date_dir, "hoary-%s.list" % date))
+            current = os.path.join(self.temp_dir, publish_base, "current")
+            os.symlink(dates[-1], current)
+        for publish_base in ("edubuntu/daily", "kubuntu/hoary/daily-live"):
+            source = os.path.join(
+                self.temp_dir, publish_base, "current", "source")
+            os.makedirs(source)
+            touch(os.path.join(source, "hoary-src-1.iso"))
+            touch(os.path.join(source, "hoary-src-1.jigdo"))
+        os.makedirs(os.path.join(self.temp_dir, "daily", "pending"))
+        touch(os.path.join(self.temp_dir, "daily", "pending", "hoary.iso"))
+        os.symlink(
+            "..", os.path.join(self.temp_dir, "daily", "20120806", "loop"))
+        expected = sorted(self.baseline_manifest_files())
+        self.assertEqual(7, len(expected))
+        self.assertEqual(expected, sorted(self.tree.manifest_files()))
+
+    def test_manifest_files_detects_loops(self):
+        daily = os.path.join(self.temp_dir, "daily")
+        os.makedirs(os.path.join(daily, "20120806"))
+        os.symlink("20120806", os.path.join(daily, "current"))
+        os.symlink("..", os.path.join(daily, "20120806", "loop"))
+        touch(os.path.join(daily, "20120806", "warty-install-i386.iso"))
+        self.assertEqual(
+            ["daily/current/warty-install-i386.iso"],
+            list(self.tree.manifest_files()))
+
     def test_manifest(self):
         daily = os.path.join(self.temp_dir, "daily")
         os.makedirs(os.path.join(daily, "20120806"))
@@ -117,6 +313,94 @@ class TestDailyTree(TestCase):
             ], self.tree.manifest())
 
 
+class TestDailyManifestIndex(TestCase):
+    def setUp(self):
+        super(TestDailyManifestIndex, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.tree = DailyTree(self.config, self.temp_dir)
+        self.index = DailyManifestIndex(self.tree)
+
+    def publish(self, image_type, date, name):
+        publish_base = os.path.join(self.temp_dir, image_type)
+        osextras.ensuredir(os.path.join(publish_base, date))
+        touch(os.path.join(publish_base, date, name))
+        current = os.path.join(publish_base, "current")
+        osextras.unlink_force(current)
+        os.symlink(date, current)
+        return "%s/current" % image_type
+
+    def test_current_dir(self):
+        self.assertEqual(
+            "kubuntu/daily/current",
+            DailyManifestIndex.current_dir(
+                "kubuntu/daily/current/source/hoary-src-1.iso"))
+
+    def test_rebuild_matches_manifest(self):
+        self.publish("daily", "20120806", "hoary-install-i386.iso")
+        self.publish("daily-live", "20120806", "hoary-live-i386.iso")
+        self.index.rebuild()
+        self.assertEqual(self.tree.manifest(), self.index.manifest())
+
+    def test_read_missing(self):
+        self.assertFalse(self.index.read())
+
+    def test_read_corrupt(self):
+        with open(self.index.path, "w") as index:
+            print("garbage", file=index)
+        self.capture_logging()
+        self.assertFalse(self.index.read())
+        self.assertLogEqual(
+            ["Corrupt manifest index %s; rebuilding" % self.index.path])
+
+    def test_write_read(self):
+        self.publish("daily", "20120806", "hoary-install-i386.iso")
+        self.index.rebuild()
+        self.index.write()
+        other = DailyManifestIndex(self.tree)
+        self.assertTrue(other.read())
+        self.assertEqual(self.index.entries, other.entries)
+
+    def test_update_only_walks_current(self):
+        self.publish("daily", "20120806", "hoary-install-i386.iso")
+        current = self.publish(
+            "daily-live", "20120806", "hoary-live-i386.iso")
+        self.index.rebuild()
+        self.publish("daily", "20120807", "hoary-alternate-i386.iso")
+        self.publish("daily-live", "20120807", "hoary-desktop-i386.iso")
+        self.index.update(current)
+        self.assertEqual([
+            "ubuntu\thoary\t/daily-live/current/hoary-desktop-i386.iso\t0",
+            "ubuntu\thoary\t/daily/current/hoary-install-i386.iso\t0",
+            ], self.index.manifest())
+        self.assertEqual(
+            (["ubuntu\thoary\t/daily/current/hoary-alternate-i386.iso\t0"],
+             ["ubuntu\thoary\t/daily/current/hoary-install-i386.iso\t0"]),
+            self.index.check())
+
+    def test_update_drops_removed_current(self):
+        old_current = self.publish(
+            "daily", "20120806", "hoary-install-i386.iso")
+        current = self.publish(
+            "daily-live", "20120806", "hoary-live-i386.iso")
+        self.index.rebuild()
+        os.unlink(os.path.join(self.temp_dir, old_current))
+        self.index.update(current)
+        self.assertEqual(
+            ["ubuntu\thoary\t/daily-live/current/hoary-live-i386.iso\t0"],
+            self.index.manifest())
+        self.assertEqual(([], []), self.index.check())
+
+    def test_write_manifest(self):
+        self.publish("daily", "20120806", "hoary-install-i386.iso")
+        self.index.rebuild()
+        self.index.write_manifest()
+        with open(os.path.join(self.temp_dir, ".manifest-daily")) as f:
+            self.assertEqual(
+                "ubuntu\thoary\t/daily/current/hoary-install-i386.iso\t0\n",
+                f.read())
+
+
 class TestDailyTreePublisher(TestCase):
     def setUp(self):
         super(TestDailyTreePublisher, self).setUp()
@@ -155,6 +439,9 @@ class TestDailyTreePublisher(TestCase):
         self.assertEqual(
             os.path.join(self.config.root, "www", "full", "kubuntu"),
             self.make_publisher("kubuntu", "daily").full_tree)
+        self.assertEqual(
+            os.path.join(self.config.root, "www", "full"),
+            self.make_publisher("livecd-base", "livecd-base").full_tree)
 
     def test_image_type_dir(self):
         publisher = self.make_publisher("ubuntu", "daily-live")
@@ -368,6 +655,91 @@ class TestDailyTreePublisher(TestCase):
             "%s-desktop-i386.manifest" % self.config.series,
             ], sorted(os.listdir(target_dir)))
 
+    def test_publish_binary_records_stages(self):
+        publisher = self.make_publisher(
+            "ubuntu", "daily-live", try_zsyncmake=False)
+        source_dir = os.path.join(publisher.image_output, "i386")
+        os.mkdir(source_dir)
+        make_iso(os.path.join(
+            source_dir, "%s-desktop-i386.raw" % self.config.series))
+        list(publisher.publish_binary("desktop", "i386", "20120807"))
+        self.assertEqual(
+            [("detect", "i386", 0), ("move", "i386", 65536)],
+            [(record["stage"], record["arch"], record["bytes"])
+             for record in publisher.timer.records])
+
+    def test_publish_jobs(self):
+        self.assertEqual(1, publish_jobs(self.config))
+        self.config["CDIMAGE_PUBLISH_JOBS"] = "3"
+        self.assertEqual(3, publish_jobs(self.config))
+        self.config["CDIMAGE_PUBLISH_JOBS"] = "bogus"
+        self.assertEqual(1, publish_jobs(self.config))
+
+    def test_publish_binaries_parallel(self):
+        self.config["ARCHES"] = "amd64 armhf i386 powerpc"
+        publisher = self.make_publisher(
+            "ubuntu", "daily-live", try_zsyncmake=False)
+        for arch in ("amd64", "armhf", "powerpc"):
+            source_dir = os.path.join(publisher.image_output, arch)
+            os.mkdir(source_dir)
+            make_iso(os.path.join(
+                source_dir, "%s-desktop-%s.raw" % (self.config.series, arch)))
+        target_dir = os.path.join(publisher.publish_base, "20120807")
+        os.makedirs(target_dir)
+        self.capture_logging()
+        published = publisher.publish_binaries("desktop", "20120807", jobs=4)
+        self.assertEqual([
+            "ubuntu/daily-live/%s-desktop-%s" % (self.config.series, arch)
+            for arch in ("amd64", "armhf", "powerpc")], published)
+        self.assertEqual([
+            os.path.join(publisher.image_output, arch)
+            for arch in ("amd64", "armhf", "powerpc")],
+            publisher.checksum_dirs)
+        self.assertEqual(sorted([
+            "%s-desktop-%s.iso" % (self.config.series, arch)
+            for arch in ("amd64", "armhf", "powerpc")]),
+            sorted(os.listdir(target_dir)))
+
+    def test_detect_image_extension(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        prefix = os.path.join(self.temp_dir, "image")
+        make_iso("%s.raw" % prefix)
+        self.assertEqual("iso", publisher.detect_image_extension(prefix))
+        make_boot_sector("%s.raw" % prefix)
+        self.assertEqual("img", publisher.detect_image_extension(prefix))
+        make_tar(prefix)
+        gzip_file(prefix, "%s.raw" % prefix)
+        self.assertEqual("tar.gz", publisher.detect_image_extension(prefix))
+
+    def test_detect_image_extension_type_file(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        prefix = os.path.join(self.temp_dir, "image")
+        with open(prefix, "wb") as image:
+            image.write(b"\1" * 1024)
+        gzip_file(prefix, "%s.raw" % prefix)
+        self.capture_logging()
+        self.assertEqual("img.gz", publisher.detect_image_extension(prefix))
+        self.assertLogEqual([
+            "Unknown compressed file type 'data'; assuming .img.gz",
+            ])
+        with open("%s.type" % prefix, "w") as type_file:
+            print("tar archive", file=type_file)
+        self.assertEqual("tar.gz", publisher.detect_image_extension(prefix))
+
+    def test_make_zsync_shares_read(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        self.addCleanup(setattr, tree, "native_zsync_fast",
+                        tree.native_zsync_fast)
+        tree.native_zsync_fast = lambda: True
+        target = os.path.join(self.temp_dir, "test.iso")
+        with open(target, "wb") as image:
+            image.write(b"image")
+        publisher.make_zsync(target, "test.iso")
+        self.assertTrue(os.path.exists("%s.zsync" % target))
+        self.assertEqual(
+            hashlib.sha256(b"image").hexdigest(),
+            publisher.precomputed_checksums["test.iso"]["SHA256SUMS"])
+
     def test_publish_source(self):
         publisher = self.make_publisher(
             "ubuntu", "daily-live", try_zsyncmake=False)
@@ -419,11 +791,8 @@ class TestDailyTreePublisher(TestCase):
             source_dir, "%s-desktop-i386.manifest" % self.config.series))
         touch(os.path.join(
             publisher.britney_report, "%s_probs.html" % self.config.series))
-        # TODO: until make-web-indices is converted to Python
         bin_dir = os.path.join(self.config.root, "bin")
         os.mkdir(bin_dir)
-        os.symlink("/bin/true", os.path.join(bin_dir, "make-web-indices"))
-        os.symlink("/bin/true", os.path.join(bin_dir, "make-metalink"))
         os.symlink("/bin/true", os.path.join(bin_dir, "post-qa"))
         os.mkdir(os.path.join(self.config.root, "etc"))
         self.capture_logging()
@@ -438,16 +807,187 @@ class TestDailyTreePublisher(TestCase):
         target_dir = os.path.join(publisher.publish_base, "20120807")
         self.assertEqual([], os.listdir(source_dir))
         self.assertEqual(sorted([
+            ".htaccess",
+            "FOOTER.html",
+            "HEADER.html",
             "MD5SUMS",
+            "MD5SUMS-metalink",
             "SHA1SUMS",
             "SHA256SUMS",
             "%s-desktop-i386.iso" % self.config.series,
             "%s-desktop-i386.list" % self.config.series,
             "%s-desktop-i386.manifest" % self.config.series,
+            "%s-desktop-i386.metalink" % self.config.series,
             "report.html",
             ]), sorted(os.listdir(target_dir)))
 
 
+    def test_purge_days(self):
+        publisher = self.make_publisher("ubuntu", "daily")
+        self.assertIsNone(publisher.purge_days("daily"))
+        os.mkdir(os.path.join(self.config.root, "etc"))
+        with open(os.path.join(
+                self.config.root, "etc", "purge-days"), "w") as purge_days:
+            print(dedent("""\
+                daily 1
+                # Comment.
+                tocd3/daily-live 0
+                ubuntu-netbook 3"""), file=purge_days)
+        self.assertEqual(1, publisher.purge_days("daily"))
+        self.assertEqual(0, publisher.purge_days("tocd3/daily-live"))
+        self.assertIsNone(publisher.purge_days("daily-live"))
+
+    def test_purge_jobs(self):
+        self.assertEqual(1, purge_jobs(self.config))
+        self.config["CDIMAGE_PURGE_JOBS"] = "4"
+        self.assertEqual(4, purge_jobs(self.config))
+
+    def test_purge_usage(self):
+        old = os.path.join(self.temp_dir, "old")
+        new = os.path.join(self.temp_dir, "new")
+        os.makedirs(os.path.join(old, "source"))
+        os.mkdir(new)
+        with open(os.path.join(old, "shared.iso"), "wb") as shared:
+            shared.write(b"\1" * 65536)
+        os.link(os.path.join(old, "shared.iso"),
+                os.path.join(new, "shared.iso"))
+        with open(os.path.join(old, "source", "only.iso"), "wb") as only:
+            only.write(b"\1" * 8192)
+        os.link(os.path.join(old, "source", "only.iso"),
+                os.path.join(old, "only.iso"))
+
+        def usage(path):
+            return os.lstat(path).st_blocks * 512
+
+        only_usage = usage(os.path.join(old, "only.iso"))
+        shared_usage = usage(os.path.join(old, "shared.iso"))
+        dirs_usage = usage(old) + usage(os.path.join(old, "source"))
+        # A file with all its links inside the purged set is freed, and
+        # counted once; a file also linked from "new" is not freed.
+        self.assertEqual(
+            (dirs_usage + only_usage + shared_usage, dirs_usage + only_usage),
+            purge_usage([old]))
+        dirs_usage += usage(new)
+        self.assertEqual(
+            (dirs_usage + only_usage + shared_usage,
+             dirs_usage + only_usage + shared_usage),
+            purge_usage([old, new]))
+
+    def make_dated_dirs(self, publisher, days_ago):
+        names = []
+        for days in days_ago:
+            name = (datetime.date.today() -
+                    datetime.timedelta(days=days)).strftime("%Y%m%d")
+            path = os.path.join(publisher.publish_base, name)
+            os.makedirs(path)
+            with open(os.path.join(path, "image.iso"), "wb") as image:
+                image.write(name.encode("UTF-8"))
+            names.append(name)
+        return names
+
+    def test_purge_candidates(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        names = self.make_dated_dirs(publisher, [5, 4, 3, 2, 1])
+        os.symlink(names[0], os.path.join(publisher.publish_base, "current"))
+        os.mkdir(os.path.join(publisher.publish_base, "pending"))
+        touch(os.path.join(publisher.publish_base, "20000101"))
+        self.assertEqual(names[1:3], publisher.purge_candidates(2))
+
+    def test_purge(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        names = self.make_dated_dirs(publisher, [3, 2, 1, 0])
+        os.symlink(names[3], os.path.join(publisher.publish_base, "current"))
+        # The newest image is carried over from the oldest build.
+        os.unlink(os.path.join(publisher.publish_base, names[3], "image.iso"))
+        os.link(os.path.join(publisher.publish_base, names[0], "image.iso"),
+                os.path.join(publisher.publish_base, names[3], "image.iso"))
+        total, freed = purge_usage(
+            [os.path.join(publisher.publish_base, name)
+             for name in names[:2]])
+        self.capture_logging()
+        self.assertEqual(
+            (names[:2], total, freed), publisher.purge(days=1, jobs=2))
+        self.assertLess(freed, total)
+        self.assertLogEqual([
+            "Purging ubuntu/daily-live images older than 1 days ...",
+            "Purging daily-live/%s" % names[0],
+            "Purging daily-live/%s" % names[1],
+            "Purged 2 directories; freed %s of %s" % (
+                format_size(freed), format_size(total)),
+            ])
+        self.assertEqual(
+            sorted(names[2:] + ["current"]),
+            sorted(os.listdir(publisher.publish_base)))
+
+    def test_purge_continues_after_errors(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        names = self.make_dated_dirs(publisher, [3, 2, 0])
+        stuck = os.path.join(publisher.publish_base, names[0])
+        real_rmdir = os.rmdir
+
+        def rmdir(path, *args, **kwargs):
+            if path == stuck:
+                raise OSError(errno.EBUSY, "Device or resource busy", path)
+            return real_rmdir(path, *args, **kwargs)
+
+        self.addCleanup(setattr, os, "rmdir", real_rmdir)
+        os.rmdir = rmdir
+        pruned = []
+        real_prune = tree.ChecksumCache.prune
+        self.addCleanup(setattr, tree.ChecksumCache, "prune", real_prune)
+        tree.ChecksumCache.prune = lambda cache: pruned.append(cache)
+        osextras.ensuredir(os.path.join(self.temp_dir, "etc"))
+        touch(os.path.join(self.temp_dir, "etc", ".checksum-cache"))
+        self.capture_logging()
+        publisher.purge(days=1, jobs=1)
+        self.assertIn(
+            "Failed to remove %s: [Errno %d] Device or resource busy: '%s'" %
+            (stuck, errno.EBUSY, stuck),
+            [record.getMessage() for record in self.handler.buffer])
+        self.assertEqual(
+            sorted(names[:1] + names[2:]),
+            sorted(os.listdir(publisher.publish_base)))
+        self.assertEqual([], os.listdir(stuck))
+        self.assertEqual(1, len(pruned))
+
+    def test_purge_zero_jobs(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        names = self.make_dated_dirs(publisher, [2, 0])
+        self.capture_logging()
+        self.assertEqual(names[:1], publisher.purge(days=1, jobs=0)[0])
+        self.assertEqual(names[1:], os.listdir(publisher.publish_base))
+
+    def test_purge_dry_run(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        names = self.make_dated_dirs(publisher, [3, 2])
+        os.mkdir(os.path.join(self.config.root, "etc"))
+        with open(os.path.join(
+                self.config.root, "etc", "purge-days"), "w") as purge_days:
+            print("daily-live 1", file=purge_days)
+        self.capture_logging()
+        purged, total, freed = publisher.purge(dry_run=True)
+        self.assertEqual(names, purged)
+        self.assertEqual(total, freed)
+        self.assertLogEqual([
+            "Purging ubuntu/daily-live images older than 1 days ...",
+            "Would purge daily-live/%s" % names[0],
+            "Would purge daily-live/%s" % names[1],
+            "Would purge 2 directories; would free %s of %s" % (
+                format_size(freed), format_size(total)),
+            ])
+        self.assertEqual(names, sorted(os.listdir(publisher.publish_base)))
+
+    def test_purge_not_configured(self):
+        publisher = self.make_publisher("ubuntu", "daily-live")
+        self.capture_logging()
+        self.assertEqual(([], 0, 0), publisher.purge())
+        self.assertEqual(([], 0, 0), publisher.purge(days=0))
+        self.assertLogEqual([
+            "No purge time configured for ubuntu/daily-live",
+            "Not purging images for ubuntu/daily-live",
+            ])
+
+
 class TestSimpleTree(TestCase):
     def setUp(self):
         super(TestSimpleTree, self).setUp()
@@ -502,6 +1042,12 @@ class TestSimpleTree(TestCase):
             ".pool/ubuntu-4.10-install-amd64.iso",
             ], list(self.tree.manifest_files()))
 
+    def test_manifest_files_ignores_pool_subdirectories(self):
+        sub = os.path.join(self.temp_dir, ".pool", "sub")
+        os.makedirs(sub)
+        touch(os.path.join(sub, "ubuntu-4.10-install-i386.iso"))
+        self.assertEqual([], list(self.tree.manifest_files()))
+
     def test_manifest(self):
         pool = os.path.join(self.temp_dir, "kubuntu", ".pool")
         os.makedirs(pool)
@@ -0,0 +1,478 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.web_indices.
+
+The expected output in these tests was produced by the shell
+implementation of make-web-indices that this module replaced, which is
+kept in data/make-web-indices so that the two can be compared directly.
+"""
+
+__metaclass__ = type
+
+import os
+import random
+import subprocess
+from textwrap import dedent
+
+try:
+    from unittest import skipUnless
+except ImportError:
+    from unittest2 import skipUnless
+
+from cdimage.config import all_series, Config, Series
+from cdimage.osextras import find_on_path
+from cdimage.tests.helpers import TestCase, touch
+from cdimage.web_indices import (
+    _arches,
+    _cdtypes,
+    _htaccess_extensions,
+    _numeric_sort_key,
+    make_web_indices,
+    WebIndices,
+    )
+
+
+_root = os.path.abspath(os.path.join(
+    os.path.dirname(__file__), os.pardir, os.pardir, os.pardir))
+_shell_script = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "make-web-indices")
+
+
+class TestWebIndices(TestCase):
+    def setUp(self):
+        super(TestWebIndices, self).setUp()
+        self.use_temp_dir()
+        self.config = Config(read=False)
+        self.config["PROJECT"] = "ubuntu"
+        self.config["CAPPROJECT"] = "Ubuntu"
+        self.config["DIST"] = Series.find_by_name("precise")
+
+    def make_directory(self, relative, names):
+        directory = os.path.join(self.temp_dir, relative)
+        os.makedirs(directory)
+        for name in names:
+            touch(os.path.join(directory, name))
+        return directory
+
+    def read(self, directory, name):
+        with open(os.path.join(directory, name)) as f:
+            return f.read()
+
+    def test_prefixes(self):
+        for cdprefix, prefixes, extra in (
+            ("ubuntu-12.10-alpha-2", ["ubuntu-12.10-alpha-2"], " Alpha 2"),
+            ("ubuntu-12.10-preview", ["ubuntu-12.10-preview"], " Preview"),
+            ("ubuntu-12.10-beta", ["ubuntu-12.10-beta"], " Beta"),
+            ("ubuntu-12.10-beta2", ["ubuntu-12.10-beta2"], " Beta 2"),
+            ("ubuntu-12.10-rc", ["ubuntu-12.10-rc"], " Release Candidate"),
+            ("precise", ["precise"], " Daily Build"),
+            ("ubuntu-12.04.1", ["ubuntu-12.04.1", "ubuntu-12.04"], ""),
+            ("ubuntu-12.04", ["ubuntu-12.04"], ""),
+            ):
+            web_indices = WebIndices(self.config, self.temp_dir, cdprefix)
+            self.assertEqual((prefixes, extra), web_indices.prefixes())
+
+    def test_dist_version(self):
+        web_indices = WebIndices(self.config, self.temp_dir, "precise")
+        self.assertEqual(
+            ("12.04.2 LTS", "Precise Pangolin"), web_indices.dist_version())
+        self.config["PROJECT"] = "xubuntu"
+        web_indices = WebIndices(self.config, self.temp_dir, "precise")
+        self.assertEqual(
+            ("12.04.2", "Precise Pangolin"), web_indices.dist_version())
+
+    def test_dist_version_new_series(self):
+        self.addCleanup(Series.register, list(all_series))
+        Series.register(list(all_series) + [
+            Series("saucy", "13.10", "Saucy Salamander")])
+        self.config["DIST"] = Series.find_by_name("saucy")
+        web_indices = WebIndices(self.config, self.temp_dir, "saucy")
+        self.assertEqual(
+            ("13.10", "Saucy Salamander"), web_indices.dist_version())
+
+    def test_count(self):
+        web_indices = WebIndices(self.config, self.temp_dir, "precise")
+        self.assertEqual("three", web_indices.count(3))
+        self.capture_logging()
+        self.assertEqual("", web_indices.count(10))
+        self.assertLogEqual(["Can't count up to 10!"])
+
+    def test_cdicons(self):
+        directory = self.make_directory("www/full/kubuntu/daily/20120807", [])
+        self.config["PROJECT"] = "kubuntu"
+        web_indices = WebIndices(self.config, directory, "precise")
+        self.assertEqual("../../../cdicons/kubuntu-", web_indices.cdicons())
+
+    def test_numeric_sort_key(self):
+        self.assertEqual(
+            ["", "1", "2", "10", "10a"],
+            sorted(["10a", "2", "", "10", "1"], key=_numeric_sort_key))
+
+    def test_daily(self):
+        directory = self.make_directory("full/daily-live/20120807", [
+            "quantal-desktop-i386.iso",
+            "quantal-desktop-i386.list",
+            "quantal-desktop-i386.OVERSIZED",
+            "quantal-desktop-amd64.iso",
+            "quantal-desktop-amd64.list",
+            "quantal-desktop-amd64.iso.zsync",
+            ])
+        self.config["DIST"] = Series.find_by_name("quantal")
+        make_web_indices(self.config, directory, "quantal", "daily")
+        self.assertEqual(dedent("""\
+            <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
+             "http://www.w3.org/TR/html4/strict.dtd">
+            <html>
+             <head>
+              <title>Ubuntu 12.10 (Quantal Quetzal) Daily Build</title>
+              <!-- Main style sheets for CSS2 capable browsers -->
+              <style type="text/css" media="screen">
+              @import url(http://releases.ubuntu.com/include/style.css);
+              pre { background: none; }
+              body { margin: 2em; }
+              </style>
+             </head>
+             <body><div id="pageWrapper">
+
+            <div id="header"><a href="http://www.ubuntu.com/"></a></div>
+
+            <h1>Ubuntu 12.10 (Quantal Quetzal) Daily Build</h1>
+
+            <div id="main">
+
+            <h2>Select an image</h2>
+
+            <h3>Desktop image</h3>
+
+            <p>The desktop image allows you to try Ubuntu without changing your
+            computer at all, and at your option to install it permanently later. This
+            type of image is what most people will want to use. You will need at least
+            384MiB of RAM to install from this image.</p>
+
+            <p>There are two images available, each for a different type of computer:</p>
+
+            <dl>
+            <dt><a href="quantal-desktop-i386.iso">PC (Intel x86) desktop image</a>
+
+            <dd>For almost all PCs. This includes most machines with Intel/AMD/etc type
+            processors and almost all computers that run Microsoft Windows, as well as
+            newer Apple Macintosh systems based on Intel processors. Choose this if you
+            are at all unsure.<br>
+            <span class="urgent">Warning: This image is oversized (which is a bug) and
+            will not fit onto a standard 703MiB CD. However, you may still test it using
+            a DVD, a USB drive, or a virtual machine.</span></dd>
+
+            <dt><a href="quantal-desktop-amd64.iso">64-bit PC (AMD64) desktop image</a>
+
+            <dd>Choose this to take full advantage of computers based on the AMD64 or EM64T
+            architecture (e.g., Athlon64, Opteron, EM64T Xeon). If you have a non-64-bit
+            processor made by AMD, or if you need full support for 32-bit code, use the
+            Intel x86 images instead.</dd>
+
+            </dl>
+
+            <p>A full list of available files can be found below.</p>
+
+            <p>If you need help burning these images to disk, see the
+            <a href="https://help.ubuntu.com/community/BurningIsoHowto">Image Burning Guide</a>.</p>
+
+            """), self.read(directory, "HEADER.html"))
+        self.assertEqual(
+            "</div></div></body></html>\n",
+            self.read(directory, "FOOTER.html"))
+        self.assertEqual(dedent("""\
+            AddDescription "Desktop image for PC (Intel x86) computers (standard download)" quantal-desktop-i386.iso
+            AddDescription "Desktop image for PC (Intel x86) computers (file listing)" quantal-desktop-i386.list
+            AddDescription "Desktop image for 64-bit PC (AMD64) computers (<a href=\\"http://zsync.moria.org.uk/\\">zsync</a> metafile)" quantal-desktop-amd64.iso.zsync
+            AddDescription "Desktop image for 64-bit PC (AMD64) computers (standard download)" quantal-desktop-amd64.iso
+            AddDescription "Desktop image for 64-bit PC (AMD64) computers (file listing)" quantal-desktop-amd64.list
+
+            HeaderName HEADER.html
+            ReadmeName FOOTER.html
+            IndexIgnore .htaccess HEADER.html FOOTER.html
+            IndexOptions NameWidth=* DescriptionWidth=* SuppressHTMLPreamble FancyIndexing IconHeight=22 IconWidth=22
+            AddIcon ../../cdicons/folder.png ^^DIRECTORY^^
+            AddIcon ../../cdicons/iso.png .iso
+            AddIcon ../../cdicons/jigdo.png .jigdo .template
+            AddIcon ../../cdicons/list.png .list .manifest .html .zsync MD5SUMS MD5SUMS.gpg MD5SUMS-metalink MD5SUMS-metalink.gpg SHA1SUMS SHA1SUMS.gpg SHA256SUMS SHA256SUMS.gpg
+            AddIcon ../../cdicons/torrent.png .torrent .metalink
+            """), self.read(directory, ".htaccess"))
+
+    def test_point_release(self):
+        directory = self.make_directory("simple/precise", [
+            "ubuntu-12.04.1-desktop-i386.iso",
+            "ubuntu-12.04.1-desktop-i386.list",
+            "ubuntu-12.04.1-desktop-i386.iso.torrent",
+            "ubuntu-12.04.1-desktop-i386.OVERSIZED",
+            "ubuntu-12.04.1-desktop-powerpc+ps3.iso.torrent",
+            "ubuntu-12.04.1-desktop-powerpc+ps3.list",
+            "ubuntu-12.04-src-1.iso",
+            "ubuntu-12.04-src-1.list",
+            "ubuntu-12.04-src-10.iso",
+            "ubuntu-12.04-src-10.list",
+            "ubuntu-12.04-src-2.iso",
+            "ubuntu-12.04-src-2.list",
+            "wubi.img",
+            ])
+        make_web_indices(self.config, directory, "ubuntu-12.04.1")
+        self.assertEqual(dedent("""\
+            <!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
+             "http://www.w3.org/TR/html4/strict.dtd">
+            <html>
+             <head>
+              <title>Ubuntu 12.04.2 LTS (Precise Pangolin)</title>
+              <!-- Main style sheets for CSS2 capable browsers -->
+              <style type="text/css" media="screen">
+              @import url(http://releases.ubuntu.com/include/style.css);
+              pre { background: none; }
+              body { margin: 2em; }
+              </style>
+             </head>
+             <body><div id="pageWrapper">
+
+            <div id="header"><a href="http://www.ubuntu.com/"></a></div>
+
+            <h1>Ubuntu 12.04.2 LTS (Precise Pangolin)</h1>
+
+            <div id="main">
+
+            <h2>Select an image</h2>
+
+            <p>Ubuntu is distributed on two types of images described below.</p>
+
+            <h3>Desktop CD</h3>
+
+            <p>The desktop CD allows you to try Ubuntu without changing your
+            computer at all, and at your option to install it permanently later. This
+            type of CD is what most people will want to use. You will need at least
+            384MiB of RAM to install from this CD.</p>
+
+            <p>There are two images available, each for a different type of computer:</p>
+
+            <dl>
+            <dt><a href="ubuntu-12.04.1-desktop-i386.iso">PC (Intel x86) desktop CD</a>
+
+            <dd>For almost all PCs. This includes most machines with Intel/AMD/etc type
+            processors and almost all computers that run Microsoft Windows, as well as
+            newer Apple Macintosh systems based on Intel processors. Choose this if you
+            are at all unsure.</dd>
+
+            <dt><a href="ubuntu-12.04.1-desktop-powerpc+ps3.iso.torrent">PlayStation 3 desktop CD (<a href="https://help.ubuntu.com/community/BitTorrent">BitTorrent</a> only)</a>
+
+            <dd>For Sony PlayStation 3 systems.
+            (This defaults to installing Ubuntu permanently, since there is usually
+            not enough memory to try out the full desktop system and run the installer
+            at the same time. An alternative boot option to try Ubuntu without
+            changing your computer is available.)</dd>
+
+            </dl>
+
+            <h3>Source CD</h3>
+
+            <p>The source CDs contain the source code used to build Ubuntu.</p>
+
+            <p>Some source package versions on this image may not match related binary
+            images, depending on exactly when the images were built.  You can always
+            find every version of Ubuntu source packages on Launchpad, using URLs of the
+            following form:</p>
+
+            <ul>
+             <li><code>https://launchpad.net/ubuntu/+source/SOURCE-PACKAGE-NAME/+publishinghistory</code> (index)</li>
+             <li><code>https://launchpad.net/ubuntu/+source/SOURCE-PACKAGE-NAME/VERSION</code> (specific version)</li>
+            </ul>
+
+            <p>There are three images available:</p>
+
+            <dl>
+            <dt><a href="ubuntu-12.04-src-1.iso">Source CD 1</a>
+            <dt><a href="ubuntu-12.04-src-2.iso">Source CD 2</a>
+            <dt><a href="ubuntu-12.04-src-10.iso">Source CD 10</a>
+            </dl>
+
+            <p>A full list of available files, including <a
+            href="https://help.ubuntu.com/community/BitTorrent">BitTorrent</a> files,
+            can be found below.</p>
+
+            <p>If you need help burning these images to disk, see the
+            <a href="https://help.ubuntu.com/community/BurningIsoHowto">Image Burning Guide</a>.</p>
+
+            """), self.read(directory, "HEADER.html"))
+        self.assertEqual(dedent("""\
+            AddDescription "Desktop CD for PC (Intel x86) computers (<a href=\\"https://help.ubuntu.com/community/BitTorrent\\">BitTorrent</a> download)" ubuntu-12.04.1-desktop-i386.iso.torrent
+            AddDescription "Desktop CD for PC (Intel x86) computers (standard download)" ubuntu-12.04.1-desktop-i386.iso
+            AddDescription "Desktop CD for PC (Intel x86) computers (file listing)" ubuntu-12.04.1-desktop-i386.list
+            AddDescription "Desktop CD for PlayStation 3 computers (<a href=\\"https://help.ubuntu.com/community/BitTorrent\\">BitTorrent</a> download)" ubuntu-12.04.1-desktop-powerpc+ps3.iso.torrent
+            AddDescription "Desktop CD for PlayStation 3 computers (file listing)" ubuntu-12.04.1-desktop-powerpc+ps3.list
+            AddDescription "Source CD 1 (standard download)" ubuntu-12.04-src-1.iso
+            AddDescription "Source CD 1 (file listing)" ubuntu-12.04-src-1.list
+            AddDescription "Source CD 2 (standard download)" ubuntu-12.04-src-2.iso
+            AddDescription "Source CD 2 (file listing)" ubuntu-12.04-src-2.list
+            AddDescription "Source CD 10 (standard download)" ubuntu-12.04-src-10.iso
+            AddDescription "Source CD 10 (file listing)" ubuntu-12.04-src-10.list
+
+            HeaderName HEADER.html
+            ReadmeName FOOTER.html
+            IndexIgnore .htaccess HEADER.html FOOTER.html
+            IndexOptions NameWidth=* DescriptionWidth=* SuppressHTMLPreamble FancyIndexing IconHeight=22 IconWidth=22
+            AddIcon ../cdicons/folder.png ^^DIRECTORY^^
+            AddIcon ../cdicons/iso.png .iso
+            AddIcon ../cdicons/jigdo.png .jigdo .template
+            AddIcon ../cdicons/list.png .list .manifest .html .zsync MD5SUMS MD5SUMS.gpg MD5SUMS-metalink MD5SUMS-metalink.gpg SHA1SUMS SHA1SUMS.gpg SHA256SUMS SHA256SUMS.gpg
+            AddIcon ../cdicons/torrent.png .torrent .metalink
+            AddType application/octet-stream .img
+            """), self.read(directory, ".htaccess"))
+
+
+@skipUnless(
+    find_on_path("perl") and
+    os.path.exists(os.path.join(_root, "etc", "config")),
+    "perl or etc/config not available")
+class TestShellCompatibility(TestCase):
+    """Compare output against the old shell implementation."""
+
+    projects = (
+        ("ubuntu", "Ubuntu"),
+        ("kubuntu", "Kubuntu"),
+        ("kubuntu-active", "Kubuntu Active"),
+        ("edubuntu", "Edubuntu"),
+        ("xubuntu", "Xubuntu"),
+        ("ubuntustudio", "Ubuntu Studio"),
+        ("mythbuntu", "Mythbuntu"),
+        ("ubuntu-server", "Ubuntu Server"),
+        )
+    dists = (
+        ("dapper", "6.06"), ("feisty", "7.04"), ("gutsy", "7.10"),
+        ("hardy", "8.04"), ("intrepid", "8.10"), ("lucid", "10.04"),
+        ("maverick", "10.10"), ("precise", "12.04"), ("quantal", "12.10"),
+        ("raring", "13.04"),
+        )
+    locations = (
+        ("full", "daily-live", "20120807"),
+        ("full", "releases", "precise", "release"),
+        ("simple", "precise"),
+        ("cdimage", "full", "kubuntu", "daily", "20120807"),
+        ("unpublished",),
+        )
+
+    def setUp(self):
+        super(TestShellCompatibility, self).setUp()
+        self.use_temp_dir()
+
+    def cdprefixes(self, rng, project, dist, version):
+        return [
+            str(dist),
+            "%s-%s" % (project, version),
+            "%s-%s.1" % (project, version),
+            "%s-%s-alpha-%d" % (project, version, rng.randint(1, 3)),
+            "%s-%s-preview" % (project, version),
+            "%s-%s-beta" % (project, version),
+            "%s-%s-beta%d" % (project, version, rng.randint(1, 2)),
+            "%s-%s-rc" % (project, version),
+            ]
+
+    def make_layout(self, rng, directory, prefixes):
+        """Populate DIRECTORY with a random selection of images."""
+        os.makedirs(directory)
+        names = set()
+        # The shell implementation fails outright if asked to count more
+        # than nine image types or architectures.
+        cdtypes = rng.sample(_cdtypes, rng.randint(0, 4))
+        for prefix in prefixes:
+            for cdtype in cdtypes:
+                if rng.random() < 0.3:
+                    continue
+                if cdtype == "src":
+                    arches = [
+                        str(n) for n in rng.sample(range(1, 12),
+                                                   rng.randint(1, 4))]
+                else:
+                    arches = rng.sample(_arches, rng.randint(1, 4))
+                    if rng.random() < 0.2:
+                        arches.append("s390x")
+                for arch in arches:
+                    base = "%s-%s-%s" % (prefix, cdtype, arch)
+                    names.add("%s.list" % base)
+                    for extension in _htaccess_extensions:
+                        if rng.random() < 0.3:
+                            names.add("%s.%s" % (base, extension))
+                    if rng.random() < 0.3:
+                        names.add("%s.OVERSIZED" % base)
+        if rng.random() < 0.3:
+            names.add("MD5SUMS")
+        if rng.random() < 0.2:
+            names.add("other.img")
+        for name in names:
+            touch(os.path.join(directory, name))
+        if rng.random() < 0.2 and names:
+            # Directories do not count as images.
+            os.mkdir(os.path.join(directory, "%s.iso" % prefixes[0]))
+
+    def run_shell(self, directory, project, capproject, dist, cdprefix,
+                  status):
+        env = dict(os.environ)
+        env.update({
+            "CDIMAGE_ROOT": _root,
+            "PROJECT": project,
+            "CAPPROJECT": capproject,
+            "DIST": dist,
+            "ARCHES": "i386",
+            })
+        process = subprocess.Popen(
+            ["sh", _shell_script, directory, cdprefix, status], env=env,
+            stderr=subprocess.PIPE, universal_newlines=True)
+        errors = process.communicate()[1]
+        self.assertEqual(0, process.returncode)
+        return errors.splitlines()
+
+    def read_outputs(self, directory):
+        outputs = []
+        for name in (".htaccess", "HEADER.html", "FOOTER.html"):
+            with open(os.path.join(directory, name)) as f:
+                outputs.append(f.read())
+        return outputs
+
+    def test_matches_shell(self):
+        rng = random.Random(0)
+        for i in range(40):
+            project, capproject = rng.choice(self.projects)
+            dist, version = rng.choice(self.dists)
+            cdprefix = rng.choice(
+                self.cdprefixes(rng, project, dist, version))
+            status = rng.choice(("daily", "release"))
+            config = Config(read=False)
+            config["PROJECT"] = project
+            config["CAPPROJECT"] = capproject
+            config["DIST"] = Series.find_by_name(dist)
+            web_indices = WebIndices(config, self.temp_dir, cdprefix)
+            prefixes = web_indices.prefixes()[0]
+            location = rng.choice(self.locations)
+            shell_dir = os.path.join(self.temp_dir, str(i), "shell", *location)
+            python_dir = os.path.join(
+                self.temp_dir, str(i), "python", *location)
+            self.make_layout(random.Random(i), shell_dir, prefixes)
+            self.make_layout(random.Random(i), python_dir, prefixes)
+            errors = self.run_shell(
+                shell_dir, project, capproject, dist, cdprefix, status)
+            self.capture_logging()
+            make_web_indices(config, python_dir, cdprefix, status)
+            self.assertLogEqual(errors)
+            self.assertEqual(
+                self.read_outputs(shell_dir), self.read_outputs(python_dir),
+                "Output differs for %s %s %s %s in %s" % (
+                    project, dist, cdprefix, status,
+                    sorted(os.listdir(python_dir))))
@@ -0,0 +1,167 @@
+#! /usr/bin/python
+
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Unit tests for cdimage.zsync."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+import binascii
+import hashlib
+import os
+import struct
+import subprocess
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from cdimage import zsync
+from cdimage.osextras import find_on_path
+from cdimage.tests.helpers import TestCase
+from cdimage.zsync import (
+    _pure_md4,
+    _rsums_pure,
+    md4_digest,
+    ZsyncGenerator,
+    zsync_blocksize,
+    zsync_file,
+    zsync_hash_lengths,
+    )
+
+
+class TestHelpers(TestCase):
+    def test_pure_md4(self):
+        # Test vectors from RFC 1320.
+        for message, digest in (
+            (b"", "31d6cfe0d16ae931b73c59d7e0c089c0"),
+            (b"abc", "a448017aaf21d8525fc10ae87aa6729d"),
+            (b"message digest", "d9130a8164549fe818874806e1c7014b"),
+            (b"1234567890" * 8, "e33b4ddc9c38f2199c3e7b164fcc0536"),
+            ):
+            self.assertEqual(
+                digest, binascii.hexlify(_pure_md4(message)).decode())
+
+    def test_md4_digest(self):
+        self.assertEqual(_pure_md4(b"x" * 2048), md4_digest(b"x" * 2048))
+
+    def test_blocksize(self):
+        self.assertEqual(2048, zsync_blocksize(700 * 1024 * 1024 // 10))
+        self.assertEqual(4096, zsync_blocksize(700 * 1024 * 1024))
+
+    def test_hash_lengths(self):
+        self.assertEqual((2, 3, 5), zsync_hash_lengths(700000000, 4096))
+        self.assertEqual((2, 2, 3), zsync_hash_lengths(5000, 2048))
+        self.assertEqual((1, 2, 4), zsync_hash_lengths(1000, 2048))
+
+    def test_rsums_pure(self):
+        block = bytearray([1, 2, 3, 4])
+        # a = 1 + 2 + 3 + 4; b = 4*1 + 3*2 + 2*3 + 1*4
+        self.assertEqual(
+            [struct.pack(">HH", 10, 20)], _rsums_pure(bytes(block), 4))
+
+    @unittest.skipIf(zsync.numpy is None, "numpy not available")
+    def test_rsums_numpy_matches_pure(self):
+        data = os.urandom(2048 * 16)
+        weights = zsync.numpy.arange(2048, 0, -1, dtype=zsync.numpy.uint64)
+        self.assertEqual(
+            _rsums_pure(data, 2048),
+            zsync._rsums_numpy(data, 2048, weights))
+
+
+class TestZsyncGenerator(TestCase):
+    def setUp(self):
+        super(TestZsyncGenerator, self).setUp()
+        self.use_temp_dir()
+
+    def read_metafile(self, path):
+        with open(path, "rb") as metafile:
+            data = metafile.read()
+        header, body = data.split(b"\n\n", 1)
+        return header.decode("UTF-8").split("\n"), body
+
+    def test_write(self):
+        data = os.urandom(5000)
+        generator = ZsyncGenerator(len(data))
+        generator.update(data[:3000])
+        generator.update(data[3000:])
+        path = os.path.join(self.temp_dir, "test.zsync")
+        generator.write(path, "test.iso", "test.iso", mtime=1347969600)
+        header, body = self.read_metafile(path)
+        self.assertEqual([
+            "zsync: 0.6.2",
+            "Filename: test.iso",
+            "MTime: Tue, 18 Sep 2012 12:00:00 +0000",
+            "Blocksize: 2048",
+            "Length: 5000",
+            "Hash-Lengths: 2,2,3",
+            "URL: test.iso",
+            "SHA-1: %s" % hashlib.sha1(data).hexdigest(),
+            ], header)
+        padded = data + b"\0" * (3 * 2048 - len(data))
+        expected = b""
+        for offset in range(0, len(padded), 2048):
+            block = padded[offset:offset + 2048]
+            expected += _rsums_pure(block, 2048)[0][2:]
+            expected += md4_digest(block)[:3]
+        self.assertEqual(expected, body)
+
+    def test_chunking(self):
+        # Feeding data in odd-sized pieces across the processing chunk
+        # boundary gives the same result as a single update.
+        data = os.urandom(zsync._CHUNK_SIZE + 3000)
+        whole = ZsyncGenerator(len(data))
+        whole.update(data)
+        whole.finish()
+        pieces = ZsyncGenerator(len(data))
+        for offset in range(0, len(data), 100001):
+            pieces.update(data[offset:offset + 100001])
+        pieces.finish()
+        self.assertEqual(whole.block_sums, pieces.block_sums)
+        self.assertEqual(
+            (len(data) + 2047) // 2048, len(whole.block_sums))
+
+    def test_zsync_file_shares_read(self):
+        path = os.path.join(self.temp_dir, "test.iso")
+        data = os.urandom(10000)
+        with open(path, "wb") as image:
+            image.write(data)
+        md5 = hashlib.md5()
+        zsync_file(path, "%s.zsync" % path, "test.iso", hash_objs=[md5])
+        self.assertEqual(hashlib.md5(data).hexdigest(), md5.hexdigest())
+        header, _ = self.read_metafile("%s.zsync" % path)
+        self.assertIn("Filename: test.iso", header)
+        self.assertIn("Length: 10000", header)
+
+    @unittest.skipUnless(find_on_path("zsyncmake"), "zsyncmake not available")
+    def test_matches_zsyncmake(self):
+        # The native metafile is byte-for-byte identical to zsyncmake's.
+        path = os.path.join(self.temp_dir, "test.iso")
+        with open(path, "wb") as image:
+            image.write(os.urandom(5 * 1024 * 1024 + 1234))
+        native = os.path.join(self.temp_dir, "native.zsync")
+        external = os.path.join(self.temp_dir, "external.zsync")
+        zsync_file(path, native, "test.iso")
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(
+                ["zsyncmake", "-Z", "-o", external, "-u", "test.iso", path],
+                stdout=devnull, stderr=devnull)
+        with open(native, "rb") as native_file:
+            with open(external, "rb") as external_file:
+                self.assertEqual(external_file.read(), native_file.read())
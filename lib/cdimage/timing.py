@@ -0,0 +1,95 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing instrumentation for long-running operations."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+from cdimage import osextras
+
+
+def _cpu_time():
+    """Return CPU time used by this process and its reaped children.
+
+    This is process-wide, so stages that run concurrently in different
+    threads will each be charged for the others' CPU time.
+    """
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+class StageTimer:
+    """Record wall time, CPU time, and bytes processed for named stages."""
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, arch=None, nbytes=0):
+        """Time the body of a with statement as stage NAME.
+
+        The record is yielded, so that the body can set its "bytes" entry
+        once the amount of data processed is known.
+        """
+        record = {"stage": name, "arch": arch, "bytes": nbytes}
+        start_wall = time.time()
+        start_cpu = _cpu_time()
+        try:
+            yield record
+        finally:
+            record["wall"] = time.time() - start_wall
+            record["cpu"] = _cpu_time() - start_cpu
+            with self.lock:
+                self.records.append(record)
+
+    def summary(self):
+        """Return totals for each stage, in the order stages first ended."""
+        totals = {}
+        order = []
+        for record in self.records:
+            if record["stage"] not in totals:
+                totals[record["stage"]] = {
+                    "stage": record["stage"], "wall": 0.0, "cpu": 0.0,
+                    "bytes": 0, "count": 0}
+                order.append(record["stage"])
+            total = totals[record["stage"]]
+            total["wall"] += record["wall"]
+            total["cpu"] += record["cpu"]
+            total["bytes"] += record["bytes"]
+            total["count"] += 1
+        return [totals[stage] for stage in order]
+
+    def write(self, path, **extra):
+        """Write all records and per-stage totals to PATH as JSON.
+
+        Any keyword arguments are included as top-level fields.
+        """
+        osextras.ensuredir(os.path.dirname(path))
+        data = dict(extra)
+        data["records"] = self.records
+        data["stages"] = self.summary()
+        with open("%s.new" % path, "w") as timings:
+            json.dump(data, timings, indent=2, sort_keys=True)
+            print(file=timings)
+        os.rename("%s.new" % path, path)
@@ -0,0 +1,251 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate BitTorrent metafiles.
+
+This produces the same metainfo as BitTornado's btmakemetafile, but lets
+the caller feed the image data in, so that the read can be shared with
+checksum or zsync generation.
+"""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+import glob
+import hashlib
+import os
+import time
+
+from cdimage.atomicfile import AtomicFile
+from cdimage.checksums import ChecksumFileSet, checksum_cache
+from cdimage.log import logger
+
+try:
+    _text_type = unicode
+    _integer_types = (int, long)
+except NameError:
+    _text_type = str
+    _integer_types = (int,)
+
+
+TRACKER = "http://torrent.ubuntu.com:6969/announce"
+IP6TRACKER = "http://ipv6.torrent.ubuntu.com:6969/announce"
+
+# Read this much of an image at a time.
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _bencode(obj, out):
+    if isinstance(obj, dict):
+        out.append(b"d")
+        items = sorted(
+            (key.encode("UTF-8") if isinstance(key, _text_type) else key,
+             value)
+            for key, value in obj.items())
+        for key, value in items:
+            _bencode(key, out)
+            _bencode(value, out)
+        out.append(b"e")
+    elif isinstance(obj, (list, tuple)):
+        out.append(b"l")
+        for item in obj:
+            _bencode(item, out)
+        out.append(b"e")
+    elif isinstance(obj, bytes):
+        out.append(("%d:" % len(obj)).encode("ASCII"))
+        out.append(obj)
+    elif isinstance(obj, _text_type):
+        _bencode(obj.encode("UTF-8"), out)
+    elif isinstance(obj, _integer_types) and not isinstance(obj, bool):
+        out.append(("i%de" % obj).encode("ASCII"))
+    else:
+        raise TypeError("Cannot bencode %r" % (obj,))
+
+
+def bencode(obj):
+    """Encode OBJ (dicts, lists, strings, and integers) as bencoded bytes.
+
+    Text strings are encoded as UTF-8, and dictionary keys are sorted.
+    """
+    out = []
+    _bencode(obj, out)
+    return b"".join(out)
+
+
+def torrent_piece_length(length):
+    """Choose a piece length as btmakemetafile does."""
+    if length > 8 * 1024 * 1024 * 1024:
+        exponent = 21
+    elif length > 2 * 1024 * 1024 * 1024:
+        exponent = 20
+    elif length > 512 * 1024 * 1024:
+        exponent = 19
+    elif length > 64 * 1024 * 1024:
+        exponent = 18
+    elif length > 16 * 1024 * 1024:
+        exponent = 17
+    elif length > 4 * 1024 * 1024:
+        exponent = 16
+    else:
+        exponent = 15
+    return 2 ** exponent
+
+
+class TorrentGenerator:
+    """Build a BitTorrent metafile from data fed to it in order.
+
+    Like a hashlib object, data is passed to update; LENGTH must be known
+    up front so that the piece length can be chosen before reading.
+    """
+
+    def __init__(self, length, piece_length=None):
+        self.length = length
+        if piece_length is None:
+            piece_length = torrent_piece_length(length)
+        self.piece_length = piece_length
+        self.pieces = []
+        self._piece = hashlib.sha1()
+        self._piece_size = 0
+        self._done = 0
+        self._finished = False
+
+    def update(self, data):
+        offset = 0
+        while offset < len(data):
+            take = min(len(data) - offset,
+                       self.piece_length - self._piece_size)
+            self._piece.update(data[offset:offset + take])
+            self._piece_size += take
+            offset += take
+            if self._piece_size == self.piece_length:
+                self.pieces.append(self._piece.digest())
+                self._piece = hashlib.sha1()
+                self._piece_size = 0
+        self._done += len(data)
+
+    def finish(self):
+        if self._finished:
+            return
+        if self._done != self.length:
+            raise ValueError(
+                "Expected %d bytes but got %d" % (self.length, self._done))
+        if self._piece_size:
+            self.pieces.append(self._piece.digest())
+            self._piece_size = 0
+        self._finished = True
+
+    def metainfo(self, name, announce, announce_list=None, comment=None,
+                 creation_date=None):
+        """Return the metainfo dictionary for a single file called NAME.
+
+        ANNOUNCE_LIST, if given, is a list of tiers, each of which is a
+        list of tracker URLs.
+        """
+        self.finish()
+        if creation_date is None:
+            creation_date = int(time.time())
+        metainfo = {
+            "announce": announce,
+            "creation date": creation_date,
+            "info": {
+                "length": self.length,
+                "name": name,
+                "piece length": self.piece_length,
+                "pieces": b"".join(self.pieces),
+                },
+            }
+        if comment:
+            metainfo["comment"] = comment
+        if announce_list:
+            metainfo["announce-list"] = [list(tier) for tier in announce_list]
+        return metainfo
+
+    def write(self, path, name, announce, **kwargs):
+        """Write the metafile to PATH.
+
+        Keyword arguments are passed on to metainfo.
+        """
+        data = bencode(self.metainfo(name, announce, **kwargs))
+        with AtomicFile(path, binary=True) as torrent:
+            torrent.write(data)
+
+
+def torrent_file(infile, outfile, announce, announce_list=None, comment=None,
+                 hash_objs=()):
+    """Make a BitTorrent metafile for INFILE, reading it only once.
+
+    Each object in HASH_OBJS is also updated with the contents of INFILE.
+    """
+    generator = TorrentGenerator(os.stat(infile).st_size)
+    consumers = [generator] + list(hash_objs)
+    with open(infile, "rb") as image:
+        while True:
+            buf = image.read(_CHUNK_SIZE)
+            if not buf:
+                break
+            for consumer in consumers:
+                consumer.update(buf)
+    generator.write(
+        outfile, os.path.basename(infile), announce,
+        announce_list=announce_list, comment=comment)
+
+
+def make_torrents(config, directory, cdprefix,
+                  target_hostname="cdimage.ubuntu.com"):
+    """Make BitTorrent metafiles for the images in DIRECTORY.
+
+    The images' entries in DIRECTORY's checksum files are computed in the
+    same read and written out, so that checksum-directory can merge them
+    rather than reading the images again.  They are also stored in the
+    checksum cache if that is enabled.
+    """
+    images = []
+    if cdprefix:
+        images.extend(
+            sorted(glob.glob(os.path.join(directory, "%s-*.iso" % cdprefix))))
+    images.append(os.path.join(directory, "%s.iso" % cdprefix))
+    images = [image for image in images if os.path.isfile(image)]
+    if not images:
+        return
+
+    if target_hostname == "releases.ubuntu.com":
+        announce_list = [[TRACKER], [IP6TRACKER]]
+    else:
+        announce_list = None
+    comment = "%s CD %s" % (config["CAPPROJECT"], target_hostname)
+
+    cache = checksum_cache(config)
+    if cache is not None:
+        cache.read()
+    checksum_files = ChecksumFileSet(config, directory, cache=cache)
+    checksum_files.read()
+    for image in images:
+        logger.info("Creating torrent for %s ..." % image)
+        name = os.path.basename(image)
+        # Any existing entries may be for an older image of the same name.
+        checksum_files.remove(name)
+        missing = checksum_files.missing(name)
+        hash_objs = [checksum_file.hash_method() for checksum_file in missing]
+        torrent_file(
+            image, "%s.torrent" % image, TRACKER,
+            announce_list=announce_list, comment=comment,
+            hash_objs=hash_objs)
+        checksum_files.add_precomputed(name, dict(
+            (checksum_file.name, hash_obj.hexdigest())
+            for checksum_file, hash_obj in zip(missing, hash_objs)))
+    checksum_files.write()
+    if cache is not None:
+        cache.write()
@@ -19,22 +19,33 @@ from __future__ import print_function
 
 __metaclass__ = type
 
+import datetime
+import errno
 from itertools import count
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import socket
 import stat
 import subprocess
+import threading
+import zlib
 
 from cdimage.atomicfile import AtomicFile
 from cdimage.checksums import (
+    ChecksumCache,
     ChecksumFileSet,
     checksum_directory,
-    metalink_checksum_directory,
+    checksum_move,
     )
 from cdimage.config import Series
 from cdimage.log import logger
+from cdimage.metalink import make_metalinks
 from cdimage import osextras
+from cdimage.osextras import format_size
+from cdimage.timing import StageTimer
+from cdimage.web_indices import make_web_indices
+from cdimage.zsync import native_zsync_fast, zsync_file
 
 
 # TODO: This should be in a configuration file.  ALL_PROJECTS is not
@@ -59,7 +70,21 @@ projects = [
     ]
 
 
-def zsyncmake(infile, outfile, url):
+def can_zsyncmake():
+    return native_zsync_fast() or osextras.find_on_path("zsyncmake")
+
+
+def zsyncmake(infile, outfile, url, hash_objs=()):
+    """Make a zsync metafile for INFILE.
+
+    If the native generator is fast enough here, it is used; each object in
+    HASH_OBJS is updated with the contents of INFILE in the same read, and
+    True is returned.  Otherwise, this falls back to running zsyncmake and
+    returns False.
+    """
+    if native_zsync_fast():
+        zsync_file(infile, outfile, url, hash_objs=hash_objs)
+        return True
     command = ["zsyncmake"]
     if infile.endswith(".gz"):
         command.append("-Z")
@@ -68,6 +93,129 @@ def zsyncmake(infile, outfile, url):
         logger.info("Trying again with block size 2048 ...")
         command[1:1] = ["-b", "2048"]
         subprocess.check_call(command)
+    return False
+
+
+# Enough of an image to see an ISO 9660 primary volume descriptor.
+_SNIFF_SIZE = 32774
+
+
+def _sniff_header(header):
+    """Identify an image type from its first few blocks."""
+    if not header:
+        return "empty"
+    elif header[32769:32774] == b"CD001":
+        return "iso"
+    elif header[:2] == b"\x1f\x8b":
+        return "gzip"
+    elif header[257:262] == b"ustar":
+        return "tar"
+    elif header[510:512] == b"\x55\xaa":
+        return "boot"
+    else:
+        return "data"
+
+
+def sniff_image(path):
+    """Identify an image from its contents.
+
+    Returns a pair of the image type ("iso", "boot" for an x86 boot sector,
+    "gzip", "tar", "empty", or "data" if unknown) and, for gzip images, the
+    type of the compressed data (otherwise None).  Only as much of a gzip
+    stream is decompressed as is needed to identify its contents.
+    """
+    with open(path, "rb") as image:
+        header = image.read(_SNIFF_SIZE)
+        image_type = _sniff_header(header)
+        if image_type != "gzip":
+            return image_type, None
+
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        decompressed = []
+        decompressed_size = 0
+        data = header
+        try:
+            while data and decompressed_size < _SNIFF_SIZE:
+                buf = decompressor.decompress(
+                    data, _SNIFF_SIZE - decompressed_size)
+                decompressed.append(buf)
+                decompressed_size += len(buf)
+                if decompressor.unused_data:
+                    # End of the compressed stream.
+                    break
+                data = decompressor.unconsumed_tail
+                if not data:
+                    data = image.read(16384)
+        except zlib.error:
+            return image_type, "data"
+        return image_type, _sniff_header(b"".join(decompressed))
+
+
+def publish_jobs(config):
+    """Return the number of architectures to publish at once."""
+    try:
+        return max(1, int(config["CDIMAGE_PUBLISH_JOBS"]))
+    except ValueError:
+        return 1
+
+
+def directory_size(directory):
+    """Return the total size of the files directly in DIRECTORY."""
+    size = 0
+    for entry in osextras.scandir(directory):
+        if entry.is_file():
+            size += entry.stat().st_size
+    return size
+
+
+def purge_jobs(config):
+    """Return the number of old directories to delete at once."""
+    try:
+        return max(1, int(config["CDIMAGE_PURGE_JOBS"]))
+    except ValueError:
+        return 1
+
+
+def _disk_usage(st):
+    if hasattr(st, "st_blocks"):
+        return st.st_blocks * 512
+    else:
+        return st.st_size
+
+
+def purge_usage(directories):
+    """Work out how much space deleting DIRECTORIES would free.
+
+    Published images are hardlinked into each new dated directory, so
+    most files have links elsewhere and deleting one directory frees
+    nothing until the last link goes.  Returns (total, freed): the disk
+    usage of everything in DIRECTORIES, counting each inode once, and the
+    part of that belonging to inodes with no links outside DIRECTORIES.
+    """
+    inodes = {}
+    total = freed = 0
+    for directory in directories:
+        total += _disk_usage(os.lstat(directory))
+        freed += _disk_usage(os.lstat(directory))
+    pending = list(directories)
+    while pending:
+        for entry in osextras.scandir(pending.pop()):
+            st = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+                total += _disk_usage(st)
+                freed += _disk_usage(st)
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in inodes:
+                inodes[key][1] += 1
+            else:
+                inodes[key] = [st, 1]
+    for st, links in inodes.values():
+        total += _disk_usage(st)
+        if links >= st.st_nlink:
+            freed += _disk_usage(st)
+    return total, freed
 
 
 class Tree:
@@ -89,9 +237,10 @@ class Tree:
         """Return the series for a file basename."""
         raise NotImplementedError
 
-    def path_to_manifest(self, path):
+    def path_to_manifest(self, path, st=None):
         """Return a manifest file entry for a tree-relative path.
 
+        ST may be the result of stating the file, if it is already known.
         May raise ValueError for unrecognised file naming schemes.
         """
         if path.startswith("tocd"):
@@ -102,15 +251,18 @@ class Tree:
             series = self.name_to_series(base)
         except ValueError:
             return None
-        size = os.stat(os.path.join(self.directory, path)).st_size
-        return "%s\t%s\t/%s\t%d" % (project, series, path, size)
+        if st is None:
+            st = os.stat(os.path.join(self.directory, path))
+        return "%s\t%s\t/%s\t%d" % (project, series, path, st.st_size)
 
-    def manifest_file_allowed(self, path):
+    def manifest_file_allowed(self, path, st=None):
         """Return true if a given file is allowed in the manifest."""
         if (path.endswith(".iso") or path.endswith(".img") or
             path.endswith(".img.gz") or path.endswith(".tar.gz") or
             path.endswith(".tar.xz")):
-            if stat.S_ISREG(os.stat(path).st_mode):
+            if st is None:
+                st = os.stat(path)
+            if stat.S_ISREG(st.st_mode):
                 return True
         return False
 
@@ -118,11 +270,20 @@ class Tree:
         """Yield all the files to include in a manifest of this tree."""
         raise NotImplementedError
 
+    def manifest_entries(self):
+        """Yield (path, stat result) for each file in the manifest.
+
+        The stat result may be None if the walk did not already have it.
+        """
+        for path in self.manifest_files():
+            yield path, None
+
     def manifest(self):
         """Return a manifest of this tree as a sequence of lines."""
         return sorted(filter(
             lambda line: line is not None,
-            (self.path_to_manifest(path) for path in self.manifest_files())))
+            (self.path_to_manifest(path, st)
+             for path, st in self.manifest_entries())))
 
 
 class Publisher:
@@ -148,30 +309,162 @@ class DailyTree(Tree):
         dist = name.split("-")[0]
         return Series.find_by_name(dist)
 
+    def _walk_manifest(self, dirpath, relative_dirpath, ancestors,
+                       in_current):
+        try:
+            with osextras.scandir(dirpath) as scanned:
+                entries = list(scanned)
+        except OSError:
+            return
+        if not in_current and [
+                entry for entry in entries
+                if entry.name == "current" and entry.is_dir()]:
+            # The dated builds next to "current" are only published
+            # through it, so don't bother walking them.
+            entries = [
+                entry for entry in entries if not entry.name[:1].isdigit()]
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            relative_path = os.path.join(relative_dirpath, entry.name)
+            if stat.S_ISDIR(st.st_mode):
+                # Detect loops.
+                dev_ino = (st.st_dev, st.st_ino)
+                if dev_ino in ancestors:
+                    continue
+                ancestors.add(dev_ino)
+                for item in self._walk_manifest(
+                    entry.path, relative_path, ancestors,
+                    in_current or entry.name == "current"):
+                    yield item
+                ancestors.remove(dev_ino)
+            elif in_current and self.manifest_file_allowed(entry.path, st=st):
+                yield relative_path, st
+
+    def manifest_entries(self, subdirectory=None):
+        """Yield (path, stat result) for each file in the manifest.
+
+        If SUBDIRECTORY is given, only walk that tree-relative directory.
+        """
+        dirpath = self.directory
+        st = os.stat(dirpath)
+        ancestors = set([(st.st_dev, st.st_ino)])
+        relative_dirpath = ""
+        if subdirectory is not None:
+            for component in subdirectory.split("/"):
+                dirpath = os.path.join(dirpath, component)
+                relative_dirpath = os.path.join(relative_dirpath, component)
+                try:
+                    st = os.stat(dirpath)
+                except OSError:
+                    return iter([])
+                ancestors.add((st.st_dev, st.st_ino))
+        return self._walk_manifest(
+            dirpath, relative_dirpath, ancestors,
+            "current" in relative_dirpath.split("/"))
+
     def manifest_files(self):
         """Yield all the files to include in a manifest of this tree."""
-        seen_inodes = []
-        for dirpath, dirnames, filenames in os.walk(
-            self.directory, followlinks=True):
-            # Detect loops.
-            st = os.stat(dirpath)
-            dev_ino = (st.st_dev, st.st_ino)
-            seen_inodes.append(dev_ino)
-            for i in range(len(dirnames) - 1, -1, -1):
-                st = os.stat(os.path.join(dirpath, dirnames[i]))
-                dev_ino = (st.st_dev, st.st_ino)
-                if dev_ino in seen_inodes:
-                    del dirnames[i]
+        for path, _ in self.manifest_entries():
+            yield path
+
+
+class DailyManifestIndex:
+    """A persistent index of a daily tree's manifest.
+
+    Manifest lines are grouped by the "current" directory that contains
+    them, so that publishing only has to walk the directory it changed
+    rather than the whole tree.
+    """
+
+    def __init__(self, tree, path=None):
+        self.tree = tree
+        if path is None:
+            path = os.path.join(tree.directory, ".manifest-daily-index")
+        self.path = path
+        self.entries = {}
+
+    @staticmethod
+    def current_dir(path):
+        """Return the "current" directory containing a tree-relative path."""
+        components = path.split("/")
+        return "/".join(components[:components.index("current") + 1])
+
+    def _scan(self, subdirectory=None):
+        entries = {}
+        for path, st in self.tree.manifest_entries(subdirectory=subdirectory):
+            line = self.tree.path_to_manifest(path, st)
+            if line is not None:
+                entries.setdefault(self.current_dir(path), []).append(line)
+        return entries
+
+    def read(self):
+        """Read the index; return False if it is missing or corrupt."""
+        entries = {}
+        try:
+            with open(self.path) as index:
+                for line in index:
+                    current_dir, sep, manifest_line = (
+                        line.rstrip("\n").partition("\t"))
+                    if not sep or not manifest_line:
+                        logger.warning(
+                            "Corrupt manifest index %s; rebuilding" %
+                            self.path)
+                        return False
+                    entries.setdefault(current_dir, []).append(manifest_line)
+        except IOError:
+            return False
+        self.entries = entries
+        return True
+
+    def rebuild(self):
+        """Rebuild the index by walking the whole tree."""
+        self.entries = self._scan()
+
+    def update(self, current_dir):
+        """Refresh the index for one tree-relative "current" directory.
+
+        Entries for other "current" directories that have since been
+        removed are dropped too, since nothing else would notice them.
+        """
+        for other_dir in list(self.entries):
+            if not os.path.isdir(os.path.join(self.tree.directory, other_dir)):
+                del self.entries[other_dir]
+        self.entries.pop(current_dir, None)
+        self.entries.update(self._scan(subdirectory=current_dir))
 
-            if "current" in dirpath.split(os.sep):
-                relative_dirpath = dirpath[len(self.directory) + 1:]
-                for filename in filenames:
-                    path = os.path.join(dirpath, filename)
-                    if self.manifest_file_allowed(path):
-                        yield os.path.join(relative_dirpath, filename)
+    def manifest(self):
+        """Return the manifest as a sorted sequence of lines."""
+        return sorted(
+            line for lines in self.entries.values() for line in lines)
 
-            if not dirnames:
-                seen_inodes.pop()
+    def check(self):
+        """Compare the index against the tree.
+
+        Returns a pair of lists: manifest lines missing from the index, and
+        lines in the index that should not be there.
+        """
+        actual = set(
+            line for lines in self._scan().values() for line in lines)
+        indexed = set(self.manifest())
+        return sorted(actual - indexed), sorted(indexed - actual)
+
+    def write(self):
+        with AtomicFile(self.path) as index:
+            for current_dir in sorted(self.entries):
+                for line in sorted(self.entries[current_dir]):
+                    print("%s\t%s" % (current_dir, line), file=index)
+
+    def write_manifest(self, path=None):
+        """Write the manifest derived from the index to PATH."""
+        if path is None:
+            path = os.path.join(self.tree.directory, ".manifest-daily")
+        with AtomicFile(path) as manifest_file:
+            for line in self.manifest():
+                print(line, file=manifest_file)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IWGRP)
 
 
 class DailyTreePublisher(Publisher):
@@ -180,6 +473,10 @@ class DailyTreePublisher(Publisher):
     def __init__(self, tree, image_type, try_zsyncmake=True):
         super(DailyTreePublisher, self).__init__(tree, image_type)
         self.checksum_dirs = []
+        self.precomputed_checksums = {}
+        # Serialises updates to checksum files shared between architectures.
+        self.checksum_lock = threading.Lock()
+        self.timer = StageTimer()
         self.try_zsyncmake = try_zsyncmake  # for testing
 
     @property
@@ -196,7 +493,7 @@ class DailyTreePublisher(Publisher):
 
     @property
     def full_tree(self):
-        if self.project == "ubuntu":
+        if self.project in ("ubuntu", "livecd-base"):
             return self.tree.directory
         else:
             return os.path.join(self.tree.directory, self.project)
@@ -332,33 +629,42 @@ class DailyTreePublisher(Publisher):
                         os.path.join(publish_date, name))
 
     def detect_image_extension(self, source_prefix):
-        subp = subprocess.Popen(
-            ["file", "-b", "%s.raw" % source_prefix], stdout=subprocess.PIPE,
-            universal_newlines=True)
-        output = subp.communicate()[0].rstrip("\n")
-        if output.startswith("# "):
-            output = output[2:]
-
-        if output.startswith("ISO 9660 CD-ROM filesystem data "):
+        image_type, compressed_type = sniff_image("%s.raw" % source_prefix)
+
+        if image_type == "iso":
             return "iso"
-        elif output.startswith("x86 boot sector"):
+        elif image_type == "boot":
             return "img"
-        elif output.startswith("gzip compressed data"):
-            with open("%s.type" % source_prefix) as compressed_type:
-                real_output = compressed_type.readline().rstrip("\n")
-            if real_output.startswith("ISO 9660 CD-ROM filesystem data "):
+        elif image_type == "gzip":
+            if compressed_type == "data":
+                # Fall back to a description left by the build, if any.
+                try:
+                    with open("%s.type" % source_prefix) as type_file:
+                        real_output = type_file.readline().rstrip("\n")
+                except IOError:
+                    real_output = compressed_type
+                if real_output.startswith("ISO 9660 CD-ROM filesystem data "):
+                    compressed_type = "iso"
+                elif real_output.startswith("x86 boot sector"):
+                    compressed_type = "boot"
+                elif real_output.startswith("tar archive"):
+                    compressed_type = "tar"
+                else:
+                    compressed_type = real_output
+            if compressed_type == "iso":
                 return "iso.gz"
-            elif real_output.startswith("x86 boot sector"):
+            elif compressed_type == "boot":
                 return "img.gz"
-            elif real_output.startswith("tar archive"):
+            elif compressed_type == "tar":
                 return "tar.gz"
             else:
                 logger.warning(
                     "Unknown compressed file type '%s'; assuming .img.gz" %
-                    real_output)
+                    compressed_type)
                 return "img.gz"
         else:
-            logger.warning("Unknown file type '%s'; assuming .iso" % output)
+            logger.warning(
+                "Unknown file type '%s'; assuming .iso" % image_type)
             return "iso"
 
     def jigdo_ports(self, arch):
@@ -384,6 +690,42 @@ class DailyTreePublisher(Publisher):
                 for line in jigdo_in:
                     jigdo_out.write(line.replace(from_line, to_line))
 
+    def publish_image(self, source, target, arch=None):
+        """Move an image into the published tree.
+
+        If the image has to be copied, its checksums are computed on the
+        way and remembered for checksum_directory.
+        """
+        with self.timer.stage("move", arch=arch) as record:
+            digests = checksum_move(source, target)
+            record["bytes"] = os.stat(target).st_size
+        name = os.path.basename(target)
+        if digests is None:
+            self.precomputed_checksums.pop(name, None)
+        else:
+            self.precomputed_checksums[name] = digests
+
+    def make_zsync(self, target, url):
+        """Make a zsync metafile for a published image.
+
+        If the image's checksums are not already known, they are computed
+        in the same read where possible and remembered for
+        checksum_directory.
+        """
+        name = os.path.basename(target)
+        hash_objs = {}
+        if name not in self.precomputed_checksums:
+            hash_objs = dict(
+                (checksum_name, hash_method())
+                for checksum_name, hash_method in
+                ChecksumFileSet.checksum_file_methods.items())
+        osextras.unlink_force("%s.zsync" % target)
+        if (zsyncmake(target, "%s.zsync" % target, url,
+                      hash_objs=list(hash_objs.values())) and hash_objs):
+            self.precomputed_checksums[name] = dict(
+                (checksum_name, hash_obj.hexdigest())
+                for checksum_name, hash_obj in hash_objs.items())
+
     def publish_binary(self, publish_type, arch, date):
         in_prefix = "%s-%s-%s" % (self.config.series, publish_type, arch)
         out_prefix = "%s-%s-%s" % (self.config.series, publish_type, arch)
@@ -401,27 +743,33 @@ class DailyTreePublisher(Publisher):
 
         logger.info("Publishing %s ..." % arch)
         osextras.ensuredir(target_dir)
-        extension = self.detect_image_extension(source_prefix)
-        shutil.move(
-            "%s.raw" % source_prefix, "%s.%s" % (target_prefix, extension))
+        with self.timer.stage("detect", arch=arch):
+            extension = self.detect_image_extension(source_prefix)
+        self.publish_image(
+            "%s.raw" % source_prefix, "%s.%s" % (target_prefix, extension),
+            arch=arch)
         if os.path.exists("%s.list" % source_prefix):
             shutil.move("%s.list" % source_prefix, "%s.list" % target_prefix)
         self.checksum_dirs.append(source_dir)
-        with ChecksumFileSet(
-            self.config, target_dir, sign=False) as checksum_files:
-            checksum_files.remove("%s.%s" % (out_prefix, extension))
+        with self.checksum_lock:
+            with ChecksumFileSet(
+                self.config, target_dir, sign=False) as checksum_files:
+                checksum_files.remove("%s.%s" % (out_prefix, extension))
 
         # Jigdo integration
         if os.path.exists("%s.jigdo" % source_prefix):
             logger.info("Publishing %s jigdo ..." % arch)
-            shutil.move("%s.jigdo" % source_prefix, "%s.jigdo" % target_prefix)
-            shutil.move(
-                "%s.template" % source_prefix, "%s.template" % target_prefix)
-            if self.jigdo_ports(arch):
-                self.replace_jigdo_mirror(
-                    "%s.jigdo" % target_prefix,
-                    "http://archive.ubuntu.com/ubuntu",
-                    "http://ports.ubuntu.com/ubuntu-ports")
+            with self.timer.stage("jigdo", arch=arch):
+                shutil.move(
+                    "%s.jigdo" % source_prefix, "%s.jigdo" % target_prefix)
+                shutil.move(
+                    "%s.template" % source_prefix,
+                    "%s.template" % target_prefix)
+                if self.jigdo_ports(arch):
+                    self.replace_jigdo_mirror(
+                        "%s.jigdo" % target_prefix,
+                        "http://archive.ubuntu.com/ubuntu",
+                        "http://ports.ubuntu.com/ubuntu-ports")
         else:
             osextras.unlink_force("%s.jigdo" % target_prefix)
             osextras.unlink_force("%s.template" % target_prefix)
@@ -437,25 +785,26 @@ class DailyTreePublisher(Publisher):
         if (self.config["CDIMAGE_SQUASHFS_BASE"] and
             os.path.exists("%s.squashfs" % source_prefix)):
             logger.info("Publishing %s squashfs ..." % arch)
-            shutil.move(
-                "%s.squashfs" % source_prefix, "%s.squashfs" % target_prefix)
+            self.publish_image(
+                "%s.squashfs" % source_prefix, "%s.squashfs" % target_prefix,
+                arch=arch)
         else:
             osextras.unlink_force("%s.squashfs" % target_prefix)
 
         # Flashable Android boot images
         if os.path.exists("%s.bootimg" % source_prefix):
             logger.info("Publishing %s abootimg bootloader images ..." % arch)
-            shutil.move(
-                "%s.bootimg" % source_prefix, "%s.bootimg" % target_prefix)
+            self.publish_image(
+                "%s.bootimg" % source_prefix, "%s.bootimg" % target_prefix,
+                arch=arch)
 
         # zsync metafiles
-        if self.try_zsyncmake and osextras.find_on_path("zsyncmake"):
+        if self.try_zsyncmake and can_zsyncmake():
             logger.info("Making %s zsync metafile ..." % arch)
-            osextras.unlink_force("%s.%s.zsync" % (target_prefix, extension))
-            zsyncmake(
-                "%s.%s" % (target_prefix, extension),
-                "%s.%s.zsync" % (target_prefix, extension),
-                "%s.%s" % (out_prefix, extension))
+            image = "%s.%s" % (target_prefix, extension)
+            with self.timer.stage(
+                "zsync", arch=arch, nbytes=os.stat(image).st_size):
+                self.make_zsync(image, "%s.%s" % (out_prefix, extension))
 
         size = os.stat("%s.%s" % (target_prefix, extension)).st_size
         if size > self.size_limit_extension(extension):
@@ -466,6 +815,42 @@ class DailyTreePublisher(Publisher):
 
         yield os.path.join(self.project, self.image_type_dir, in_prefix)
 
+    def publish_binaries(self, publish_type, date, jobs=None):
+        """Publish binary images for all architectures.
+
+        Up to JOBS architectures are published at once.  Returns the
+        published paths in architecture order, as a serial publish would.
+        """
+        arches = self.config.arches
+        if jobs is None:
+            jobs = publish_jobs(self.config)
+        if jobs < 2 or len(arches) < 2:
+            published = []
+            for arch in arches:
+                published.extend(
+                    list(self.publish_binary(publish_type, arch, date)))
+            return published
+
+        first_checksum_dir = len(self.checksum_dirs)
+        pool = ThreadPool(min(jobs, len(arches)))
+        try:
+            results = pool.map(
+                lambda arch: list(
+                    self.publish_binary(publish_type, arch, date)),
+                arches, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        # Workers append old checksum directories in whatever order they
+        # finish; restore architecture order.
+        arch_order = dict(
+            (os.path.join(self.image_output, arch), i)
+            for i, arch in enumerate(arches))
+        self.checksum_dirs[first_checksum_dir:] = sorted(
+            self.checksum_dirs[first_checksum_dir:],
+            key=lambda source_dir: arch_order.get(source_dir, len(arches)))
+        return [path for result in results for path in result]
+
     def publish_source(self, date):
         for i in count(1):
             in_prefix = "%s-src-%d" % (self.config.series, i)
@@ -499,7 +884,7 @@ class DailyTreePublisher(Publisher):
                 osextras.unlink_force("%s.template" % target_prefix)
 
             # zsync metafiles
-            if self.try_zsyncmake and osextras.find_on_path("zsyncmake"):
+            if self.try_zsyncmake and can_zsyncmake():
                 logger.info("Making source %d zsync metafile ..." % i)
                 osextras.unlink_force("%s.iso.zsync" % target_prefix)
                 zsyncmake(
@@ -510,17 +895,32 @@ class DailyTreePublisher(Publisher):
                 self.project, self.image_type, "%s-src" % self.config.series)
 
     def publish(self, date):
-        self.new_publish_dir(date)
+        """Publish a daily build, recording how long each stage takes."""
+        self.timer = StageTimer()
+        try:
+            self._publish(date)
+        finally:
+            timings_path = os.path.join(
+                self.config.root, "log", self.project, self.config.series,
+                "%s-%s.timings.json" % (self.image_type, date))
+            try:
+                self.timer.write(
+                    timings_path, project=self.project,
+                    series=self.config.series, image_type=self.image_type,
+                    date=date)
+            except (IOError, OSError) as e:
+                logger.warning("Couldn't write %s: %s" % (timings_path, e))
+
+    def _publish(self, date):
+        with self.timer.stage("new_publish_dir"):
+            self.new_publish_dir(date)
         published = []
         self.checksum_dirs = []
+        self.precomputed_checksums = {}
         if not self.config["CDIMAGE_ONLYSOURCE"]:
-            for arch in self.config.arches:
-                published.extend(
-                    list(self.publish_binary(self.publish_type, arch, date)))
+            published.extend(self.publish_binaries(self.publish_type, date))
             if self.project == "edubuntu" and self.publish_type == "server":
-                for arch in self.config.arches:
-                    published.extend(
-                        list(self.publish_binary("serveraddon", arch, date)))
+                published.extend(self.publish_binaries("serveraddon", date))
         published.extend(list(self.publish_source(date)))
 
         if not published:
@@ -539,22 +939,32 @@ class DailyTreePublisher(Publisher):
             osextras.unlink_force(target_report)
 
         if not self.config["CDIMAGE_ONLYSOURCE"]:
-            checksum_directory(
-                self.config, target_dir, old_directories=self.checksum_dirs,
-                map_expr=r"s/\.\(img\|img\.gz\|iso\|iso\.gz\|tar\.gz\)$/.raw/")
-            subprocess.check_call(
-                [os.path.join(self.config.root, "bin", "make-web-indices"),
-                 target_dir, self.config.series, "daily"])
+            with self.timer.stage(
+                "checksums", nbytes=directory_size(target_dir)):
+                checksum_directory(
+                    self.config, target_dir,
+                    old_directories=self.checksum_dirs,
+                    map_expr=(
+                        r"s/\.\(img\|img\.gz\|iso\|iso\.gz\|tar\.gz\)$/.raw/"),
+                    precomputed=self.precomputed_checksums)
+            with self.timer.stage("make-web-indices"):
+                make_web_indices(
+                    self.config, target_dir, self.config.series, "daily")
 
         target_dir_source = os.path.join(target_dir, "source")
         if os.path.isdir(target_dir_source):
-            checksum_directory(
-                self.config, target_dir_source,
-                old_directories=[os.path.join(self.image_output, "src")],
-                map_expr=r"s/\.\(img\|img\.gz\|iso\|iso\.gz\|tar\.gz\)$/.raw/")
-            subprocess.check_call(
-                [os.path.join(self.config.root, "bin", "make-web-indices"),
-                 target_dir_source, self.config.series, "daily"])
+            with self.timer.stage(
+                "checksums", arch="source",
+                nbytes=directory_size(target_dir_source)):
+                checksum_directory(
+                    self.config, target_dir_source,
+                    old_directories=[os.path.join(self.image_output, "src")],
+                    map_expr=(
+                        r"s/\.\(img\|img\.gz\|iso\|iso\.gz\|tar\.gz\)$/.raw/"))
+            with self.timer.stage("make-web-indices", arch="source"):
+                make_web_indices(
+                    self.config, target_dir_source, self.config.series,
+                    "daily")
 
         if (self.image_type.endswith("-live") or
             self.image_type.endswith("dvd")):
@@ -565,15 +975,11 @@ class DailyTreePublisher(Publisher):
             osextras.unlink_force(md5sums_metalink)
             osextras.unlink_force(md5sums_metalink_gpg)
             basedir, reldir = self.metalink_dirs(date)
-            if subprocess.call([
-                os.path.join(self.config.root, "bin", "make-metalink"),
-                basedir, self.config.series, reldir, "cdimage.ubuntu.com",
-                ]) == 0:
-                metalink_checksum_directory(self.config, target_dir)
-            else:
-                for name in os.listdir(target_dir):
-                    if name.endswith(".metalink"):
-                        osextras.unlink_force(os.path.join(target_dir, name))
+            with self.timer.stage("metalink"):
+                make_metalinks(
+                    self.config, basedir, self.config.series, reldir,
+                    "cdimage.ubuntu.com",
+                    precomputed=self.precomputed_checksums)
 
         publish_current = os.path.join(self.publish_base, "current")
         osextras.unlink_force(publish_current)
@@ -582,18 +988,21 @@ class DailyTreePublisher(Publisher):
         manifest_lock = os.path.join(
             self.config.root, "etc", ".lock-manifest-daily")
         try:
-            subprocess.check_call(["lockfile", "-r", "4", manifest_lock])
+            with self.timer.stage("manifest lock wait"):
+                subprocess.check_call(["lockfile", "-r", "4", manifest_lock])
         except subprocess.CalledProcessError:
             logger.error("Couldn't acquire manifest-daily lock!")
             raise
         try:
-            manifest_daily = os.path.join(
-                self.tree.directory, ".manifest-daily")
-            with AtomicFile(manifest_daily) as manifest_daily_file:
-                for line in self.tree.manifest():
-                    print(line, file=manifest_daily_file)
-            os.chmod(
-                manifest_daily, os.stat(manifest_daily).st_mode | stat.S_IWGRP)
+            with self.timer.stage("manifest write"):
+                index = DailyManifestIndex(self.tree)
+                if index.read():
+                    index.update(os.path.relpath(
+                        publish_current, self.tree.directory))
+                else:
+                    index.rebuild()
+                index.write()
+                index.write_manifest()
 
             # Create timestamps for this run.
             # TODO cjwatson 20120807: Shouldn't these be in www/full
@@ -606,9 +1015,126 @@ class DailyTreePublisher(Publisher):
         finally:
             osextras.unlink_force(manifest_lock)
 
-        subprocess.check_call([
-            os.path.join(self.config.root, "bin", "post-qa"), date,
-            ] + published)
+        with self.timer.stage("post-qa"):
+            subprocess.check_call([
+                os.path.join(self.config.root, "bin", "post-qa"), date,
+                ] + published)
+
+    def purge_days(self, key):
+        """Return the configured number of days to keep KEY's images.
+
+        Returns None if etc/purge-days has no entry for KEY.
+        """
+        path = os.path.join(self.config.root, "etc", "purge-days")
+        try:
+            with open(path) as purge_days:
+                for line in purge_days:
+                    words = line.split()
+                    if len(words) >= 2 and words[0] == key:
+                        return int(words[1])
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return None
+
+    def purge_candidates(self, days):
+        """Return the names of dated directories older than DAYS days.
+
+        The directory pointed to by the "current" symlink is never a
+        candidate.
+        """
+        oldest = (
+            datetime.date.today() - datetime.timedelta(days=days)).strftime(
+            "%Y%m%d")
+        publish_current = os.path.join(self.publish_base, "current")
+        if os.path.islink(publish_current):
+            current = os.readlink(publish_current)
+        else:
+            current = None
+        candidates = []
+        for name in sorted(osextras.listdir_force(self.publish_base)):
+            if not os.path.isdir(os.path.join(self.publish_base, name)):
+                continue
+            if not name[:1].isdigit():
+                continue
+            if oldest <= name:
+                continue
+            if name == current:
+                continue
+            candidates.append(name)
+        return candidates
+
+    def purge(self, days=None, dry_run=False, jobs=None):
+        """Purge old dated directories of this image type.
+
+        If DAYS is None, it is taken from etc/purge-days.  With DRY_RUN,
+        report what would be purged and how much space that would free,
+        but do not delete anything.  Returns (purged, total, freed): the
+        names of the directories purged, their disk usage, and the number
+        of bytes actually freed given that many of their files are
+        hardlinked from directories that are being kept.
+        """
+        project_image_type = "%s/%s" % (self.project, self.image_type)
+        if days is None:
+            days = self.purge_days(project_image_type)
+            if days is None:
+                days = self.purge_days(self.image_type)
+            if days is None:
+                logger.info(
+                    "No purge time configured for %s" % project_image_type)
+                return [], 0, 0
+        if days == 0:
+            logger.info("Not purging images for %s" % project_image_type)
+            return [], 0, 0
+        logger.info("Purging %s images older than %d days ..." % (
+            project_image_type, days))
+
+        if not os.path.isdir(self.publish_base):
+            logger.info("No old images to purge")
+            return [], 0, 0
+        purged = self.purge_candidates(days)
+        paths = [os.path.join(self.publish_base, name) for name in purged]
+        total, freed = purge_usage(paths)
+        for name in purged:
+            if dry_run:
+                logger.info("Would purge %s/%s" % (self.image_type_dir, name))
+            else:
+                logger.info("Purging %s/%s" % (self.image_type_dir, name))
+
+        if not dry_run:
+            if jobs is None:
+                jobs = purge_jobs(self.config)
+            try:
+                if paths:
+                    pool = ThreadPool(max(1, min(jobs, len(paths))))
+                    try:
+                        pool.map(_purge_directory, paths, chunksize=1)
+                    finally:
+                        pool.close()
+                        pool.join()
+            finally:
+                cache = ChecksumCache(self.config)
+                if os.path.exists(cache.path):
+                    with cache:
+                        cache.prune()
+
+        # Files that are still linked from kept directories take up space
+        # in the total but are not freed.
+        if dry_run:
+            logger.info("Would purge %d directories; would free %s of %s" % (
+                len(purged), format_size(freed), format_size(total)))
+        else:
+            logger.info("Purged %d directories; freed %s of %s" % (
+                len(purged), format_size(freed), format_size(total)))
+        return purged, total, freed
+
+
+def _purge_directory(path):
+    """Remove PATH as rm -rf would, logging any errors and carrying on."""
+    def onerror(function, failed_path, exc_info):
+        logger.warning("Failed to remove %s: %s" % (failed_path, exc_info[1]))
+
+    shutil.rmtree(path, onerror=onerror)
 
 
 class SimpleTree(Tree):
@@ -628,26 +1154,53 @@ class SimpleTree(Tree):
             logger.warning("Unknown version: %s" % version)
             raise
 
+    def _walk_manifest(self, dirpath, relative_dirpath, mode, main, pool):
+        # MODE is "main" outside .pool directories, "pool" directly inside
+        # one, and "pruned" in subdirectories of a .pool directory.
+        try:
+            with osextras.scandir(dirpath) as scanned:
+                entries = list(scanned)
+        except OSError:
+            return
+        for entry in sorted(entries, key=lambda entry: entry.name):
+            relative_path = os.path.join(relative_dirpath, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name == ".pool":
+                    submode = "pool"
+                elif mode == "main":
+                    submode = "main"
+                else:
+                    submode = "pruned"
+                self._walk_manifest(
+                    entry.path, relative_path, submode, main, pool)
+            elif mode != "pruned":
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if self.manifest_file_allowed(entry.path, st=st):
+                    if mode == "main":
+                        main.append((relative_path, st))
+                    else:
+                        pool.append((relative_path, st))
+
+    def manifest_entries(self):
+        """Yield (path, stat result) for each file in the manifest.
+
+        Files in .pool directories are only included if no file with the
+        same name exists outside a .pool directory.
+        """
+        main = []
+        pool = []
+        self._walk_manifest(self.directory, "", "main", main, pool)
+        main_filenames = set(os.path.basename(path) for path, _ in main)
+        for path, st in main:
+            yield path, st
+        for path, st in pool:
+            if os.path.basename(path) not in main_filenames:
+                yield path, st
+
     def manifest_files(self):
         """Yield all the files to include in a manifest of this tree."""
-        main_filenames = set()
-        for dirpath, dirnames, filenames in os.walk(self.directory):
-            relative_dirpath = dirpath[len(self.directory) + 1:]
-            try:
-                del dirnames[dirnames.index(".pool")]
-            except ValueError:
-                pass
-            for filename in filenames:
-                path = os.path.join(dirpath, filename)
-                if self.manifest_file_allowed(path):
-                    main_filenames.add(filename)
-                    yield os.path.join(relative_dirpath, filename)
-
-        for dirpath, _, filenames in os.walk(self.directory):
-            if os.path.basename(dirpath) == ".pool":
-                relative_dirpath = dirpath[len(self.directory) + 1:]
-                for filename in filenames:
-                    if filename not in main_filenames:
-                        path = os.path.join(dirpath, filename)
-                        if self.manifest_file_allowed(path):
-                            yield os.path.join(relative_dirpath, filename)
+        for path, _ in self.manifest_entries():
+            yield path
@@ -0,0 +1,692 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate HEADER.html, FOOTER.html, and .htaccess for image directories."""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+from fnmatch import fnmatchcase
+import os
+import re
+from string import Template
+
+from cdimage.config import Series
+from cdimage.log import logger
+
+
+_counts = {
+    1: "one", 2: "two", 3: "three", 4: "four", 5: "five",
+    6: "six", 7: "seven", 8: "eight", 9: "nine",
+    }
+
+# Series names, versions, and display names come from etc/series.  LTS
+# series are shown with the version of their latest point release, and
+# marked as LTS for the projects that were supported for the long term.
+_lts_series = {
+    "dapper": ("6.06.2", ("ubuntu", "kubuntu", "edubuntu", "ubuntu-server")),
+    "hardy": ("8.04.4", ("ubuntu", "ubuntu-server")),
+    "lucid": ("10.04.4", ("ubuntu", "kubuntu", "ubuntu-server")),
+    "precise": ("12.04.2", ("ubuntu", "kubuntu", "ubuntu-server")),
+    }
+
+_cdtypes = (
+    "live", "desktop", "server", "install", "alternate", "serveraddon",
+    "addon", "dvd", "src",
+    )
+
+_arches = (
+    "i386", "amd64", "amd64+mac", "armel", "armhf", "powerpc", "powerpc+ps3",
+    "hppa", "ia64", "lpia", "sparc",
+    )
+
+_htaccess_extensions = (
+    "img.zsync", "img", "iso.torrent", "iso.zsync", "iso", "jigdo", "list",
+    "manifest", "manifest-desktop", "manifest-remove", "template",
+    )
+
+_mimetype_extensions = (
+    "img", "iso.torrent", "iso", "jigdo", "list", "manifest",
+    "manifest-desktop", "manifest-remove", "template",
+    )
+
+# Some MIME types aren't configured by default.
+_mimetypes = {
+    "img": "application/octet-stream",
+    }
+
+_archstrs = {
+    "amd64": "64-bit PC (AMD64)",
+    "amd64+mac": "64-bit Mac (AMD64)",
+    "armel": "ARM EABI",
+    "armhf": "ARM EABI (Hard-Float)",
+    "hppa": "HP PA-RISC",
+    "i386": "PC (Intel x86)",
+    "ia64": "IA-64",
+    "lpia": "Low-Power Intel Architecture",
+    "powerpc": "Mac (PowerPC) and IBM-PPC (POWER5)",
+    "powerpc+ps3": "PlayStation 3",
+    "sparc": "SPARC",
+    }
+
+_extensionstrs = {
+    "img": "USB image",
+    "iso": "standard download",
+    "iso.torrent": (
+        '<a href=\\"https://help.ubuntu.com/community/BitTorrent\\">'
+        'BitTorrent</a> download'),
+    "jigdo": '<a href=\\"http://atterer.org/jigdo/\\">jigdo</a> download',
+    "list": "file listing",
+    "manifest": "contents of live filesystem",
+    "manifest-desktop": "contents of desktop part of live filesystem",
+    "manifest-remove":
+        "packages to remove from live filesystem on installation",
+    "template": '<a href=\\"http://atterer.org/jigdo/\\">jigdo</a> template',
+    "iso.zsync": (
+        '<a href=\\"http://zsync.moria.org.uk/\\">zsync</a> metafile'),
+    "img.zsync": (
+        '<a href=\\"http://zsync.moria.org.uk/\\">zsync</a> metafile'),
+    }
+
+_cdtypedesc_templates = {
+    "live": Template("""\
+<p>The live $CD allows you to try $CAPPROJECT without changing your computer
+at all, and at your option to install it permanently later.</p>
+"""),
+    "desktop-edubuntu": Template("""\
+<p>The desktop $CD allows you to try $CAPPROJECT without changing your
+computer at all, and at your option to install it permanently later. You
+will need at least ${DESKTOP_RAM}MiB of RAM to install from this $CD. You
+can install additional educational programs using the classroom server
+add-on $CD.</p>
+"""),
+    "desktop": Template("""\
+<p>The desktop $CD allows you to try $CAPPROJECT without changing your
+computer at all, and at your option to install it permanently later. This
+type of $CD is what most people will want to use. You will need at least
+${DESKTOP_RAM}MiB of RAM to install from this $CD.</p>
+"""),
+    "install": Template("""\
+<p>The install $CD allows you to install $CAPPROJECT permanently on a
+computer.</p>
+"""),
+    "alternate": Template("""\
+<p>The alternate install $CD allows you to perform certain specialist
+installations of $CAPPROJECT. It provides for the following situations:</p>
+
+<ul>
+<li>setting up automated deployments;
+<li>upgrading from older installations without network access;
+<li>LVM and/or RAID partitioning;
+<li>installs on systems with less than about ${DESKTOP_RAM}MiB of RAM
+(although note that low-memory systems may not be able to run a full desktop
+environment reasonably).
+</ul>
+
+<p>
+In the event that you encounter a bug using the alternate installer,
+please file a bug on the
+<a href="https://bugs.launchpad.net/ubuntu/+source/debian-installer/\
++filebug">debian-installer</a>
+package.
+</p>
+"""),
+    "server-edubuntu": Template("""\
+<p>The classroom server $CD allows you to install $CAPPROJECT permanently on
+a computer. It includes LTSP (Linux Terminal Server Project) support,
+providing out-of-the-box thin client support. After installation you can
+install additional educational programs using the classroom server add-on
+$CD.</p>
+"""),
+    "server": Template("""\
+<p>The server install $CD allows you to install $CAPPROJECT permanently on a
+computer for use as a server. It will not install a graphical user
+interface.</p>
+"""),
+    "netbook": Template("""\
+<p>The live $CD allows you to try ${CAPPROJECT_NETBOOK} Netbook Edition \
+without changing
+your computer at all, and at your option to install it permanently later.
+This live $CD is optimized for netbooks with screens up to 10". You will need
+at least ${DESKTOP_RAM}MiB of RAM to install from this $CD.</p>
+"""),
+    "active": Template("""\
+<p>The Active Image offers a preview of the Plasma Active workspace to try or
+install.</p>
+"""),
+    "serveraddon": Template("""\
+<p>The classroom server add-on $CD contains additional useful packages,
+including many educational programs and all available language packs. It
+requires that an $CAPPROJECT desktop be installed on the machine.</p>
+"""),
+    "addon": Template("""\
+<p>The add-on $CD contains additional useful packages, including many
+educational programs and all available language packs. It requires that an
+Ubuntu desktop system already be installed.</p>
+"""),
+    "dvd-edubuntu": Template("""\
+<p>The install DVD allows you to install $CAPPROJECT permanently on a
+computer.</p>
+"""),
+    "dvd": Template("""\
+<p>The combined install/live DVD allows you either to install $CAPPROJECT
+permanently on a computer, or (by entering 'live' at the boot prompt) to try
+$CAPPROJECT without changing your computer at all.</p>
+"""),
+    "src": Template("""\
+<p>The source ${CD}s contain the source code used to build $CAPPROJECT.</p>
+
+<p>Some source package versions on this image may not match related binary
+images, depending on exactly when the images were built.  You can always
+find every version of Ubuntu source packages on Launchpad, using URLs of the
+following form:</p>
+
+<ul>
+ <li><code>https://launchpad.net/ubuntu/+source/SOURCE-PACKAGE-NAME/\
++publishinghistory</code> (index)</li>
+ <li><code>https://launchpad.net/ubuntu/+source/SOURCE-PACKAGE-NAME/\
+VERSION</code> (specific version)</li>
+</ul>
+"""),
+    }
+
+_archdesc_templates = {
+    "amd64": Template("""\
+Choose this to take full advantage of computers based on the AMD64 or EM64T
+architecture (e.g., Athlon64, Opteron, EM64T Xeon). If you have a non-64-bit
+processor made by AMD, or if you need full support for 32-bit code, use the
+Intel x86 images instead.
+"""),
+    "amd64+mac": Template("""\
+Choose this to take full advantage of computers based on the AMD64 or EM64T
+architecture (e.g., Athlon64, Opteron, EM64T Xeon). If you have a non-64-bit
+processor made by AMD, or if you need full support for 32-bit code, use the
+Intel x86 images instead. This image is adjusted to work properly on Mac
+systems.
+"""),
+    "armel": Template("""\
+For ARMv7 processors and above.
+"""),
+    "armhf": Template("""\
+For ARMv7 processors and above (Hard-Float).
+"""),
+    "hppa": Template("""\
+For HP PA-RISC computers.
+"""),
+    "i386": Template("""\
+For almost all PCs. This includes most machines with Intel/AMD/etc type
+processors and almost all computers that run Microsoft Windows, as well as
+newer Apple Macintosh systems based on Intel processors. Choose this if you
+are at all unsure.
+"""),
+    "ia64": Template("""\
+For Intel Itanium and Itanium 2 computers.
+"""),
+    "lpia": Template("""\
+For devices using the Low-Power Intel Architecture, including the A1xx and \
+Atom processors.
+"""),
+    "powerpc": Template("""\
+For Apple Macintosh G3, G4, and G5 computers, including iBooks and
+PowerBooks as well as IBM OpenPower machines.
+"""),
+    "powerpc+ps3": Template("""\
+For Sony PlayStation 3 systems.
+"""),
+    "powerpc+ps3-desktop": Template("""\
+(This defaults to installing $CAPPROJECT permanently, since there is usually
+not enough memory to try out the full desktop system and run the installer
+at the same time. An alternative boot option to try $CAPPROJECT without
+changing your computer is available.)
+"""),
+    "sparc": Template("""\
+For Sun UltraSPARC computers, including those based on the multicore
+UltraSPARC T1 ("Niagara") processors.
+"""),
+    }
+
+_oversized_templates = {
+    "cd": Template("""\
+<br>
+<span class="urgent">Warning: This image is oversized (which is a bug) and
+will not fit onto a standard 703MiB CD. However, you may still test it using
+a DVD, a USB drive, or a virtual machine.</span>
+"""),
+    "dvd": Template("""\
+<br>
+<span class="urgent">Warning: This image is oversized (which is a bug) and
+will not fit onto a single-sided single-layer DVD. However, you may still
+test it using a larger USB drive or a virtual machine.</span>
+"""),
+    }
+
+_header_start_template = Template("""\
+<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN"
+ "http://www.w3.org/TR/html4/strict.dtd">
+<html>
+ <head>
+  <title>$CAPPROJECT $distversion ($distfullname)$distextra</title>
+  <!-- Main style sheets for CSS2 capable browsers -->
+  <style type="text/css" media="screen">
+""")
+
+_header_css_template = Template("""\
+  @import url($css);
+""")
+
+_header_body_template = Template("""\
+  pre { background: none; }
+  body { margin: 2em; }
+  </style>
+ </head>
+ <body><div id="pageWrapper">
+
+<div id="header"><a href="http://www.ubuntu.com/"></a></div>
+
+<h1>$CAPPROJECT $distversion ($distfullname)$distextra</h1>
+
+<div id="main">
+
+<h2>Select an image</h2>
+
+""")
+
+_header_torrent = """\
+<p>A full list of available files, including <a
+href="https://help.ubuntu.com/community/BitTorrent">BitTorrent</a> files,
+can be found below.</p>
+
+"""
+
+_header_no_torrent = """\
+<p>A full list of available files can be found below.</p>
+
+"""
+
+_header_end = """\
+<p>If you need help burning these images to disk, see the
+<a href="https://help.ubuntu.com/community/BurningIsoHowto">Image Burning \
+Guide</a>.</p>
+
+"""
+
+_footer = """\
+</div></div></body></html>
+"""
+
+_htaccess_template = Template("""\
+
+HeaderName HEADER.html
+ReadmeName FOOTER.html
+IndexIgnore .htaccess HEADER.html FOOTER.html
+IndexOptions NameWidth=* DescriptionWidth=* SuppressHTMLPreamble \
+FancyIndexing IconHeight=22 IconWidth=22
+AddIcon ${CDICONS}folder.png ^^DIRECTORY^^
+AddIcon ${CDICONS}iso.png .iso
+AddIcon ${CDICONS}jigdo.png .jigdo .template
+AddIcon ${CDICONS}list.png .list .manifest .html .zsync MD5SUMS MD5SUMS.gpg \
+MD5SUMS-metalink MD5SUMS-metalink.gpg SHA1SUMS SHA1SUMS.gpg SHA256SUMS \
+SHA256SUMS.gpg
+AddIcon ${CDICONS}torrent.png .torrent .metalink
+""")
+
+
+def _titlecase(text):
+    return "\n".join(line[:1].upper() + line[1:] for line in text.split("\n"))
+
+
+def _numeric_sort_key(line):
+    """Sort key equivalent to "sort -n" in the C locale."""
+    match = re.match(r"\s*(-?)(\d*)(?:\.(\d*))?", line)
+    sign, integer, fraction = match.groups()
+    value = float("%s.%s" % (integer or "0", fraction or "0"))
+    if sign:
+        value = -value
+    return value, line
+
+
+class WebIndices:
+    """Generate web index files for a directory of images.
+
+    DIRECTORY holds images whose names start with one of the
+    space-separated prefixes in CDPREFIX.  STATUS is "daily" for daily
+    builds or "release" for release builds.
+    """
+
+    def __init__(self, config, directory, cdprefix, status="release"):
+        self.config = config
+        self.directory = directory
+        self.cdprefix = cdprefix
+        self.status = status
+        self.project = config["PROJECT"]
+        self.capproject = config["CAPPROJECT"]
+        self.dist = config["DIST"]
+
+    def count(self, number):
+        if number in _counts:
+            return _counts[number]
+        logger.warning("Can't count up to %d!" % number)
+        return ""
+
+    def cssincludes(self):
+        if self.project.startswith("kubuntu"):
+            return ["http://releases.ubuntu.com/include/kubuntu.css"]
+        else:
+            return ["http://releases.ubuntu.com/include/style.css"]
+
+    def cd(self):
+        if self.dist < "quantal":
+            # Ubuntu Studio is expected to be oversized in Gutsy; sigh.
+            if self.project == "ubuntustudio":
+                return "DVD"
+            else:
+                return "CD"
+        else:
+            return "image"
+
+    def desktop_ram(self):
+        if self.project == "xubuntu":
+            if self.dist <= "intrepid":
+                return 128
+            else:
+                return 192
+        elif self.dist <= "feisty":
+            return 256
+        elif self.dist <= "gutsy":
+            return 320
+        elif self.dist <= "hardy":
+            return 384
+        elif self.dist <= "maverick":
+            return 256
+        else:
+            return 384
+
+    def cdtypestr(self, cdtype):
+        cd = self.cd()
+        if cdtype == "live":
+            return "live %s" % cd
+        elif cdtype == "desktop":
+            return "desktop %s" % cd
+        elif cdtype == "install":
+            return "install %s" % cd
+        elif cdtype == "alternate":
+            return "alternate install %s" % cd
+        elif cdtype == "server":
+            if self.project == "edubuntu":
+                return "classroom server %s" % cd
+            else:
+                return "server install %s" % cd
+        elif cdtype == "serveraddon":
+            # Edubuntu only
+            return "classroom server add-on %s" % cd
+        elif cdtype == "addon":
+            # Edubuntu only
+            return "add-on %s" % cd
+        elif cdtype == "dvd":
+            return "install/live DVD"
+        elif cdtype == "src":
+            return "source %s" % cd
+        elif cdtype == "netbook":
+            return "netbook live %s" % cd
+        elif cdtype == "active":
+            return "preview active image"
+        else:
+            logger.warning("Unknown image type %s!" % cdtype)
+            return ""
+
+    def cdtypedesc(self, cdtype):
+        key = cdtype
+        if (cdtype in ("desktop", "server", "dvd") and
+                self.project == "edubuntu"):
+            key = "%s-edubuntu" % cdtype
+        if key not in _cdtypedesc_templates:
+            logger.warning("Unknown image type %s!" % cdtype)
+            return ""
+        capproject_netbook = self.capproject
+        if capproject_netbook.endswith("-Netbook"):
+            capproject_netbook = capproject_netbook[:-len("-Netbook")]
+        return _cdtypedesc_templates[key].substitute(
+            CD=self.cd(), CAPPROJECT=self.capproject,
+            CAPPROJECT_NETBOOK=capproject_netbook,
+            DESKTOP_RAM=self.desktop_ram())
+
+    def archstr(self, arch):
+        if arch not in _archstrs:
+            logger.warning("Unknown architecture %s!" % arch)
+            return ""
+        return _archstrs[arch]
+
+    def archdesc(self, arch, cdtype):
+        if arch not in _archdesc_templates:
+            logger.warning("Unknown architecture %s!" % arch)
+            return ""
+        desc = _archdesc_templates[arch].substitute(
+            CAPPROJECT=self.capproject)
+        if (arch == "powerpc+ps3" and cdtype == "desktop" and
+                self.dist >= "gutsy"):
+            desc += _archdesc_templates["powerpc+ps3-desktop"].substitute(
+                CAPPROJECT=self.capproject)
+        return desc
+
+    def maybe_oversized(self, path, cdtype):
+        if self.status == "daily" and os.path.exists(path):
+            if cdtype == "dvd" or self.project == "ubuntustudio":
+                realtype = "dvd"
+            else:
+                realtype = "cd"
+            return _oversized_templates[realtype].substitute()
+        return ""
+
+    def extensionstr(self, extension):
+        if extension not in _extensionstrs:
+            logger.warning("Unknown extension %s!" % extension)
+            return ""
+        return _extensionstrs[extension]
+
+    def dist_version(self):
+        """Return the version, full name, and any suffix for the title."""
+        try:
+            series = Series.find_by_name(str(self.dist))
+        except ValueError:
+            return "", ""
+        version = series.version
+        if series.name in _lts_series:
+            version, lts_projects = _lts_series[series.name]
+            if self.project in lts_projects:
+                version = "%s LTS" % version
+        return version, series.displayname
+
+    def prefixes(self):
+        """Return the prefixes to search, and any suffix for the title."""
+        cdprefix = self.cdprefix
+        if fnmatchcase(cdprefix, "*-alpha-*"):
+            extra = " Alpha %s" % cdprefix.split("-alpha-", 1)[1]
+        elif cdprefix.endswith("-preview"):
+            extra = " Preview"
+        elif cdprefix.endswith("-beta"):
+            extra = " Beta"
+        elif fnmatchcase(cdprefix, "*-beta?*"):
+            extra = " Beta %s" % cdprefix.rsplit("-beta", 1)[1]
+        elif cdprefix.endswith("-rc"):
+            extra = " Release Candidate"
+        elif cdprefix == str(self.dist):
+            extra = " Daily Build"
+        elif fnmatchcase(cdprefix, "*.*.*"):
+            # point release - need the base version too
+            cdprefix = "%s %s" % (cdprefix, cdprefix.rsplit(".", 1)[0])
+            extra = ""
+        else:
+            extra = ""
+        return cdprefix.split(), extra
+
+    def find_files(self, pattern):
+        """Return the names of regular files matching PATTERN."""
+        return [
+            name for name in sorted(os.listdir(self.directory))
+            if fnmatchcase(name, pattern) and
+            os.path.isfile(os.path.join(self.directory, name))]
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.directory, name))
+
+    def cdicons(self):
+        # We may not be mirrored to the webserver root, so calculate a
+        # relative path for the icons.
+        cdicons = "cdicons/"
+        for part in reversed(os.path.realpath(self.directory).split("/")):
+            if not part:
+                continue
+            if part in ("full", "simple"):
+                break
+            cdicons = "../%s" % cdicons
+        if self.project.startswith("kubuntu"):
+            cdicons = "%skubuntu-" % cdicons
+        return cdicons
+
+    def generate(self):
+        """Return the contents of HEADER.html, FOOTER.html, and .htaccess."""
+        prefixes, distextra = self.prefixes()
+        distversion, distfullname = self.dist_version()
+        header = []
+        htaccess = []
+
+        title = dict(
+            CAPPROJECT=self.capproject, distversion=distversion,
+            distfullname=distfullname, distextra=distextra)
+        header.append(_header_start_template.substitute(title))
+        for css in self.cssincludes():
+            header.append(_header_css_template.substitute(css=css))
+        header.append(_header_body_template.substitute(title))
+
+        present = [
+            (prefix, cdtype)
+            for prefix in prefixes for cdtype in _cdtypes
+            if self.find_files("%s-%s-*.list" % (prefix, cdtype))]
+
+        if len(present) > 1:
+            header.append(
+                "<p>%s is distributed on %s types of images described "
+                "below.</p>\n\n" % (self.capproject, self.count(len(present))))
+
+        foundtorrent = False
+
+        for prefix, cdtype in present:
+            if cdtype == "src":
+                # Perverse, but works.
+                start = "%s-%s-" % (prefix, cdtype)
+                arches = sorted(
+                    (name[len(start):-len(".iso")]
+                     for name in self.find_files("%s*.iso" % start)),
+                    key=_numeric_sort_key)
+                arches = " ".join(arches).split()
+            else:
+                arches = _arches
+
+            cdtypestr = self.cdtypestr(cdtype)
+            header.append("<h3>%s</h3>\n\n%s\n\n" % (
+                _titlecase(cdtypestr),
+                self.cdtypedesc(cdtype).rstrip("\n")))
+
+            archcount = len([
+                arch for arch in arches
+                if self.exists("%s-%s-%s.list" % (prefix, cdtype, arch))])
+            if archcount == 1:
+                header.append("<p>There is one image available:</p>\n")
+            elif cdtype == "src":
+                header.append(
+                    "<p>There are %s images available:</p>\n" %
+                    self.count(archcount))
+            else:
+                header.append(
+                    "<p>There are %s images available, each for a "
+                    "different type of computer:</p>\n" %
+                    self.count(archcount))
+
+            header.append("\n<dl>\n")
+
+            for arch in arches:
+                if cdtype == "src":
+                    imagestr = "%s %s" % (_titlecase(cdtypestr), arch)
+                    htaccessimagestr = imagestr
+                else:
+                    imagestr = "%s %s" % (self.archstr(arch), cdtypestr)
+                    htaccessimagestr = "%s for %s computers" % (
+                        _titlecase(cdtypestr), self.archstr(arch))
+
+                base = "%s-%s-%s" % (prefix, cdtype, arch)
+                if self.exists("%s.iso" % base):
+                    header.append(
+                        '<dt><a href="%s.iso">%s</a>\n' % (base, imagestr))
+                elif self.exists("%s.iso.torrent" % base):
+                    header.append(
+                        '<dt><a href="%s.iso.torrent">%s (<a '
+                        'href="https://help.ubuntu.com/community/BitTorrent">'
+                        'BitTorrent</a> only)</a>\n' % (base, imagestr))
+                else:
+                    continue
+
+                if self.exists("%s.iso.torrent" % base):
+                    foundtorrent = True
+
+                if cdtype != "src":
+                    header.append("\n<dd>%s%s</dd>\n\n" % (
+                        self.archdesc(arch, cdtype).rstrip("\n"),
+                        self.maybe_oversized(
+                            os.path.join(
+                                self.directory, "%s.OVERSIZED" % base),
+                            cdtype).rstrip("\n")))
+
+                for extension in _htaccess_extensions:
+                    if self.exists("%s.%s" % (base, extension)):
+                        htaccess.append(
+                            'AddDescription "%s (%s)" %s.%s\n' % (
+                                htaccessimagestr,
+                                self.extensionstr(extension),
+                                base, extension))
+
+            header.append("</dl>\n\n")
+
+        if foundtorrent:
+            header.append(_header_torrent)
+        else:
+            header.append(_header_no_torrent)
+        header.append(_header_end)
+
+        htaccess.append(_htaccess_template.substitute(CDICONS=self.cdicons()))
+        for extension in _mimetype_extensions:
+            mimetype = _mimetypes.get(extension)
+            if mimetype and self.find_files("*.%s" % extension):
+                htaccess.append("AddType %s .%s\n" % (mimetype, extension))
+
+        return "".join(header), _footer, "".join(htaccess)
+
+    def write(self):
+        header, footer, htaccess = self.generate()
+        for name, contents in (
+            (".htaccess", htaccess),
+            ("HEADER.html", header),
+            ("FOOTER.html", footer),
+            ):
+            path = os.path.join(self.directory, name)
+            if os.path.lexists(path):
+                os.unlink(path)
+            with open(path, "w") as output:
+                output.write(contents)
+
+
+def make_web_indices(config, directory, cdprefix, status="release"):
+    """Write HEADER.html, FOOTER.html, and .htaccess in DIRECTORY."""
+    WebIndices(config, directory, cdprefix, status=status).write()
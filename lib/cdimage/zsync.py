@@ -0,0 +1,263 @@
+# Copyright (C) 2012 Canonical Ltd.
+# Author: Colin Watson <cjwatson@ubuntu.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Generate zsync metafiles.
+
+This produces the same output as "zsyncmake -Z" from zsync 0.6.2, but
+lets the caller feed the image data in, so that the read can be shared
+with checksum generation.  The rolling checksums are computed a chunk of
+blocks at a time using numpy if it is available; otherwise a (much
+slower) pure Python implementation is used.
+"""
+
+from __future__ import print_function
+
+__metaclass__ = type
+
+import hashlib
+import math
+import os
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+ZSYNC_VERSION = "0.6.2"
+
+# Process this much buffered data at a time.
+_CHUNK_SIZE = 1024 * 1024
+
+
+def _lrot(x, n):
+    return ((x << n) | (x >> (32 - n))) & 0xffffffff
+
+
+def _pure_md4(data):
+    """MD4 (RFC 1320), for systems whose hashlib does not provide it."""
+    message = bytearray(data)
+    bit_length = (len(message) * 8) & 0xffffffffffffffff
+    message.append(0x80)
+    while len(message) % 64 != 56:
+        message.append(0)
+    message += struct.pack("<Q", bit_length)
+
+    state = [0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476]
+    rounds = (
+        (lambda x, y, z: (x & y) | (~x & z), 0,
+         list(range(16)), (3, 7, 11, 19)),
+        (lambda x, y, z: (x & y) | (x & z) | (y & z), 0x5a827999,
+         [0, 4, 8, 12, 1, 5, 9, 13, 2, 6, 10, 14, 3, 7, 11, 15],
+         (3, 5, 9, 13)),
+        (lambda x, y, z: x ^ y ^ z, 0x6ed9eba1,
+         [0, 8, 4, 12, 2, 10, 6, 14, 1, 9, 5, 13, 3, 11, 7, 15],
+         (3, 9, 11, 15)),
+        )
+    for offset in range(0, len(message), 64):
+        words = struct.unpack("<16I", bytes(message[offset:offset + 64]))
+        v = list(state)
+        for function, constant, order, shifts in rounds:
+            for i, k in enumerate(order):
+                # Registers are updated in the order a, d, c, b.
+                j = (0, 3, 2, 1)[i % 4]
+                v[j] = _lrot(
+                    (v[j] + function(v[(j + 1) % 4], v[(j + 2) % 4],
+                                     v[(j + 3) % 4]) +
+                     words[k] + constant) & 0xffffffff,
+                    shifts[i % 4])
+        state = [(s + x) & 0xffffffff for s, x in zip(state, v)]
+    return struct.pack("<4I", *state)
+
+
+def _hashlib_has_md4():
+    try:
+        hashlib.new("md4")
+    except ValueError:
+        return False
+    return True
+
+
+if _hashlib_has_md4():
+    def md4_digest(data):
+        return hashlib.new("md4", data).digest()
+else:
+    md4_digest = _pure_md4
+
+
+def native_zsync_fast():
+    """Is the native generator fast enough to use for real images?"""
+    return numpy is not None and md4_digest is not _pure_md4
+
+
+def zsync_blocksize(length):
+    """Choose a block size as zsyncmake does."""
+    if length < 100000000:
+        return 2048
+    else:
+        return 4096
+
+
+def zsync_hash_lengths(length, blocksize):
+    """Return (seq_matches, rsum_bytes, checksum_bytes) as zsyncmake does."""
+    length = max(length, 1)
+    if length > blocksize:
+        seq_matches = 2
+    else:
+        seq_matches = 1
+    rsum_len = int(math.ceil(
+        ((math.log(length) + math.log(blocksize)) / math.log(2) - 8.6) /
+        seq_matches / 8))
+    rsum_len = max(2, min(4, rsum_len))
+    blocks_log = math.log(1 + length // blocksize)
+    checksum_len = int(math.ceil(
+        (20 + (math.log(length) + blocks_log) / math.log(2)) /
+        seq_matches / 8))
+    checksum_len2 = int((7.9 + (20 + blocks_log / math.log(2))) / 8)
+    checksum_len = min(16, max(checksum_len, checksum_len2))
+    return seq_matches, rsum_len, checksum_len
+
+
+def _rsums_pure(data, blocksize):
+    rsums = []
+    for offset in range(0, len(data), blocksize):
+        block = bytearray(data[offset:offset + blocksize])
+        a = sum(block) & 0xffff
+        b = sum((blocksize - i) * c for i, c in enumerate(block)) & 0xffff
+        rsums.append(struct.pack(">HH", a, b))
+    return rsums
+
+
+def _rsums_numpy(data, blocksize, weights):
+    blocks = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+        -1, blocksize)
+    a = blocks.sum(axis=1, dtype=numpy.uint64) & 0xffff
+    b = blocks.dot(weights) & 0xffff
+    packed = numpy.empty((len(blocks), 2), dtype=">u2")
+    packed[:, 0] = a
+    packed[:, 1] = b
+    raw = packed.tobytes()
+    return [raw[i:i + 4] for i in range(0, len(raw), 4)]
+
+
+_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_MONTHS = (
+    "Jan", "Feb", "Mar", "Apr", "May", "Jun",
+    "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def _format_mtime(mtime):
+    tm = time.gmtime(mtime)
+    return "%s, %02d %s %04d %02d:%02d:%02d +0000" % (
+        _DAYS[tm.tm_wday], tm.tm_mday, _MONTHS[tm.tm_mon - 1], tm.tm_year,
+        tm.tm_hour, tm.tm_min, tm.tm_sec)
+
+
+class ZsyncGenerator:
+    """Build a zsync metafile from data fed to it in order.
+
+    Like a hashlib object, data is passed to update; LENGTH must be known
+    up front so that the block size can be chosen before reading.
+    """
+
+    def __init__(self, length, blocksize=None):
+        self.length = length
+        if blocksize is None:
+            blocksize = zsync_blocksize(length)
+        self.blocksize = blocksize
+        self.sha1 = hashlib.sha1()
+        self.block_sums = []
+        self._pending = []
+        self._pending_size = 0
+        self._finished = False
+        if numpy is not None:
+            self._weights = numpy.arange(
+                blocksize, 0, -1, dtype=numpy.uint64)
+
+    def _process(self, data):
+        if numpy is not None:
+            rsums = _rsums_numpy(data, self.blocksize, self._weights)
+        else:
+            rsums = _rsums_pure(data, self.blocksize)
+        for i, rsum in enumerate(rsums):
+            offset = i * self.blocksize
+            self.block_sums.append(
+                rsum + md4_digest(data[offset:offset + self.blocksize]))
+
+    def update(self, data):
+        self.sha1.update(data)
+        self._pending.append(data)
+        self._pending_size += len(data)
+        if self._pending_size >= _CHUNK_SIZE:
+            buf = b"".join(self._pending)
+            whole = len(buf) - len(buf) % self.blocksize
+            self._process(buf[:whole])
+            self._pending = [buf[whole:]]
+            self._pending_size = len(buf) - whole
+
+    def finish(self):
+        if self._finished:
+            return
+        buf = b"".join(self._pending)
+        if buf:
+            if len(buf) % self.blocksize:
+                buf += b"\0" * (self.blocksize - len(buf) % self.blocksize)
+            self._process(buf)
+        self._pending = []
+        self._pending_size = 0
+        self._finished = True
+
+    def write(self, path, filename, url, mtime=None):
+        """Write the metafile to PATH."""
+        self.finish()
+        seq_matches, rsum_len, checksum_len = zsync_hash_lengths(
+            self.length, self.blocksize)
+        headers = ["zsync: %s" % ZSYNC_VERSION, "Filename: %s" % filename]
+        if mtime is not None:
+            headers.append("MTime: %s" % _format_mtime(mtime))
+        headers.extend([
+            "Blocksize: %d" % self.blocksize,
+            "Length: %d" % self.length,
+            "Hash-Lengths: %d,%d,%d" % (seq_matches, rsum_len, checksum_len),
+            "URL: %s" % url,
+            "SHA-1: %s" % self.sha1.hexdigest(),
+            ])
+        with open(path, "wb") as zsync:
+            zsync.write(("\n".join(headers) + "\n\n").encode("UTF-8"))
+            for block_sum in self.block_sums:
+                # Use the trailing bytes of the rsum, as zsyncmake does.
+                zsync.write(block_sum[4 - rsum_len:4])
+                zsync.write(block_sum[4:4 + checksum_len])
+
+
+def zsync_file(infile, outfile, url, hash_objs=()):
+    """Make a zsync metafile for INFILE, reading it only once.
+
+    Each object in HASH_OBJS is also updated with the contents of INFILE.
+    """
+    st = os.stat(infile)
+    generator = ZsyncGenerator(st.st_size)
+    consumers = [generator] + list(hash_objs)
+    with open(infile, "rb") as image:
+        while True:
+            buf = image.read(_CHUNK_SIZE)
+            if not buf:
+                break
+            for consumer in consumers:
+                consumer.update(buf)
+    generator.write(
+        outfile, os.path.basename(infile), url, mtime=int(st.st_mtime))